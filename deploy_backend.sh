@@ -55,7 +55,9 @@ Commands:
 	    redis		Creates a bash shell into redis cache container. 'redis-cli' to access cmd line interface.
     logs
     	    web			Shows logs for the web service
-	    celery		Shows logs for celery distributed task queue
+	    celery_interactive	Shows logs for celery workers of the interactive queue
+	    celery_batch	Shows logs for celery workers of the batch queue
+	    celery_maintenance	Shows logs for celery workers of the maintenance queue
 	    flower		Shows logs for the flower monitor of the celery distributed task queue
 	    nginx		Shows logs for nginx
 	    redis		Shows logs for redis
@@ -184,8 +186,8 @@ docker_service_logs(){
 		web)
 			docker service logs $(docker service ls -f name=${DOCKER_STACK}_web -q) -f -t
 		;;
-		celery)
-			docker service logs $(docker service ls -f name=${DOCKER_STACK}_celery -q) -f -t
+		celery_interactive|celery_batch|celery_maintenance)
+			docker service logs $(docker service ls -f name=${DOCKER_STACK}_$1 -q) -f -t
 		;;
 		flower)
 			docker service logs $(docker service ls -f name=${DOCKER_STACK}_flower -q) -f -t
@@ -8,17 +8,21 @@ from logging.handlers import RotatingFileHandler
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_bootstrap import WebCDN
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_caching import Cache
 from flask_mail import Mail
 from config import config, Config
 from celery import Celery
 from .watchdog import Watchdog
+from .routing_session import RoutingSQLAlchemy
+from .timeseries import TimeSeriesCache
+from .local_cache import LocalCache, InvalidationBus
+from .rate_limit import RateLimiter
+from .wait_slots import WaitSlots
 from werkzeug.contrib.fixers import ProxyFix
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 mail = Mail()
 cache = Cache(config={
     'CACHE_TYPE': 'redis',
@@ -29,6 +33,10 @@ cache = Cache(config={
 
 celery = Celery(__name__, broker=Config.CELERY_BROKER_URL)
 
+# Plain Redis client for the data structures flask_caching cannot express
+# (counters, sorted sets, pub/sub). Connections are opened lazily.
+redis_store = redis.StrictRedis.from_url(Config.REDIS_URL)
+
 login_manager = LoginManager()
 login_manager.session_protection = 'basic'
 login_manager.login_view = 'auth.login'
@@ -47,6 +55,31 @@ info_file_handler.setFormatter(info_formatter)
 logger.addHandler(info_file_handler)
 
 watchdog = Watchdog(timeout=10, cache=cache)
+timeseries = TimeSeriesCache(redis_store)
+rate_limiter = RateLimiter(redis_store)
+invalidation_bus = InvalidationBus(redis_store)
+# Requests of this worker waiting on events, SSE streams and long-polls
+wait_slots = WaitSlots()
+# Per-worker cache of samples by second, None marks a second without data
+sample_cache = invalidation_bus.register(LocalCache(
+    'samples', maxsize=Config.LOCAL_CACHE_MAX_SAMPLES,
+    ttl=Config.LOCAL_CACHE_TTL_S))
+# Per-worker (user id, confirmed) of recently verified API credentials, keyed
+# by an HMAC of the credentials and tagged with the user id
+credential_cache = invalidation_bus.register(LocalCache(
+    'credentials', maxsize=Config.CREDENTIAL_CACHE_MAX,
+    ttl=Config.CREDENTIAL_CACHE_TTL_S))
+# Per-worker column values of recently loaded User rows, by user id
+user_cache = invalidation_bus.register(LocalCache(
+    'users', maxsize=Config.USER_CACHE_MAX, ttl=Config.USER_CACHE_TTL_S))
+# Per-worker (user id, confirmed) of device keys by key id, None for unknown
+# keys, tagged with the user id
+device_key_cache = invalidation_bus.register(LocalCache(
+    'device_keys', maxsize=Config.DEVICE_KEY_CACHE_MAX,
+    ttl=Config.DEVICE_KEY_CACHE_TTL_S))
+# Per-worker replication lag of each read replica, None if unreachable
+replica_lag_cache = LocalCache('replica_lag', maxsize=64,
+                               ttl=Config.REPLICA_LAG_CHECK_S)
 
 def create_app(config_name):
     """
@@ -90,6 +123,7 @@ def create_app(config_name):
         except redis.ConnectionError as e:
             print(e)
             sys.exit(-1)
+    invalidation_bus.clear_local()
 
     # Backend Warning/Error Logger
     if not app.config['TESTING']:
@@ -1,19 +1,51 @@
 """Handles authentication information for API calls"""
+import hmac
+import math
+import hashlib
 from sqlalchemy import func
-from flask import g, jsonify
+from flask import g, jsonify, current_app, request
 from flask_httpauth import HTTPBasicAuth
 from . import api_0_1
-from .errors import unauthorized, forbidden
-from ..models import User, AnonymousUser
+from .errors import unauthorized, forbidden, bad_request, \
+    too_many_requests
+from .. import credential_cache, invalidation_bus, tokens, device_keys, \
+    rate_limiter
+from ..models import User, AnonymousUser, ApiPrincipal
 
 # pylint: disable=invalid-name
 auth = HTTPBasicAuth()
+# Scope a request needs, by method
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Endpoints any valid token may use, to get or revoke tokens
+TOKEN_ENDPOINTS = ('api_0_1.get_token', 'api_0_1.revoke_token')
+# Endpoints requests signed with a device key may use
+DEVICE_ENDPOINTS = ('api_0_1.new_post',)
+
+
+def credential_key(email, password):
+    """
+    Keyed hash of a pair of credentials, so that the credential cache does
+    not hold anything a password could be recovered from without the key
+
+    Args:
+        email: lower case email of the user
+        password: the password given
+
+    Returns:
+        hex HMAC-SHA256 of the credentials, keyed by SECRET_KEY
+    """
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'),
+                    '{}\0{}'.format(email, password).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
 
 
 @auth.verify_password
 def verify_password(email_or_token, password):
     """
-    Verifies for password or token
+    Verifies for password or token. Verified email/password pairs are
+    cached for CREDENTIAL_CACHE_TTL_S, so that repeated requests skip the
+    user query and the password hash; the entries of a user are dropped
+    when their email, password or confirmation changes or they are deleted.
 
     Args:
         email_or_token: used to verify the identity of the user
@@ -30,12 +62,21 @@ def verify_password(email_or_token, password):
         g.token_used = True
         return g.current_user is not None
     email_or_token = email_or_token.lower()
+    invalidation_bus.ensure_started()
+    key = credential_key(email_or_token, password)
+    found, principal = credential_cache.get(key)
+    g.token_used = False
+    if found:
+        g.current_user = ApiPrincipal(*principal)
+        return True
     user = User.query.filter(func.lower(User.email)==email_or_token).first()
     if not user:
         return False
     g.current_user = user
-    g.token_used = False
-    return user.verify_password(password)
+    if not user.verify_password(password):
+        return False
+    credential_cache.set(key, (user.id, user.confirmed), tag=user.id)
+    return True
 
 
 @auth.error_handler
@@ -50,10 +91,89 @@ def auth_error():
 
 
 @api_0_1.before_request
-@auth.login_required
 def before_request():
     """
-    Checks that the API user is signed in before any requests are made
+    Rate limits requests by IP address, then authenticates those signed with
+    a device key by their signature, and the others by password or token,
+    and rate limits them by who they are, before any requests are made
+
+    Returns:
+        too_many_requests, with Retry-After, if a rate limit is reached
+    """
+    refused = rate_limited(rate_limiter.limit_address(request))
+    if refused is not None:
+        return refused
+    key_id = request.headers.get(device_keys.KEY_ID_HEADER)
+    error = verify_user() if key_id is None else verify_device()
+    if error is not None:
+        return error
+    principal = ('user:{}'.format(g.current_user.id) if key_id is None
+                 else 'device:{}'.format(key_id))
+    return rate_limited(rate_limiter.limit(request, principal))
+
+
+def rate_limited(limited):
+    """
+    Keeps the state of a rate limit for the response headers
+
+    Args:
+        limited: result of rate_limiter.limit or limit_address, None if the
+        request was not limited
+
+    Returns:
+        too_many_requests, with Retry-After, if no token was left
+    """
+    if limited is None:
+        return None
+    allowed, capacity, remaining, wait = limited
+    g.rate_limit = (capacity, remaining)
+    if not allowed:
+        return too_many_requests('Rate limit reached.',
+                                 retry_after=math.ceil(wait))
+    return None
+
+
+@api_0_1.after_request
+def add_rate_limit_headers(response):
+    """Tells clients how many requests they have left"""
+    if 'rate_limit' in g:
+        capacity, remaining = g.rate_limit
+        response.headers['X-RateLimit-Limit'] = str(capacity)
+        response.headers['X-RateLimit-Remaining'] = str(remaining)
+    return response
+
+
+def verify_device():
+    """
+    Checks the signature of a request signed with a device key. Devices
+    can only post samples.
+
+    Returns:
+        unauthorized, which displays the message 'Invalid signature'
+        forbidden, if the endpoint is not for devices or the user cannot
+        use the API
+    """
+    owner = device_keys.verify(request)
+    if owner is None:
+        return unauthorized('Invalid signature')
+    user_id, confirmed = owner
+    g.current_user = ApiPrincipal(user_id, confirmed, scopes=['write'])
+    # Devices cannot get tokens either
+    g.token_used = True
+    if request.endpoint not in DEVICE_ENDPOINTS:
+        return forbidden('Device keys can only post samples')
+    return check_user()
+
+
+@auth.login_required
+def verify_user():
+    """Checks the password or token of a request"""
+    return check_user()
+
+
+def check_user():
+    """
+    Checks that the API user is signed in and allowed to make the request
 
     Returns:
         forbidden, which displays the message 'Not signed in'
@@ -64,11 +184,30 @@ def before_request():
     if not g.current_user.confirmed:
         return forbidden('Unconfirmed account')
 
+    scope = 'read' if request.method in READ_METHODS else 'write'
+    if request.endpoint not in TOKEN_ENDPOINTS and not has_scope(scope):
+        return forbidden('Token lacks the {} scope'.format(scope))
+
+
+def has_scope(scope):
+    """
+    Args:
+        scope: one of API_TOKEN_SCOPES
+
+    Returns:
+        True if the current user may use the scope. Passwords grant every
+        scope, tokens those they were issued with.
+    """
+    scopes = getattr(g.current_user, 'scopes', None)
+    return scopes is None or scope in scopes
+
 
 @api_0_1.route('/token')
 def get_token():
     """
-    Generates a token, based on the username and password.
+    Generates a token, based on the username and password. The token
+    grants the scopes given, comma separated, all of them by default, and
+    expires after expiration seconds, API_TOKEN_EXPIRATION by default.
 
     Returns:
         unauthorized, which displays the message 'Invalid credentials'
@@ -82,13 +221,13 @@ def get_token():
 
     .. sourcecode:: shell
 
-        curl --user <username>:<password> -X GET http://localhost/api/v0.1/token
+        curl --user <username>:<password> -X GET http://localhost/api/v0.1/token?scope=read&expiration=3600
 
     Command response:
 
     .. sourcecode:: http
 
-        GET /api/v0.1/token HTTP/1.1
+        GET /api/v0.1/token?scope=read&expiration=3600 HTTP/1.1
         Host: 127.0.0.1:5000
         Authorization: Basic <b64 encoded username:password>
 
@@ -104,13 +243,54 @@ def get_token():
             "token":"asdfj34j34i5h38ewi34j0983uerij23ih03-i203riho"
             }
 
+    :query scope: comma separated scopes, among read and write
+    :query expiration: lifetime of the token in seconds, at most
+        API_TOKEN_MAX_EXPIRATION
     :reqheader Authorization: use cURL tag with <usrnme>:<psswrd>, or <token>:
     :resheader Content-Type: application/json
     :statuscode 200: Successfully retrieved token
+    :statuscode 400: Unknown scope or invalid expiration
     :statuscode 401: Invalid credentials
 
     """
     if g.current_user.is_anonymous or g.token_used:
         return unauthorized('Invalid credentials')
+    valid_scopes = current_app.config['API_TOKEN_SCOPES']
+    scopes = request.args.get('scope', ','.join(valid_scopes)).split(',')
+    if not scopes or any(scope not in valid_scopes for scope in scopes):
+        return bad_request('Scopes must be among {}.'.format(
+            ', '.join(valid_scopes)))
+    expiration = request.args.get(
+        'expiration', current_app.config['API_TOKEN_EXPIRATION'], type=int)
+    if not 0 < expiration <= current_app.config['API_TOKEN_MAX_EXPIRATION']:
+        return bad_request('Expiration must be from 1 to {} seconds.'.format(
+            current_app.config['API_TOKEN_MAX_EXPIRATION']))
     return jsonify({'token': g.current_user.generate_auth_token(
-        expiration=3600), 'expiration': 3600})
+        expiration=expiration, scopes=scopes), 'expiration': expiration})
+
+
+@api_0_1.route('/token', methods=['DELETE'])
+def revoke_token():
+    """
+    Revokes the token the request is authenticated with, or every token of
+    the user when authenticated with a password.
+
+    .. :quickref: Token; Revoke authentication tokens
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <token>: -X DELETE http://localhost/api/v0.1/token
+
+    :reqheader Authorization: use cURL tag with <usrnme>:<psswrd>, or <token>:
+    :statuscode 204: Revoked
+    :statuscode 401: Invalid credentials
+    """
+    if g.token_used:
+        tokens.revoke_token(g.current_user.claims)
+    else:
+        tokens.revoke_user_tokens(g.current_user.id)
+    return '', 204
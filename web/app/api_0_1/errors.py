@@ -99,18 +99,71 @@ def unauthorized(message):
     return response
 
 
-def too_many_requests(message):
+def not_found(message):
+    """
+    Creates 404: Not Found response
+
+    Args:
+        message: this is the imported error that the program sends to this file
+
+    Returns:
+        response of '404 error' with message 'not found'
+    """
+    response = jsonify({'404 error': 'not found', 'message': message})
+    response.status_code = 404
+    return response
+
+
+def gone(message):
+    """
+    Creates 410: Gone response
+
+    Args:
+        message: this is the imported error that the program sends to this file
+
+    Returns:
+        response of '410 error' with message 'gone'
+    """
+    response = jsonify({'410 error': 'gone', 'message': message})
+    response.status_code = 410
+    return response
+
+
+def service_unavailable(message, retry_after=None):
+    """
+    Creates 503: Service Unavailable response
+
+    Args:
+        message: this is the imported error that the program sends to this file
+        retry_after: optional seconds to wait, sent as Retry-After
+
+    Returns:
+        response of '503 error' with message 'service unavailable'
+    """
+    response = jsonify({'503 error': 'service unavailable',
+                        'message': message})
+    response.status_code = 503
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(int(retry_after))
+    current_app.logger.error(message)
+    return response
+
+
+def too_many_requests(message, retry_after=None):
     """
     Creates 429: Too Many Requests response
 
     Args:
         message: this is the imported error that the program sends to this file
+        retry_after: optional seconds to wait, sent as Retry-After
 
     Returns:
         response of '429 error' with message 'too many requests'
     """
     response = jsonify({'429 error': 'too many requests', 'message': message})
     response.status_code = 429
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(int(retry_after))
     current_app.logger.warning(str(response.data) + '. The IP trying '
                                'to access data: ' +
                                str(request.remote_addr))
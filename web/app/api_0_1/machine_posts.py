@@ -1,21 +1,121 @@
 """api endpoints"""
-import cProfile
-import pstats
-import io
+import re
+import time
 import sqlalchemy
 import json
 from sqlalchemy import desc
 from datetime import datetime, timedelta
-from flask import jsonify, request, url_for, current_app
+from flask import jsonify, request, url_for, current_app, g, Response, \
+    stream_with_context
 from flask_sqlalchemy import get_debug_queries
+from celery import chord
+from celery.utils import uuid
+from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
 from redis import RedisError
-from .. import db, cache, watchdog, celery
+from werkzeug.http import is_resource_modified
+from .. import db, watchdog, celery, timeseries, sample_cache, \
+    invalidation_bus, redis_store, wait_slots
+from ..http_cache import window_validators, set_window_cache_headers
+from ..gaps import find_gaps
+from ..ingest import sample_ingested
+from ..replicas import read_only
+from ..rollups import rollup_statistics
 from . import api_0_1
-from .errors import not_acceptable, bad_request, too_many_requests, server_error
+from .errors import not_acceptable, bad_request, too_many_requests, \
+    server_error, not_found, service_unavailable, gone
 from ..accepted_json_message import ACCEPTED_JSON
+from ..exceptions import CursorExpired
 from ..models import Machine
+from .. import statistics, statistics_cache, statistics_jobs, result_store
+from .. import correlation, spectrum, task_events
 import strict_rfc3339
 
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Chunks of a long statistics window run as <task id>-<chunk index>
+CHUNK_TASK_ID = '{}-{}'
+PROGRESS_KEY = 'statistics_progress:{}'
+# Durations such as '5', '5s', '10m' or '1h'
+DURATION_UNITS_S = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+DURATION_PATTERN = re.compile(r'^(\d+)([smh]?)$')
+
+
+def read_cached_window(start_epoch, end_epoch):
+    """
+    Reads a window of samples with a single range read of the Redis cache.
+    Blocks of TIMESERIES_BLOCK_S seconds never loaded from the database are
+    read with a single range query and cached, seconds without data in
+    loaded blocks are not queried again.
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        list of (epoch, sample) tuples, in chronological order
+    """
+    def query(first_epoch, last_epoch):
+        return [(strict_rfc3339.rfc3339_to_timestamp(row.datetime),
+                 row.to_json())
+                for row in Machine.query_window(
+                    time.strftime(TIME_FORMAT, time.gmtime(first_epoch)),
+                    time.strftime(TIME_FORMAT, time.gmtime(last_epoch)))]
+
+    block_s = current_app.config['TIMESERIES_BLOCK_S']
+    try:
+        samples, missing = timeseries.range_loaded(start_epoch, end_epoch,
+                                                   block_s)
+    except RedisError as e:
+        print(e)
+        return query(start_epoch, end_epoch)
+    if not missing:
+        return samples
+
+    # Whole blocks are loaded, from the first to the last one missing
+    span_start = missing[0] * block_s
+    span_end = (missing[-1] + 1) * block_s - 1
+    loaded = query(span_start, span_end)
+    try:
+        timeseries.add_many(loaded)
+        timeseries.mark_loaded(range(missing[0], missing[-1] + 1), block_s)
+    except RedisError as e:
+        print(e)
+    return ([sample for sample in samples if sample[0] < span_start] +
+            [sample for sample in loaded
+             if start_epoch <= sample[0] <= end_epoch] +
+            [sample for sample in samples if sample[0] > span_end])
+
+
+def read_window(start_epoch, end_epoch):
+    """
+    Reads a window of samples from the worker's memory, only going to Redis
+    (or the database) for the seconds it does not hold. Seconds without data
+    are remembered too once they are older than LATE_SAMPLE_DELAY_S; late
+    samples invalidate them in every worker.
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        list of samples, in chronological order
+    """
+    invalidation_bus.ensure_started()
+    seconds = range(int(start_epoch), int(end_epoch) + 1)
+    window = sample_cache.get_many(seconds)
+    missing = [second for second in seconds if second not in window]
+    if missing:
+        fetched = {int(epoch): sample for epoch, sample
+                   in read_cached_window(missing[0], missing[-1])}
+        settled = time.time() - current_app.config['LATE_SAMPLE_DELAY_S']
+        for second in missing:
+            sample = fetched.get(second)
+            if sample is not None or second < settled:
+                sample_cache.set(second, sample)
+            window[second] = sample
+    return [window[second] for second in seconds
+            if window[second] is not None]
+
+
 @api_0_1.after_request
 def after_request(response):
     """
@@ -30,6 +130,7 @@ def after_request(response):
 
 
 @api_0_1.route('/posts/')
+@read_only
 def get_posts():
     """
     Get all posts in the database. The result will be paginated if there
@@ -111,7 +212,219 @@ def get_posts():
     })
 
 
+@api_0_1.route('/cache/stats')
+def cache_stats():
+    """
+    Hit and miss counters of the in-memory caches of the worker process
+    that answered the request.
+
+    Returns:
+        jsonify, with the statistics of every cache
+
+    .. :quickref: Cache Statistics; Get in-memory cache counters
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "caches": [
+                {
+                "name": "samples",
+                "size": 1800,
+                "maxsize": 14400,
+                "ttl": 120,
+                "hits": 53100,
+                "misses": 1805,
+                "hit_ratio": 0.967
+                }
+                ]
+            }
+
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :statuscode 200: Successfully retrieved statistics
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+
+    """
+    return jsonify({'caches': [local_cache.stats() for local_cache
+                               in invalidation_bus.caches.values()]})
+
+
+@api_0_1.route('/posts/latest')
+def get_latest_post():
+    """
+    Get the most recent sample, and optionally the most recent samples
+    before it. Served from Redis only, the database is never queried.
+
+    Returns:
+        jsonify, with the latest sample and the recent samples if asked for
+
+    .. :quickref: Latest Data; Get the most recent data
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X GET https://localhost/api/v0.1/posts/latest?count=2
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "latest": {
+                "datetime": "2017-08-17T21:27:35Z",
+                "sensor_1": "10.0"
+                },
+            "recent": [
+                {
+                "datetime": "2017-08-17T21:27:35Z",
+                "sensor_1": "10.0"
+                },
+                {
+                "datetime": "2017-08-17T21:27:34Z",
+                "sensor_1": "9.0"
+                }
+                ]
+            }
+
+   :query count: number of recent samples, at most LATEST_SAMPLES_KEPT
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :statuscode 200: Successfully retrieved data
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 404: No sample was ingested since Redis started
+   :statuscode 503: Redis is unavailable
+
+    """
+    count = request.args.get('count', 0, type=int)
+    MAX_LATEST = current_app.config['LATEST_SAMPLES_KEPT']
+    if count > MAX_LATEST:
+        return too_many_requests(
+            'Request is above {} recent samples.'.format(MAX_LATEST))
+    try:
+        latest = timeseries.latest()
+        recent = timeseries.recent(count) if count > 0 else None
+    except RedisError as e:
+        print(e)
+        return service_unavailable('The latest sample cannot be read, '
+                                   'Redis does not appear to be running.')
+    if latest is None:
+        return not_found('No sample has been received yet.')
+    response = {'latest': latest}
+    if recent is not None:
+        response['recent'] = recent
+    return jsonify(response)
+
+
+@api_0_1.route('/posts/since/<cursor>')
+def get_posts_since(cursor):
+    """
+    Get every sample ingested after a cursor, in the order they were
+    ingested, including late or back-filled samples. If there are none yet,
+    the request waits for new samples until the timeout passes.
+
+    Args:
+        cursor: cursor returned by the previous call, or 0 to start from the
+        oldest sample still in the ingest log
+
+    Returns:
+        jsonify, with the samples and the cursor to use on the next call
+
+    .. :quickref: Changes Since; Long-poll for newly ingested data
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X GET https://localhost/api/v0.1/posts/since/0?timeout=25
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "cursor": "5f0c1b6e3a4d4b5c8e2f9a7d6c5b4a39.1284",
+            "data": [
+                {
+                "datetime": "2017-08-17T21:27:34Z",
+                "sensor_1": "10.0"
+                }
+                ]
+            }
+
+   :query timeout: seconds to wait for new samples, at most
+                   LONG_POLL_MAX_TIMEOUT_S
+   :query limit: maximum number of samples returned
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :statuscode 200: Successfully retrieved data, possibly none
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 410: Cursor expired, resynchronize with a window of data
+   :statuscode 503: Redis is unavailable, or MAX_WAITING_REQUESTS requests
+                    are already waiting, retry after Retry-After
+
+    """
+    MAX_TIMEOUT_S = current_app.config['LONG_POLL_MAX_TIMEOUT_S']
+    MAX_API_DATA_S = current_app.config['MAX_API_DATA_PER_REQUEST']
+    timeout = min(max(request.args.get('timeout', MAX_TIMEOUT_S, type=float),
+                      0), MAX_TIMEOUT_S)
+    limit = min(max(request.args.get('limit', MAX_API_DATA_S, type=int), 1),
+                MAX_API_DATA_S)
+    try:
+        samples, next_cursor = timeseries.changes_since(cursor, limit)
+        if not samples and timeout > 0:
+            if not wait_slots.acquire():
+                return service_unavailable(
+                    'Too many requests are waiting, retry later.',
+                    retry_after=current_app.config['WAITING_RETRY_AFTER_S'])
+            # Nothing is read from the database while waiting
+            db.session.remove()
+            try:
+                pubsub = timeseries.subscribe()
+                try:
+                    # Checked again once subscribed, so no sample is missed
+                    samples, next_cursor = timeseries.changes_since(cursor,
+                                                                    limit)
+                    deadline = time.time() + timeout
+                    while not samples and time.time() < deadline:
+                        if pubsub.get_message(
+                                timeout=deadline - time.time()) is not None:
+                            samples, next_cursor = timeseries.changes_since(
+                                cursor, limit)
+                finally:
+                    pubsub.close()
+            finally:
+                wait_slots.release()
+    except CursorExpired as e:
+        return gone(str(e) + ' Read the missed window with '
+                    '/posts/<start_time>/<end_time> and restart from 0.')
+    except RedisError as e:
+        print(e)
+        return service_unavailable('The ingest log cannot be read, '
+                                   'Redis does not appear to be running.')
+    return jsonify({'data': samples, 'cursor': next_cursor})
+
+
 @api_0_1.route('/posts/<start_time>/<end_time>')
+@read_only
 def get_post(start_time, end_time):
     """
     Get a single post and convert to json.
@@ -173,8 +486,12 @@ def get_post(start_time, end_time):
    :query start_time: Beginning time of window of data being queried
    :query end_time: End time of window of data being queried
    :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :reqheader If-None-Match: ETag of a previously retrieved copy of the window
    :resheader Content-Type: application/json
+   :resheader ETag: changes whenever data inside the window is written
+   :resheader Cache-Control: no-cache, windows are revalidated with their ETag
    :statuscode 200: Successfully retrieved data
+   :statuscode 304: Window has not changed since it was last retrieved
    :statuscode 401: Invalid credentials
    :statuscode 403: Not signed in
 
@@ -204,41 +521,206 @@ def get_post(start_time, end_time):
         return too_many_requests(
             'Request is above {} seconds of data.'.format(MAX_API_DATA_S))
 
-    end = start_time_stripped + time_delta
-    data = []
-    while start_time_stripped <= end:
-        # Until we change to 24hr time
-        strtime = start_time_stripped.strftime(time_format)
+    # Answer conditional requests before doing any of the lookups
+    etag, last_modified = window_validators(start_time_epoch, end_time_epoch)
+    if etag is not None and not is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+        return set_window_cache_headers(response, etag, last_modified)
+
+    data = read_window(start_time_epoch, end_time_epoch)
+
+    response = jsonify(data)
+    if etag is not None:
+        set_window_cache_headers(response, etag, last_modified)
+    return response
+
+@api_0_1.route('/posts/gaps/<start_time>/<end_time>')
+@read_only
+def get_gaps(start_time, end_time):
+    """
+    Get the runs of missing seconds of a window of data, computed by the
+    database. Gaps of closed days are cached.
+
+    Args:
+        start_time: Beginning time of window of data being checked
+        end_time: End time of window of data being checked
+
+    Returns:
+        jsonify, with the first and last missing second of every gap
+
+    .. :quickref: Data Gaps; Get missing intervals of a window of data
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X GET https://localhost/api/v0.1/posts/gaps/2017-09-13T00:00:00Z/2017-09-13T23:59:59Z?min_gap=5s
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "start_time": "2017-09-13T00:00:00Z",
+            "end_time": "2017-09-13T23:59:59Z",
+            "min_gap": 5,
+            "missing": 95,
+            "gaps": [
+                ["2017-09-13T06:55:00Z", "2017-09-13T06:56:29Z"],
+                ["2017-09-13T13:01:57Z", "2017-09-13T13:02:01Z"]
+                ]
+            }
+
+   :query min_gap: shortest gap returned, e.g. 5, 5s, 10m or 1h
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :statuscode 200: Successfully checked the window
+   :statuscode 400: Bad datetimes or min_gap
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 429: Window is too long
+
+    """
+    if not (strict_rfc3339.validate_rfc3339(start_time) and
+            strict_rfc3339.validate_rfc3339(end_time)):
+        return bad_request('Error: Datetimes are not RFC 3339')
+    start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+    end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+    if end_time_epoch < start_time_epoch:
+        return bad_request('Error: End time is before start time')
+
+    MAX_GAP_QUERY_S = current_app.config['MAX_GAP_QUERY_S']
+    if end_time_epoch - start_time_epoch > MAX_GAP_QUERY_S:
+        return too_many_requests(
+            'Request is above {} seconds of data.'.format(MAX_GAP_QUERY_S))
+
+    match = DURATION_PATTERN.match(request.args.get('min_gap', '1'))
+    if match is None:
+        return bad_request('Error: min_gap is not a duration, e.g. 5s')
+    min_gap = max(1, int(match.group(1)) * DURATION_UNITS_S[match.group(2)])
+
+    gaps = find_gaps(start_time_epoch, end_time_epoch, min_gap)
+    return jsonify({
+        'start_time': start_time,
+        'end_time': end_time,
+        'min_gap': min_gap,
+        'missing': sum(last - first + 1 for first, last in gaps),
+        'gaps': [[time.strftime(TIME_FORMAT, time.gmtime(first)),
+                  time.strftime(TIME_FORMAT, time.gmtime(last))]
+                 for first, last in gaps]})
+
+
+@api_0_1.route('/posts/query', methods=['POST'])
+@read_only
+def query_posts():
+    """
+    Get many windows of data with a single request and a single database
+    query. The samples are grouped by window, in the order the windows
+    were given.
+
+    Returns:
+        jsonify, with the samples of each window
+
+    .. :quickref: Batch Query; Get many windows of data at once
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X POST https://localhost/api/v0.1/posts/query -H 'Content-Type: application/json' -d '{"windows": [{"start_time": "2017-09-13T06:55:00Z", "end_time": "2017-09-13T07:05:00Z"}], "fields": ["sensor_1"]}'
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "windows": [
+                {
+                "start_time": "2017-09-13T06:55:00Z",
+                "end_time": "2017-09-13T07:05:00Z",
+                "data": [
+                    {
+                    "datetime": "2017-09-13T06:55:00Z",
+                    "sensor_1": "10.0"
+                    }
+                    ]
+                }
+                ]
+            }
+
+    *(JSON cut for length)*
+
+   :<json windows: list of windows, each with a start_time and an end_time
+   :<json fields: optional list of the sensors to return, defaults to all
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :reqheader Content-Type: application/json
+   :resheader Content-Type: application/json
+   :statuscode 200: Successfully retrieved data
+   :statuscode 400: Malformed JSON, windows or fields
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 429: Too many windows or seconds of data requested
+
+    """
+    try:
+        json_data = json.loads(request.data.decode("utf-8"))
+        raw_windows = json_data['windows']
+        fields = json_data.get('fields', Machine.__table__.columns.keys())
+        if not (isinstance(raw_windows, list) and isinstance(fields, list)):
+            raise TypeError('windows and fields must be lists')
+        if not all(isinstance(field, str) for field in fields):
+            raise TypeError('fields must be strings')
+        windows = [(window['start_time'], window['end_time'])
+                   for window in raw_windows]
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return bad_request('Batch query is malformed: ' + str(e))
+
+    unknown_fields = [field for field in fields
+                      if field not in Machine.__table__.columns]
+    if unknown_fields:
+        return bad_request('Unknown fields: ' + str(unknown_fields))
+
+    MAX_WINDOWS = current_app.config['MAX_QUERY_WINDOWS']
+    if len(windows) > MAX_WINDOWS:
+        return too_many_requests(
+            'Request is above {} windows.'.format(MAX_WINDOWS))
+
+    MAX_API_DATA_S = current_app.config['MAX_API_DATA_PER_REQUEST']
+    total_s = 0
+    for start_time, end_time in windows:
         try:
-            cache.get(strtime)
-            no_redis_connection = False
-        except RedisError:
-            no_redis_connection = True
-
-        if not no_redis_connection:
-            if cache.get(strtime) is None:
-                data_query = Machine.query.filter_by(
-                    datetime=strtime).first()
-                if data_query is not None:
-                    try:
-                        raw_data = data_query.to_json()
-                        data.append(raw_data)
-                        cache.set(strtime, raw_data, timeout=0)
-                    except BaseException:
-                        data.append({"Error": "Could not find data."})
-            else:
-                data.append(cache.get(strtime))
-        else:
-            data_query = Machine.query.filter_by(datetime=strtime).first()
-            if data_query is not None:
-                try:
-                    raw_data = data_query.to_json()
-                    data.append(raw_data)
-                except BaseException:
-                    data.append({"Error": "Could not find data."})
-        start_time_stripped += timedelta(seconds=1)
+            time_delta = datetime.strptime(end_time, TIME_FORMAT) - \
+                datetime.strptime(start_time, TIME_FORMAT)
+        except (ValueError, TypeError):
+            return bad_request('Error: Datetimes are not RFC 3339')
+        if time_delta < timedelta(0):
+            return bad_request('Error: End time is before start time')
+        if time_delta > timedelta(seconds=MAX_API_DATA_S):
+            return too_many_requests(
+                'Window is above {} seconds of data.'.format(MAX_API_DATA_S))
+        total_s += time_delta.total_seconds() + 1
+
+    MAX_TOTAL_S = current_app.config['MAX_QUERY_TOTAL_S']
+    if total_s > MAX_TOTAL_S:
+        return too_many_requests(
+            'Request is above {} seconds of data.'.format(MAX_TOTAL_S))
+
+    results = Machine.select_windows(windows, fields) if windows else []
+    return jsonify({'windows': [
+        {'start_time': start_time, 'end_time': end_time, 'data': data}
+        for (start_time, end_time), data in zip(windows, results)]})
 
-    return jsonify(data)
 
 @api_0_1.route('/posts/', methods=['POST'])
 def new_post():
@@ -279,6 +761,14 @@ def new_post():
 
         curl --user <token>: -X POST https://localhost/api/v0.1/posts/ -H 'Content-Type: application/json' -d 'JSON DATA GOES HERE'
 
+    *or with a device key*, see app.device_keys, where <signature> is the
+    hex HMAC-SHA256 keyed by the key's secret of the timestamp, method, path,
+    query string and hex SHA-256 of the body, one per line:
+
+    .. sourcecode:: shell
+
+        curl -X POST https://localhost/api/v0.1/posts/ -H 'Content-Type: application/json' -H 'X-Device-Key: <key id>' -H 'X-Timestamp: <epoch>' -H 'X-Signature: <signature>' -d 'JSON DATA GOES HERE'
+
     Command line output of cUrl:
 
     .. sourcecode:: http
@@ -301,6 +791,9 @@ def new_post():
         }
 
    :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :reqheader X-Device-Key: id of a device key, instead of Authorization
+   :reqheader X-Timestamp: seconds since epoch, with X-Device-Key
+   :reqheader X-Signature: signature of the request, with X-Device-Key
    :reqheader Content-Type: application/json
    :resheader Content-Type: application/json
    :statuscode 200: Successfully retrieved data
@@ -370,44 +863,546 @@ def new_post():
                               'database: ' + str(invalid_sensors))
 
     """
-    Set datetime key in cache if it doesn't already exist.
+    Add the sample to the cache if that second isn't already cached.
     Try to commit it to the database if it wasn't in cache already.
     """
+    epoch = strict_rfc3339.rfc3339_to_timestamp(json_post['datetime'])
     try:
-        if cache.get(json_post['datetime']) is None:
-            cache.set(json_post['datetime'], to_json_data,
-                      timeout=0)
-            try:
-                db.session.add(data)
-                db.session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                return not_acceptable(
-                    'A unique id error was returned. '
-                    'This datetime is already in the database.')
-        else:
+        if not timeseries.add(epoch, to_json_data):
             return not_acceptable('This datetime is already in cache.')
+        cached = True
     except RedisError as e:
         print(e)
         print('Redis port may be closed, the redis server does '
               'not appear to be running.')
+        cached = False
+
+    try:
+        db.session.add(data)
+        db.session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # Else the session cannot be used for the rest of the request
+        db.session.rollback()
+        if cached:
+            try:
+                timeseries.remove(to_json_data)
+            except RedisError as e:
+                print(e)
+                print('Redis port may be closed, the refused sample stays '
+                      'cached.')
+        return not_acceptable(
+            'A unique id error was returned. '
+            'This datetime is already in the database.')
+    sample_ingested(epoch, to_json_data)
 
     return jsonify(
         {'response': '201 data created',
          'message': 'Data was successfully posted!'}), 201
 
 
+def start_statistics(start_time, end_time, start_time_epoch, end_time_epoch):
+    """
+    Starts a statistics task, unless the same request is cached or already
+    running
+
+    Args:
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+        start_time_epoch: start_time, in seconds since epoch
+        end_time_epoch: end_time, in seconds since epoch
+
+    Returns:
+        the cached result, or a 202 pointing to the task's status
+    """
+    return start_task(
+        start_time_epoch, end_time_epoch,
+        {'percentiles': current_app.config['STATISTICS_PERCENTILES'],
+         'reservoir_size': current_app.config['STATISTICS_RESERVOIR_SIZE']},
+        lambda task_id, key: launch_statistics(
+            task_id, start_time, end_time, start_time_epoch, end_time_epoch,
+            key))
+
+
+def start_task(start_time_epoch, end_time_epoch, params, launch):
+    """
+    Starts a background task over a window, unless the same request is
+    cached or already running
+
+    Args:
+        start_time_epoch: Beginning of the window, in seconds since epoch
+        end_time_epoch: End of the window, in seconds since epoch
+        params: JSON serializable parameters telling the computation apart
+        from others over the same window
+        launch: function of the task id and the cache key that sends the
+        task
+
+    Returns:
+        the cached result, or a 202 pointing to the task's status
+    """
+    callback = request.args.get('callback')
+    if callback is not None and not task_events.valid_webhook(callback):
+        return bad_request('Error: callback is not an https URL of a '
+                           'public host')
+    key = statistics_cache.request_key(
+        Machine.__tablename__, start_time_epoch, end_time_epoch, params)
+    task_id = uuid()
+    user_id = g.current_user.id
+    if key is not None:
+        response = statistics_cache.cached_result(key)
+        if result_store.is_offloaded(response):
+            streamed = result_store.stream(response)
+            # A purged result file is computed again
+            if streamed is not None:
+                return streamed
+        elif response is not None:
+            return jsonify(response['result']), response['status']
+        existing = statistics_cache.claim(key, task_id)
+        if existing is not None and async_statistics.AsyncResult(
+                existing).state in ('FAILURE', 'REVOKED'):
+            existing = statistics_cache.claim(key, task_id, replace=True)
+        if existing is not None:
+            # Joining a running task does not add to the queue
+            statistics_jobs.add_requester(existing, user_id)
+            if callback is not None:
+                task_events.add_webhook(existing, callback, url_for(
+                    'api_0_1.statistics_status', task_id=existing,
+                    _external=True))
+                # The task may have finished before the webhook was added
+                task = async_statistics.AsyncResult(existing)
+                if task.ready():
+                    task_events.notify(existing, task.state, (
+                        task.result.get('status')
+                        if isinstance(task.result, dict) else None))
+            return jsonify({}), 202, {
+                'Location': url_for('api_0_1.statistics_status',
+                                    task_id=existing)}
+
+    queue, _ = statistics_jobs.placement(end_time_epoch - start_time_epoch + 1)
+    refusal = admit_statistics(user_id, queue)
+    if refusal is not None:
+        if key is not None:
+            statistics_cache.release(key)
+        return refusal
+    statistics_jobs.add_requester(task_id, user_id)
+    if callback is not None:
+        task_events.add_webhook(task_id, callback, url_for(
+            'api_0_1.statistics_status', task_id=task_id, _external=True))
+    launch(task_id, key)
+    return jsonify({}), 202, {'Location': url_for('api_0_1.statistics_status',
+                                                  task_id=task_id)}
+
+
+def admit_statistics(user_id, queue):
+    """
+    Admission control of new statistics tasks
+
+    Args:
+        user_id: id of the user requesting a task
+        queue: Celery queue the task would be sent to
+
+    Returns:
+        a 429 response if the task should not be started, else None
+    """
+    retry_after = current_app.config['STATISTICS_RETRY_AFTER_S']
+    MAX_TASKS = current_app.config['STATISTICS_MAX_TASKS_PER_USER']
+    in_flight = statistics_jobs.tasks_in_flight(
+        user_id, lambda task_id: async_statistics.AsyncResult(task_id).ready())
+    if in_flight >= MAX_TASKS:
+        return too_many_requests(
+            'You already have {} statistics tasks running.'.format(MAX_TASKS),
+            retry_after=retry_after)
+    if statistics_jobs.queue_length(queue) \
+            >= current_app.config['STATISTICS_QUEUE_MAX']:
+        return too_many_requests('Statistics queue is full.',
+                                 retry_after=retry_after)
+    return None
+
+
+def launch_statistics(task_id, start_time, end_time, start_time_epoch,
+                      end_time_epoch, cache_key=None):
+    """
+    Runs windows of up to STATISTICS_CHUNK_S in a single task, longer ones
+    as a chord of one task per chunk whose callback merges the partial
+    results. The chunks' ids are derived from task_id. Every task of a
+    window gets the queue and priority of the whole window, except the
+    callback which is cheap and goes first.
+
+    Args:
+        task_id: id of the task whose result is the statistics
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+        start_time_epoch: start_time, in seconds since epoch
+        end_time_epoch: end_time, in seconds since epoch
+        cache_key: key the result is cached under, if any
+    """
+    chunk_s = current_app.config['STATISTICS_CHUNK_S']
+    start_time_epoch = int(start_time_epoch)
+    end_time_epoch = int(end_time_epoch)
+    queue, priority = statistics_jobs.placement(
+        end_time_epoch - start_time_epoch + 1)
+    if end_time_epoch - start_time_epoch < chunk_s:
+        soft, hard = statistics_jobs.time_limits(
+            end_time_epoch - start_time_epoch + 1)
+        async_statistics.apply_async((start_time, end_time),
+                                     {'cache_key': cache_key},
+                                     task_id=task_id, soft_time_limit=soft,
+                                     time_limit=hard, queue=queue,
+                                     priority=priority)
+        return
+    soft, hard = statistics_jobs.time_limits(chunk_s)
+    chunks = [(chunk_start, min(chunk_start + chunk_s - 1, end_time_epoch))
+              for chunk_start in range(start_time_epoch, end_time_epoch + 1,
+                                       chunk_s)]
+    # Reported by statistics_status until the callback stores its result
+    async_statistics.backend.store_result(
+        task_id, {'result': {'result': 'Computing statistics.',
+                             'progress': 0.0},
+                  'status': 202, 'chunks': len(chunks)}, 'PROGRESS')
+    header = [statistics_chunk.signature(
+        (time.strftime(TIME_FORMAT, time.gmtime(chunk_start)),
+         time.strftime(TIME_FORMAT, time.gmtime(chunk_end)), task_id),
+        immutable=True).set(task_id=CHUNK_TASK_ID.format(task_id, index),
+                            soft_time_limit=soft, time_limit=hard,
+                            queue=queue, priority=priority)
+              for index, (chunk_start, chunk_end) in enumerate(chunks)]
+    chord(header)(merge_callback(task_id, start_time, end_time,
+                                 end_time_epoch, cache_key, queue))
+
+
+def merge_callback(task_id, start_time, end_time, end_time_epoch, cache_key,
+                   queue):
+    """
+    Args:
+        task_id: id of the task whose result is the statistics
+        start_time: Beginning time of the window
+        end_time: End time of the window
+        end_time_epoch: end_time, in seconds since epoch
+        cache_key: key the result is cached under, if any
+        queue: Celery queue of the window's tasks
+
+    Returns:
+        signature of the merge_statistics callback of a chord, with the
+        chord_failed errback
+    """
+    soft, hard = statistics_jobs.time_limits(0)
+    callback = merge_statistics.signature(
+        (start_time, end_time, end_time_epoch, cache_key)).set(
+            task_id=task_id, soft_time_limit=soft, time_limit=hard,
+            queue=queue, priority=0)
+    # The callback never runs if a chunk fails
+    callback.link_error(chord_failed.signature(
+        kwargs={'cache_key': cache_key}).set(queue=queue, priority=0))
+    return callback
+
+
 @api_0_1.route('/statistics/<start_time>/<end_time>', methods=['GET'])
+@read_only
 def statistics_of_data(start_time, end_time):
     """
-    API Endpoint to run statistical analysis, which calls the async
-    background function.
+    API Endpoint to run statistical analysis. By default the async
+    background function computes the statistics from the raw rows, with
+    source=rollups they are merged from the per-minute rollups and returned
+    right away. Percentiles of the rollups are estimated from quantile
+    sketches, within STATISTICS_SKETCH_ACCURACY of the true values. Rollups
+    only cover the samples ingested since they were deployed, or rebuilt
+    with manage.py rebuild_rollups, and miss the minutes lost if Redis was
+    restarted or evicted them before they were flushed.
     Args:
         start_time: Beginning time of window of data being queried
         end_time: End time of window of data being queried
+
+    .. :quickref: Statistics; Get statistics of a window of data
+
+    **Example response**, with source=rollups:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "start_time": "2017-09-01T00:00:00Z",
+            "end_time": "2017-09-30T23:59:59Z",
+            "data": {
+                "sensor_1": {
+                    "count": 2592000,
+                    "mean": 7.2,
+                    "std": 1.3,
+                    "min": 0.0,
+                    "max": 12.5,
+                    "percentiles": {"50": 7.1, "95": 9.6, "99": 11.8}
+                    }
+                }
+            }
+
+   :query source: raw (default) or rollups
+   :query callback: https URL POSTed to when the task is done, with
+                    source=raw, see statistics_events
+   :query percentiles: comma separated percentiles from 0 to 100, defaults
+                       to STATISTICS_SKETCH_PERCENTILES, rollups only
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :resheader Location: status of the background task, with source=raw
+   :statuscode 200: Statistics merged from the rollups, with source=rollups
+   :statuscode 202: Background task started, with source=raw
+   :statuscode 400: Bad datetimes, source or percentiles
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 429: Window too long, too many tasks running for this user or
+                    statistics queue full, retry after Retry-After seconds
+   :statuscode 503: Redis is unavailable with source=rollups, use source=raw
     """
-    task = async_statistics.delay(start_time, end_time)
-    return jsonify({}), 202, {'Location': url_for('api_0_1.statistics_status',
-                                                  task_id=task.id)}
+    source = request.args.get('source', 'raw')
+    if source not in ('raw', 'rollups'):
+        return bad_request('Error: source is either raw or rollups')
+
+    if not (strict_rfc3339.validate_rfc3339(start_time) and
+            strict_rfc3339.validate_rfc3339(end_time)):
+        return bad_request('Error: Datetimes are not RFC 3339')
+    start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+    end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+    if end_time_epoch < start_time_epoch:
+        return bad_request('Error: End time is before start time')
+
+    if source == 'raw':
+        MAX_WINDOW_S = current_app.config['STATISTICS_MAX_WINDOW_S']
+        if end_time_epoch - start_time_epoch > MAX_WINDOW_S:
+            return too_many_requests(
+                'Request is above {} seconds of data.'.format(MAX_WINDOW_S))
+        return start_statistics(start_time, end_time, start_time_epoch,
+                                end_time_epoch)
+
+    percentiles = current_app.config['STATISTICS_SKETCH_PERCENTILES']
+    if request.args.get('percentiles'):
+        try:
+            percentiles = [float(percentile) for percentile
+                           in request.args['percentiles'].split(',')]
+        except ValueError:
+            return bad_request('Error: percentiles are not numbers')
+        if not all(0 <= percentile <= 100 for percentile in percentiles):
+            return bad_request('Error: percentiles are not between 0 and 100')
+        # 50 rather than 50.0 in the keys of the result
+        percentiles = [int(percentile) if percentile.is_integer()
+                       else percentile for percentile in percentiles]
+
+    try:
+        accumulator, sketches = rollup_statistics(start_time_epoch,
+                                                  end_time_epoch)
+    except RedisError as e:
+        print(e)
+        return service_unavailable('Rollups are unavailable, use source=raw.')
+    data = accumulator.result([])
+    for sensor in data:
+        data[sensor]['percentiles'] = sketches[sensor].percentiles(
+            percentiles)
+    return jsonify({'start_time': start_time,
+                    'end_time': end_time,
+                    'data': data})
+
+
+@api_0_1.route('/correlation/<start_time>/<end_time>', methods=['GET'])
+@read_only
+def correlation_of_data(start_time, end_time):
+    """
+    API Endpoint to compute the correlation and covariance matrices of the
+    sensors over a window, in a background task. With lags, sensor j at
+    t - lag is paired with sensor i at t. The result is polled from the
+    statistics status endpoint.
+    Args:
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+
+    .. :quickref: Statistics; Get correlations between sensors
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X GET "https://localhost/api/v0.1/correlation/2017-09-01T00:00:00Z/2017-09-30T23:59:59Z?lags=0,60"
+
+    **Example result**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "start_time": "2017-09-01T00:00:00Z",
+            "end_time": "2017-09-30T23:59:59Z",
+            "sensors": ["sensor_1"],
+            "lags": {
+                "0": {"count": [[2592000]], "covariance": [[1.69]],
+                      "correlation": [[1.0]]},
+                "60": {"count": [[2591940]], "covariance": [[1.21]],
+                       "correlation": [[0.72]]}
+                }
+            }
+
+   :query sensors: comma separated sensors, defaults to every sensor
+   :query lags: comma separated lags in seconds, defaults to 0
+   :query callback: https URL POSTed to when the task is done, see
+                    statistics_events
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :resheader Location: status of the background task
+   :statuscode 200: Result of an identical request, from the cache
+   :statuscode 202: Background task started
+   :statuscode 400: Bad datetimes, sensors or lags
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 429: Window too long, too many tasks running for this user or
+                    statistics queue full, retry after Retry-After seconds
+    """
+    if not (strict_rfc3339.validate_rfc3339(start_time) and
+            strict_rfc3339.validate_rfc3339(end_time)):
+        return bad_request('Error: Datetimes are not RFC 3339')
+    start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+    end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+    if end_time_epoch < start_time_epoch:
+        return bad_request('Error: End time is before start time')
+    MAX_WINDOW_S = current_app.config['STATISTICS_MAX_WINDOW_S']
+    if end_time_epoch - start_time_epoch > MAX_WINDOW_S:
+        return too_many_requests(
+            'Request is above {} seconds of data.'.format(MAX_WINDOW_S))
+
+    sensors = statistics.sensor_columns()
+    if request.args.get('sensors'):
+        requested = request.args['sensors'].split(',')
+        if not set(requested) <= set(sensors):
+            return bad_request('Error: Unknown sensors')
+        sensors = requested
+    try:
+        lags = sorted({int(lag) for lag
+                       in request.args.get('lags', '0').split(',')})
+    except ValueError:
+        return bad_request('Error: Lags are not integers')
+    if lags[0] < 0 or lags[-1] > current_app.config['CORRELATION_MAX_LAG_S'] \
+            or len(lags) > current_app.config['CORRELATION_MAX_LAGS']:
+        return bad_request('Error: Lags must be at most {} values from 0 to '
+                           '{} seconds'.format(
+                               current_app.config['CORRELATION_MAX_LAGS'],
+                               current_app.config['CORRELATION_MAX_LAG_S']))
+
+    def launch(task_id, key):
+        queue, priority = statistics_jobs.placement(
+            end_time_epoch - start_time_epoch + 1)
+        soft, hard = statistics_jobs.time_limits(
+            end_time_epoch - start_time_epoch + 1)
+        async_correlation.apply_async(
+            (start_time, end_time, sensors, lags), {'cache_key': key},
+            task_id=task_id, soft_time_limit=soft, time_limit=hard,
+            queue=queue, priority=priority)
+
+    return start_task(start_time_epoch, end_time_epoch,
+                      {'kind': 'correlation', 'sensors': sensors,
+                       'lags': lags}, launch)
+
+
+@api_0_1.route('/spectrum/<start_time>/<end_time>', methods=['GET'])
+@read_only
+def spectrum_of_data(start_time, end_time):
+    """
+    API Endpoint to compute the Welch power spectral density and the
+    dominant frequencies of the sensors over a window, in a background task.
+    Sensors are sampled once a second at most, so frequencies go up to
+    0.5 Hz. The result is polled from the statistics status endpoint.
+    Args:
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+
+    .. :quickref: Statistics; Get the power spectral density of sensors
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X GET "https://localhost/api/v0.1/spectrum/2017-09-01T00:00:00Z/2017-09-01T23:59:59Z?segment=256"
+
+    **Example result**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: application/json
+
+        {
+            "start_time": "2017-09-01T00:00:00Z",
+            "end_time": "2017-09-01T23:59:59Z",
+            "frequencies": [0.0, 0.00390625, 0.0078125, ...],
+            "sensors": {
+                "sensor_1": {
+                    "segments": 673,
+                    "psd": [0.0, 0.012, 0.31, ...],
+                    "peaks": [{"frequency": 0.0078125, "power": 0.31}]
+                    }
+                }
+            }
+
+   :query sensors: comma separated sensors, defaults to every sensor
+   :query segment: length of the Welch segments in seconds, a power of two,
+                   defaults to SPECTRUM_SEGMENT_S
+   :query callback: https URL POSTed to when the task is done, see
+                    statistics_events
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: application/json
+   :resheader Location: status of the background task
+   :statuscode 200: Result of an identical request, from the cache
+   :statuscode 202: Background task started
+   :statuscode 400: Bad datetimes, sensors or segment
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 429: Window too long, too many tasks running for this user or
+                    statistics queue full, retry after Retry-After seconds
+    """
+    if not (strict_rfc3339.validate_rfc3339(start_time) and
+            strict_rfc3339.validate_rfc3339(end_time)):
+        return bad_request('Error: Datetimes are not RFC 3339')
+    start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+    end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+    if end_time_epoch < start_time_epoch:
+        return bad_request('Error: End time is before start time')
+    MAX_WINDOW_S = current_app.config['STATISTICS_MAX_WINDOW_S']
+    if end_time_epoch - start_time_epoch > MAX_WINDOW_S:
+        return too_many_requests(
+            'Request is above {} seconds of data.'.format(MAX_WINDOW_S))
+
+    sensors = statistics.sensor_columns()
+    if request.args.get('sensors'):
+        requested = request.args['sensors'].split(',')
+        if not set(requested) <= set(sensors):
+            return bad_request('Error: Unknown sensors')
+        sensors = requested
+    MAX_SEGMENT_S = current_app.config['SPECTRUM_MAX_SEGMENT_S']
+    try:
+        segment_s = int(request.args.get(
+            'segment', current_app.config['SPECTRUM_SEGMENT_S']))
+    except ValueError:
+        return bad_request('Error: Segment is not an integer')
+    # Powers of two from 8 seconds
+    if segment_s < 8 or segment_s > MAX_SEGMENT_S or \
+            segment_s & (segment_s - 1):
+        return bad_request('Error: Segment must be a power of two from 8 to '
+                           '{} seconds'.format(MAX_SEGMENT_S))
+
+    def launch(task_id, key):
+        queue, priority = statistics_jobs.placement(
+            end_time_epoch - start_time_epoch + 1)
+        soft, hard = statistics_jobs.time_limits(
+            end_time_epoch - start_time_epoch + 1)
+        async_spectrum.apply_async(
+            (start_time, end_time, sensors, segment_s), {'cache_key': key},
+            task_id=task_id, soft_time_limit=soft, time_limit=hard,
+            queue=queue, priority=priority)
+
+    return start_task(start_time_epoch, end_time_epoch,
+                      {'kind': 'spectrum', 'sensors': sensors,
+                       'segment_s': segment_s,
+                       'peaks': current_app.config['SPECTRUM_PEAKS']}, launch)
 
 
 @api_0_1.route('/statistics/status/<task_id>')
@@ -415,9 +1410,26 @@ def statistics_status(task_id):
     """
     Return status or result of statistical analysis being done in the background
     https://blog.miguelgrinberg.com/post/using-celery-with-flask
+    Large results are streamed from their result file, gzipped if the client
+    accepts gzip. Failed tasks get a 500, and tasks that ran out of time a
+    503 with a Retry-After.
     """
     try:
         task = async_statistics.AsyncResult(task_id)
+        if task.state == 'REVOKED':
+            return gone('Statistics task was cancelled.')
+        if task.state == 'FAILURE':
+            # task.result is the exception the task raised
+            current_app.logger.error('Statistics task {} failed: {!r}'
+                                     .format(task_id, task.result))
+            if isinstance(task.result, (SoftTimeLimitExceeded,
+                                        TimeLimitExceeded)):
+                return service_unavailable(
+                    'Statistics task ran out of time, retry later or with a '
+                    'shorter window.',
+                    retry_after=current_app.config[
+                        'STATISTICS_RETRY_AFTER_S'])
+            return server_error(' statistics task failed.')
         if task.result is None: # Task has not been handed off to a process yet
             # TODO: Better way of checking this? Checking status of a task that
             # is non-existent or invalid will still technically behave the same
@@ -425,8 +1437,23 @@ def statistics_status(task_id):
             response = jsonify({'result': result})
             response.status_code = 202
             return response
+        if task.state == 'SUCCESS' and result_store.is_offloaded(task.result):
+            # Large results are streamed from their file
+            response = result_store.stream(task.result)
+            if response is None:
+                return gone('Statistics result has expired.')
+            return response
         result = task.result['result']
         status = task.result['status']
+        if task.state == 'PROGRESS' and 'chunks' in task.result:
+            # Chunks of a chord count themselves once they are done
+            try:
+                done = int(redis_store.get(PROGRESS_KEY.format(task_id)) or 0)
+            except RedisError as e:
+                print(e)
+                done = 0
+            result = dict(result, progress=round(
+                100.0 * done / task.result['chunks'], 1))
         if (task.state in ('PENDING', 'STARTED', 'PROGRESS', 'SUCCESS')) and (status in (200, 202, 204)):
             # task was created, in various stages of completion
             response = jsonify(result)
@@ -438,13 +1465,6 @@ def statistics_status(task_id):
         elif status == 500:
             # Task returned Sever Error
             return server_error(result)
-        elif task.state == 'FAILURE':
-            # Task failed, unknown reason
-            response = jsonify({
-                'state': task.state,
-                'status': task.info.get('status', '')
-            })
-            # response.status_code = 500
         else:
             # something went wrong in the background job, unknown result
             response = jsonify({
@@ -471,25 +1491,256 @@ def statistics_status(task_id):
     return response
 
 
+@api_0_1.route('/statistics/events/<task_id>')
+def statistics_events(task_id):
+    """
+    Server-Sent Events stream telling when a background task is done,
+    instead of polling its status. A single done event is sent, then the
+    stream ends and the result is read once from the status endpoint.
+    Webhooks given with the request's callback parameter are POSTed the
+    same event, signed with an HMAC-SHA256 of the server's secret key in
+    the X-Signature header.
+
+    Args:
+        task_id: id of the task, from the Location of the request
+
+    .. :quickref: Statistics; Wait for a background task to be done
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl -N --user <email>:<password> -X GET https://localhost/api/v0.1/statistics/events/<task_id>
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.1 200 OK
+        Content-Type: text/event-stream
+
+        event: done
+        data: {"task_id": "<task_id>", "state": "SUCCESS", "status": 200, "location": "https://localhost/api/v0.1/statistics/status/<task_id>"}
+
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :resheader Content-Type: text/event-stream
+   :statuscode 200: Streaming until the task is done or
+                    TASK_EVENTS_MAX_S elapsed
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 503: Redis is unavailable, or MAX_WAITING_REQUESTS requests
+                    are already waiting, poll the status instead
+    """
+    keepalive = current_app.config['SSE_KEEPALIVE_S']
+    location = url_for('api_0_1.statistics_status', task_id=task_id,
+                       _external=True)
+    if not wait_slots.acquire():
+        return service_unavailable(
+            'Too many requests are waiting, poll the status instead.',
+            retry_after=current_app.config['WAITING_RETRY_AFTER_S'])
+    try:
+        # Subscribed before reading the state, so no completion is missed
+        pubsub = task_events.subscribe(task_id)
+    except RedisError as e:
+        print(e)
+        wait_slots.release()
+        return service_unavailable('Task events are unavailable, poll the '
+                                   'status instead.')
+
+    def done(payload):
+        return 'event: done\ndata: {}\n\n'.format(
+            json.dumps(dict(payload, location=location)))
+
+    def events():
+        try:
+            task = async_statistics.AsyncResult(task_id)
+            if task.ready():
+                yield done(task_events.event(task_id, task.state, (
+                    task.result.get('status')
+                    if isinstance(task.result, dict) else None)))
+                return
+            deadline = time.time() + current_app.config['TASK_EVENTS_MAX_S']
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=keepalive)
+                if message is not None and message['type'] == 'message':
+                    yield done(json.loads(message['data'].decode('utf-8')))
+                    return
+                yield ': keepalive\n\n'
+            yield 'event: timeout\ndata: {}\n\n'
+        except RedisError as e:
+            print(e)
+        finally:
+            pubsub.close()
+
+    # Nothing is read from the database while streaming
+    db.session.remove()
+    response = Response(stream_with_context(events()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 # Tells nginx not to buffer the stream
+                                 'X-Accel-Buffering': 'no'})
+    # Also called when the client leaves before the stream starts
+    response.call_on_close(wait_slots.release)
+    return response
+
+
+@api_0_1.route('/statistics/status/<task_id>', methods=['DELETE'])
+def cancel_statistics(task_id):
+    """
+    Cancel a statistics task. Identical requests share a task, so the task
+    is only revoked once every user who requested it has cancelled it.
+
+    Args:
+        task_id: id of the task, from the Location of the statistics request
+
+    .. :quickref: Statistics; Cancel a statistics task
+
+    **Example request**:
+
+    Shell command:
+
+    .. sourcecode:: shell
+
+        curl --user <email>:<password> -X DELETE https://localhost/api/v0.1/statistics/status/<task_id>
+
+   :reqheader Authorization: use cURL tag with <email>:<psswrd>, or <token>:
+   :statuscode 204: Cancelled
+   :statuscode 401: Invalid credentials
+   :statuscode 403: Not signed in
+   :statuscode 404: No statistics task of this user has this id
+   :statuscode 503: Redis is unavailable
+    """
+    try:
+        remaining = statistics_jobs.remove_requester(task_id,
+                                                     g.current_user.id)
+    except RedisError as e:
+        print(e)
+        return service_unavailable('Could not cancel the task, try again.')
+    if remaining is None:
+        return not_found('No statistics task of yours has this id.')
+    if remaining == 0:
+        task = async_statistics.AsyncResult(task_id)
+        task_ids = [task_id]
+        if task.state == 'PROGRESS' and isinstance(task.result, dict):
+            task_ids.extend(CHUNK_TASK_ID.format(task_id, index)
+                            for index in range(task.result.get('chunks', 0)))
+        # SIGUSR1 raises SoftTimeLimitExceeded in tasks already running
+        celery.control.revoke(task_ids, terminate=True, signal='SIGUSR1')
+        async_statistics.backend.mark_as_revoked(
+            task_id, reason='Cancelled by its requesters')
+        task_events.notify(task_id, 'REVOKED')
+    return '', 204
+
+
+@celery.task
+@read_only
+def statistics_chunk(start_time, end_time, parent_id):
+    """
+    Computes the partial statistics of a chunk of a long window
+
+    Args:
+        start_time: Beginning time of the chunk
+        end_time: End time of the chunk
+        parent_id: id of the task merging the chunks, to report progress
+
+    Returns:
+        the chunk's Accumulator, as a dict
+    """
+    partial = statistics.window_statistics(start_time, end_time).to_dict()
+    progress_key = PROGRESS_KEY.format(parent_id)
+    try:
+        redis_store.incr(progress_key)
+        redis_store.expire(progress_key,
+                           current_app.config['STATISTICS_INFLIGHT_TTL'])
+    except RedisError as e:
+        print(e)
+        print('statistics_chunk: Redis port may be closed, progress is not '
+              'reported.')
+    return partial
+
+
+@celery.task(bind=True)
+def merge_statistics(self, partials, start_time, end_time, end_time_epoch,
+                     cache_key=None):
+    """
+    Chord callback merging the partial statistics of the chunks of a window
+
+    Args:
+        partials: results of statistics_chunk, in any order
+        start_time: Beginning time of the window
+        end_time: End time of the window
+        end_time_epoch: end_time, in seconds since epoch
+        cache_key: key the result is cached under, if any
+
+    Returns:
+        response: same as async_statistics
+    """
+    try:
+        accumulator = statistics.Accumulator.from_dict(partials[0])
+        for partial in partials[1:]:
+            accumulator.merge(statistics.Accumulator.from_dict(partial))
+        response = {'result': {
+                        'start_time': start_time, 'end_time': end_time,
+                        'data': accumulator.result(
+                            current_app.config['STATISTICS_PERCENTILES'])},
+                    'status': 200}
+        response = result_store.offload(response, self.request.id)
+        if cache_key is not None:
+            statistics_cache.store_result(cache_key, end_time_epoch,
+                                          response)
+        return response
+    finally:
+        # Also when the merge fails or runs out of time, see async_statistics
+        if cache_key is not None:
+            statistics_cache.release(cache_key)
+        statistics_jobs.finish(self.request.id)
+
+
+@celery.task(ignore_result=True)
+def chord_failed(task_id, *, cache_key=None):
+    """
+    Errback of the callback of a chord, called with the callback's task id
+    when a chunk fails, since the callback then never runs, or when the
+    callback fails. Releases what the task held, as the callback would
+    have, and notifies the task's Server-Sent Events streams and webhooks
+    of the failure, as task_postrun does for tasks that run. Running it
+    again after the callback's own cleanup and notification does nothing
+    but publish the failure once more, webhooks are called once.
+
+    Args:
+        task_id: id of the chord's callback, the task clients wait on
+        cache_key: key the result is cached under, if any. Keyword only, so
+        that Celery calls the errback with the task id alone.
+    """
+    if cache_key is not None:
+        statistics_cache.release(cache_key)
+    statistics_jobs.finish(task_id)
+    task_events.notify(task_id, 'FAILURE')
+
+
 @celery.task(bind=True)
-def async_statistics(self, start_time, end_time):
+@read_only
+def async_statistics(self, start_time, end_time, cache_key=None):
     """
     Gets a specific set of statistically analyzed data from the database to be used in Statistical Analysis.
 
     Args:
         start_time: Beginning time of window of data being queried
         end_time: End time of window of data being queried
+        cache_key: key the result is cached under, if any
 
     Returns:
-        response: the trimmed blower data, or a status report
+        response: the statistics of each sensor, or a status report
         This async function will output a primitive dict of shape:
             {
                 result:
                 status:
             }
         Where, if successful, 'result' is also a primitive dict containing
-        start_time, end_time, and a list of trimmed json blower data (or an
-        empty dict if blower wasn't on). If not successful, 'result' will be a
+        start_time, end_time, and in 'data' the count, mean, std, min, max
+        and percentiles of each sensor. If not successful, 'result' will be a
         string containing a status message. 'status' will always be an int,
         referring to an HTTP status code.
 
@@ -530,66 +1781,145 @@ def async_statistics(self, start_time, end_time):
    :statuscode 401: Invalid credentials
    :statuscode 403: Not signed in
    """
-    #pr = cProfile.Profile()
-    #pr.enable()
-
-    self.update_state(state='STARTED',
-                        meta={'result': "Gathering data for statistical analysis.",
-                              'status': 202})
-
-    # TODO We should define that you cannot run statistics over a super long
-    # period since this is not an asynchronous request.
-    MAX_API_DATA_S = current_app.config['MAX_API_DATA_PER_REQUEST']
-    # issue with collecting more than a half hour at a time
-    delta_t_chunk_size = MAX_API_DATA_S
-    # Checking and setting up the start and end times
+    try:
+        self.update_state(state='STARTED', meta={
+            'result': "Gathering data for statistical analysis.",
+            'status': 202})
+
+        if not (strict_rfc3339.validate_rfc3339(start_time) and
+                strict_rfc3339.validate_rfc3339(end_time)):
+            print("Error: datetimes are not RFC 3339")
+            # API will return bad_request
+            return {'result': "Bad request; datetimes are not RFC 3339.",
+                    'status': 400}
 
-    if not (strict_rfc3339.validate_rfc3339(start_time) and
-            strict_rfc3339.validate_rfc3339(end_time)):
-        print("Error: datetimes are not RFC 3339")
-        response = {'result': "Bad request; datetimes are not RFC 3339.",
+        start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+        end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+        if end_time_epoch < start_time_epoch:
+            print("Error: end time is before start time")
+            # API will return bad_request
+            return {'result': "Bad request; end time is before start time",
                     'status': 400}
-        # API will return bad_request
+
+        # The window is read in chunks of MAX_API_DATA_PER_REQUEST rows
+        accumulator = statistics.window_statistics(start_time, end_time)
+
+        self.update_state(state='PROGRESS', meta={
+            'result': "Finished gathering data, running stats.",
+            'status': 202})
+
+        response = {'result': {
+                        'start_time': start_time, 'end_time': end_time,
+                        'data': accumulator.result(
+                            current_app.config['STATISTICS_PERCENTILES'])},
+                    'status': 200}
+        # Large results are stored as a file
+        response = result_store.offload(response, self.request.id)
+        if cache_key is not None:
+            statistics_cache.store_result(cache_key, end_time_epoch,
+                                          response)
         return response
+    finally:
+        # Also when the task fails or runs out of time, so that new requests
+        # start a new task and its requesters may start others
+        if cache_key is not None:
+            statistics_cache.release(cache_key)
+        statistics_jobs.finish(self.request.id)
 
+
+@celery.task(bind=True)
+@read_only
+def async_correlation(self, start_time, end_time, sensors, lags,
+                      cache_key=None):
+    """
+    Computes the correlation and covariance matrices of sensors over a
+    window, from the co-moments of each of its UTC days
+
+    Args:
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+        sensors: names of the sensors
+        lags: lags, in seconds
+        cache_key: key the result is cached under, if any
+
+    Returns:
+        response: same shape as async_statistics, 'result' holding the
+        matrices of each lag
+    """
     start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
     end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
-    if (end_time_epoch < start_time_epoch):
-        print("Error: end time is before start time")
-        response = {'result': "Bad request; end time is before start time",
-                    'status': 400}
-        # API will return bad_request
-        return response
 
-    temp_start_time_epoch = start_time_epoch
-    # Add chunk time to temp time values only if request time exceeds 30 min
-    if end_time_epoch - start_time_epoch >= 1800:
-        temp_end_time_epoch = start_time_epoch + delta_t_chunk_size
-    else:
-        temp_end_time_epoch = end_time_epoch
-
-    # Do stuff
-
-    self.update_state(state='PROGRESS',
-                        meta={'result': "Finished gathering data, running stats.",
-                              'status': 202})
-
-    # @TODO update whatever the actual response is
-    response = {'result': {'start_time' : start_time, 'end_time' : end_time,
-                           'data': 'here is data'},
-                'status': '200'}
-
-    #pr.disable()
-    #s = io.StringIO()
-    #ps = pstats.Stats(pr, stream=s).sort_stats('tottime')
-    #ps.print_stats()
-    #print(s.getvalue())
-
-    if response is None:
-        # An error occured in Statistics.py, couldn't process request
-        response = {'result': "Processing Failure; Statistics returned nothing.",
-                    'status': 500}
+    def progress(fraction):
+        self.update_state(state='PROGRESS', meta={
+            'result': {'result': 'Computing correlations.',
+                       'progress': round(100.0 * fraction, 1)},
+            'status': 202})
+
+    try:
+        comoments = correlation.daily_comoments(
+            start_time_epoch, end_time_epoch, sensors, lags, progress)
+        response = {'result': {'start_time': start_time,
+                               'end_time': end_time, 'sensors': sensors,
+                               'lags': comoments.result()},
+                    'status': 200}
+        response = result_store.offload(response, self.request.id)
+        if cache_key is not None:
+            statistics_cache.store_result(cache_key, end_time_epoch,
+                                          response)
         return response
-    else:
-        # successfully returned data
+    finally:
+        # Also when the task fails or runs out of time, see async_statistics
+        if cache_key is not None:
+            statistics_cache.release(cache_key)
+        statistics_jobs.finish(self.request.id)
+
+
+@celery.task(bind=True)
+@read_only
+def async_spectrum(self, start_time, end_time, sensors, segment_s,
+                   cache_key=None):
+    """
+    Computes the Welch power spectral density and dominant frequencies of
+    sensors over a window
+
+    Args:
+        start_time: Beginning time of window of data being queried
+        end_time: End time of window of data being queried
+        sensors: names of the sensors
+        segment_s: length of the Welch segments, in seconds
+        cache_key: key the result is cached under, if any
+
+    Returns:
+        response: same shape as async_statistics, 'result' holding the
+        frequencies and the spectrum of each sensor
+    """
+    start_time_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+    end_time_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+    reported = [0]
+
+    def progress(fraction):
+        # Reported once per percent, not once per chunk
+        percent = int(100 * fraction)
+        if percent > reported[0]:
+            reported[0] = percent
+            self.update_state(state='PROGRESS', meta={
+                'result': {'result': 'Computing spectrum.',
+                           'progress': float(percent)},
+                'status': 202})
+
+    try:
+        result = spectrum.window_spectrum(
+            start_time_epoch, end_time_epoch, sensors, segment_s,
+            progress).result(current_app.config['SPECTRUM_PEAKS'])
+        result.update(start_time=start_time, end_time=end_time)
+        response = result_store.offload({'result': result, 'status': 200},
+                                        self.request.id)
+        if cache_key is not None:
+            statistics_cache.store_result(cache_key, end_time_epoch,
+                                          response)
         return response
+    finally:
+        # Also when the task fails or runs out of time, see async_statistics
+        if cache_key is not None:
+            statistics_cache.release(cache_key)
+        statistics_jobs.finish(self.request.id)
@@ -0,0 +1,286 @@
+"""
+Correlation and covariance matrices between sensors, computed with NumPy.
+
+For each lag L the co-moments of every pair of sensors (i, j) are kept over
+the seconds t where both sensor i at t and sensor j at t - L have a value,
+so sensor j leads sensor i by L seconds. Negative lags are the transposed
+matrices of positive ones.
+
+Co-moments are summed chunk by chunk with matrix products and merged exactly
+(Chan et al.'s parallel co-moment), so the partial co-moments of the UTC days
+of a window are computed once, cached while the day's data version does not
+change, and merged. The value a second lags behind may come from before the
+window, which is what makes the partials of consecutive days add up to the
+co-moments of their union.
+"""
+import json
+import hashlib
+import warnings
+import numpy as np
+import strict_rfc3339
+from flask import current_app
+from redis import RedisError
+from . import cache
+from .gaps import DAY_S
+from .http_cache import window_validators, is_closed_window
+from .statistics import read_chunks
+
+COMOMENTS_KEY = 'comoments:{}:{}:{}'
+
+
+class CoMoments():
+    """
+    Mergeable pairwise co-moments of a set of sensors at a set of lags.
+    Arrays have one (sensor, lagged sensor) matrix per lag.
+
+    Attributes:
+        sensors: names of the sensors, in the order of the matrices
+        lags: lags of the matrices, in seconds
+        count: number of seconds each pair has values at
+        mean: mean of the sensor over those seconds
+        lagged_mean: mean of the lagged sensor over those seconds
+        m2: sum of squared deviations of the sensor
+        lagged_m2: sum of squared deviations of the lagged sensor
+        comoment: sum of the products of the deviations of the pair
+    """
+    NAMES = ('count', 'mean', 'lagged_mean', 'm2', 'lagged_m2', 'comoment')
+
+    def __init__(self, sensors, lags):
+        self.sensors = list(sensors)
+        self.lags = [int(lag) for lag in lags]
+        shape = (len(self.lags), len(self.sensors), len(self.sensors))
+        for name in self.NAMES:
+            setattr(self, name, np.zeros(shape))
+
+    @staticmethod
+    def _pair_moments(values, lagged):
+        """
+        Co-moments of the pairs of columns of two arrays, over the rows
+        where both have a value
+
+        Args:
+            values: 2D float array, NaN where missing
+            lagged: 2D float array of the same shape, NaN where missing
+
+        Returns:
+            tuple of the matrices in the order of NAMES
+        """
+        valid = (~np.isnan(values)).astype(np.float64)
+        lagged_valid = (~np.isnan(lagged)).astype(np.float64)
+        # Shifting by the column means keeps the sums small
+        with warnings.catch_warnings():
+            # Columns without values have no mean
+            warnings.simplefilter('ignore', RuntimeWarning)
+            shift = np.nan_to_num(np.nanmean(values, axis=0))
+            lagged_shift = np.nan_to_num(np.nanmean(lagged, axis=0))
+        centered = np.where(valid > 0, values - shift, 0)
+        lagged_centered = np.where(lagged_valid > 0, lagged - lagged_shift, 0)
+        count = valid.T.dot(lagged_valid)
+        total = centered.T.dot(lagged_valid)
+        lagged_total = valid.T.dot(lagged_centered)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, 0)
+            lagged_mean = np.where(count > 0, lagged_total / count, 0)
+        m2 = (centered * centered).T.dot(lagged_valid) - total * mean
+        lagged_m2 = valid.T.dot(lagged_centered * lagged_centered) - \
+            lagged_total * lagged_mean
+        comoment = centered.T.dot(lagged_centered) - total * lagged_mean
+        return (count, mean + shift[:, np.newaxis],
+                lagged_mean + lagged_shift[np.newaxis, :],
+                m2, lagged_m2, comoment)
+
+    def add_chunk(self, epochs, values, source_epochs, source_values):
+        """
+        Adds the seconds of a chunk of rows
+
+        Args:
+            epochs: increasing times of the rows, in seconds since epoch
+            values: 2D float array of one row per time and one column per
+            sensor, NaN where a sensor has no value
+            source_epochs: increasing times of the rows lagged values are
+            taken from, covering the largest lag before epochs[0]
+            source_values: values of the rows of source_epochs
+        """
+        if not len(epochs):
+            return
+        chunk = CoMoments(self.sensors, self.lags)
+        for index, lag in enumerate(self.lags):
+            wanted = epochs - lag
+            positions = np.minimum(np.searchsorted(source_epochs, wanted),
+                                   len(source_epochs) - 1)
+            found = source_epochs[positions] == wanted
+            lagged = np.where(found[:, np.newaxis],
+                              source_values[positions], np.nan)
+            for name, matrix in zip(self.NAMES,
+                                    self._pair_moments(values, lagged)):
+                getattr(chunk, name)[index] = matrix
+        self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Merges the co-moments of other into these ones
+
+        Args:
+            other: CoMoments of the same sensors and lags
+        """
+        count = self.count + other.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(count > 0, other.count / count, 0)
+            delta = other.mean - self.mean
+            lagged_delta = other.lagged_mean - self.lagged_mean
+            # n1 * n2 / n
+            product = self.count * weight
+        self.mean = self.mean + delta * weight
+        self.lagged_mean = self.lagged_mean + lagged_delta * weight
+        self.m2 = self.m2 + other.m2 + delta * delta * product
+        self.lagged_m2 = self.lagged_m2 + other.lagged_m2 + \
+            lagged_delta * lagged_delta * product
+        self.comoment = self.comoment + other.comoment + \
+            delta * lagged_delta * product
+        self.count = count
+
+    def to_dict(self):
+        """
+        Returns:
+            dict of lists, to cache or send co-moments between processes
+        """
+        state = {'sensors': self.sensors, 'lags': self.lags}
+        for name in self.NAMES:
+            state[name] = getattr(self, name).tolist()
+        return state
+
+    @staticmethod
+    def from_dict(state):
+        """
+        Args:
+            state: dict returned by to_dict()
+
+        Returns:
+            the CoMoments
+        """
+        comoments = CoMoments(state['sensors'], state['lags'])
+        for name in CoMoments.NAMES:
+            setattr(comoments, name, np.array(state[name], dtype=np.float64))
+        return comoments
+
+    def result(self):
+        """
+        Returns:
+            dict of str(lag) to its count, covariance and correlation
+            matrices, as lists of rows, None where undefined
+        """
+        def matrix(values):
+            return [[None if np.isnan(value) else float(value)
+                     for value in row] for row in values]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = np.where(self.count > 1,
+                                  self.comoment / (self.count - 1), np.nan)
+            correlation = np.where(
+                (self.m2 > 0) & (self.lagged_m2 > 0),
+                self.comoment / np.sqrt(self.m2 * self.lagged_m2), np.nan)
+            # Rounding errors may put perfect correlations slightly above 1
+            correlation = np.clip(correlation, -1, 1)
+        return {str(lag): {'count': self.count[index].astype(int).tolist(),
+                           'covariance': matrix(covariance[index]),
+                           'correlation': matrix(correlation[index])}
+                for index, lag in enumerate(self.lags)}
+
+
+def window_comoments(start_epoch, end_epoch, sensors, lags):
+    """
+    Computes the co-moments of the seconds of a window in one pass over
+    its rows
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+        sensors: names of the sensors
+        lags: lags, in seconds
+
+    Returns:
+        CoMoments of the window
+    """
+    comoments = CoMoments(sensors, lags)
+    max_lag = max(comoments.lags)
+    carried = np.empty((0, len(sensors) + 1))
+    for chunk in read_chunks(strict_rfc3339.timestamp_to_rfc3339_utcoffset(
+                                 int(start_epoch) - max_lag),
+                             strict_rfc3339.timestamp_to_rfc3339_utcoffset(
+                                 int(end_epoch)), sensors,
+                             current_app.config['MAX_API_DATA_PER_REQUEST'],
+                             epochs=True):
+        source = np.concatenate((carried, chunk))
+        current = chunk[chunk[:, 0] >= start_epoch]
+        comoments.add_chunk(current[:, 0], current[:, 1:],
+                            source[:, 0], source[:, 1:])
+        # Rows the next chunk's lags may reach back to
+        carried = source[source[:, 0] > source[-1, 0] - max_lag]
+    return comoments
+
+
+def _day_comoments(start_epoch, end_epoch, sensors, lags):
+    """
+    Co-moments of a window that does not span more than one UTC day, cached
+    for whole closed days
+
+    Returns:
+        CoMoments of the window
+    """
+    whole_day = (start_epoch % DAY_S == 0 and
+                 end_epoch == start_epoch + DAY_S - 1)
+    key = None
+    if whole_day and is_closed_window(end_epoch):
+        # Lags reach into the previous day, whose late samples count too
+        etag, _ = window_validators(start_epoch - max(lags), end_epoch)
+        if etag is not None:
+            key = COMOMENTS_KEY.format(start_epoch, etag, hashlib.sha1(
+                json.dumps([sensors, lags]).encode()).hexdigest())
+            try:
+                state = cache.get(key)
+            except RedisError as e:
+                print(e)
+                print('correlation: Redis port may be closed, skipping '
+                      'cache.')
+                state = key = None
+            if state is not None:
+                return CoMoments.from_dict(state)
+
+    comoments = window_comoments(start_epoch, end_epoch, sensors, lags)
+    if key is not None:
+        try:
+            cache.set(key, comoments.to_dict(), timeout=current_app.config[
+                'CORRELATION_CACHE_TIMEOUT'])
+        except RedisError as e:
+            print(e)
+            print('correlation: Redis port may be closed, could not cache '
+                  'co-moments.')
+    return comoments
+
+
+def daily_comoments(start_epoch, end_epoch, sensors, lags, progress=None):
+    """
+    Computes the co-moments of a window by merging those of its UTC days
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+        sensors: names of the sensors
+        lags: lags, in seconds
+        progress: function called with the fraction of the window done
+
+    Returns:
+        CoMoments of the window
+    """
+    start_epoch = int(start_epoch)
+    end_epoch = int(end_epoch)
+    comoments = CoMoments(sensors, lags)
+    day_start = start_epoch
+    while day_start <= end_epoch:
+        day_end = min(day_start - day_start % DAY_S + DAY_S - 1, end_epoch)
+        comoments.merge(_day_comoments(day_start, day_end, sensors, lags))
+        if progress is not None:
+            progress((day_end - start_epoch + 1.0) /
+                     (end_epoch - start_epoch + 1))
+        day_start = day_end + 1
+    return comoments
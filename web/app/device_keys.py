@@ -0,0 +1,148 @@
+"""
+Request signing with per-device API keys, for machines posting samples.
+
+A device key is a key id and a secret. The secret is derived from the key id
+with the app's SECRET_KEY, so the database only stores which user a key id
+belongs to, and a leak of the database leaks no secret. Each request carries
+the key id, a timestamp and an HMAC-SHA256 of
+
+    timestamp, method, path, query string and SHA-256 of the body
+
+one per line, keyed by the secret. Checking it costs two hashes and a
+lookup of the key id in a per-worker cache, instead of a password hash, and
+the signature also protects the body from being altered. Requests whose
+timestamp is more than DEVICE_SIGNATURE_MAX_SKEW_S away from the server's
+clock are refused, and the signatures of the others are remembered in Redis
+until then, so a captured request cannot be replayed. A retry must be signed
+again, with a later timestamp if the first attempt was sent the same second.
+
+Since the secrets are derived from SECRET_KEY, changing SECRET_KEY changes
+every device's secret: the new secrets are printed with
+`manage.py device secret -k <key id>` and must be given to the devices.
+"""
+import hmac
+import time
+import hashlib
+from flask import current_app
+from redis import RedisError
+from . import db, device_key_cache, invalidation_bus, redis_store
+from .models import DeviceKey, User
+
+KEY_ID_HEADER = 'X-Device-Key'
+TIMESTAMP_HEADER = 'X-Timestamp'
+SIGNATURE_HEADER = 'X-Signature'
+SEEN_SIGNATURE_KEY = 'device_signature:{}:{}'
+
+
+def signing_secret(key_id):
+    """
+    Args:
+        key_id: id of a device key
+
+    Returns:
+        hex secret of the key, derived from the key id and SECRET_KEY
+    """
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'),
+                    'device_key:{}'.format(key_id).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def string_to_sign(timestamp, method, path, query_string, body):
+    """
+    Args:
+        timestamp: seconds since epoch, as sent in X-Timestamp
+        method: HTTP method of the request
+        path: path of the request
+        query_string: raw query string of the request, '' if none
+        body: bytes of the body of the request
+
+    Returns:
+        bytes signed by the device
+    """
+    return '\n'.join((str(timestamp), method.upper(), path, query_string,
+                      hashlib.sha256(body).hexdigest())).encode('utf-8')
+
+
+def sign(secret, timestamp, method, path, query_string, body):
+    """
+    Signs a request, as devices must
+
+    Args:
+        secret: hex secret of the device key
+        timestamp: seconds since epoch, as sent in X-Timestamp
+        method: HTTP method of the request
+        path: path of the request
+        query_string: raw query string of the request, '' if none
+        body: bytes of the body of the request
+
+    Returns:
+        hex signature, sent in X-Signature
+    """
+    return hmac.new(secret.encode('utf-8'),
+                    string_to_sign(timestamp, method, path, query_string,
+                                   body),
+                    hashlib.sha256).hexdigest()
+
+
+def lookup(key_id):
+    """
+    Finds the user of a device key, cached for DEVICE_KEY_CACHE_TTL_S
+
+    Args:
+        key_id: id of a device key
+
+    Returns:
+        (user id, confirmed) of the key's user, None if there is no such key
+    """
+    invalidation_bus.ensure_started()
+    found, owner = device_key_cache.get(key_id)
+    if found:
+        return owner
+    row = db.session.query(User.id, User.confirmed).join(
+        DeviceKey, DeviceKey.user_id == User.id).filter(
+            DeviceKey.id == key_id).first()
+    owner = None if row is None else (row.id, row.confirmed)
+    device_key_cache.set(key_id, owner,
+                         tag=None if owner is None else owner[0])
+    return owner
+
+
+def verify(request):
+    """
+    Checks the signature of a request
+
+    Args:
+        request: the Flask request, with the headers of a device key
+
+    Returns:
+        (user id, confirmed) of the key's user, None if the key is unknown,
+        the timestamp too far off, the signature wrong or already used
+    """
+    key_id = request.headers.get(KEY_ID_HEADER, '')
+    try:
+        timestamp = int(request.headers.get(TIMESTAMP_HEADER, ''))
+    except ValueError:
+        return None
+    max_skew = current_app.config['DEVICE_SIGNATURE_MAX_SKEW_S']
+    if abs(time.time() - timestamp) > max_skew:
+        return None
+    expected = sign(signing_secret(key_id), timestamp, request.method,
+                    request.path, request.query_string.decode('utf-8'),
+                    request.get_data(cache=True))
+    if not hmac.compare_digest(
+            expected.encode('utf-8'),
+            request.headers.get(SIGNATURE_HEADER, '').encode('utf-8')):
+        return None
+    try:
+        # Kept until the timestamp is too far off to be accepted again
+        first_use = redis_store.set(
+            SEEN_SIGNATURE_KEY.format(key_id, expected), 1, nx=True,
+            ex=max(1, int(timestamp + max_skew - time.time()) + 1))
+    except RedisError as e:
+        print(e)
+        print('device_keys: Redis port may be closed, replays of this '
+              'request not refused.')
+        first_use = True
+    if not first_use:
+        return None
+    return lookup(key_id)
@@ -4,3 +4,8 @@
 class ValidationError(ValueError):
     """Raises an error if values are input inncorrectly"""
     pass
+
+
+class CursorExpired(LookupError):
+    """Raises an error if a cursor no longer points into the ingest log"""
+    pass
@@ -0,0 +1,86 @@
+"""
+Detection of the missing seconds of a window of machine data.
+
+Windows are split into UTC days. The gaps of a day that is fully inside the
+window and closed are cached, keyed by the day's data version, so that a
+late sample in that day is picked up by the next request.
+"""
+import strict_rfc3339
+from flask import current_app
+from redis import RedisError
+from . import cache
+from .http_cache import window_validators, is_closed_window
+from .models import Machine
+
+DAY_S = 3600 * 24
+GAPS_KEY = 'gaps:{}:{}'
+
+
+def _day_gaps(start_epoch, end_epoch):
+    """
+    Gaps of a window that does not span more than one UTC day
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        list of (first missing epoch, last missing epoch) tuples
+    """
+    whole_day = (start_epoch % DAY_S == 0 and
+                 end_epoch == start_epoch + DAY_S - 1)
+    key = None
+    if whole_day and is_closed_window(end_epoch):
+        etag, _ = window_validators(start_epoch, end_epoch)
+        if etag is not None:
+            key = GAPS_KEY.format(start_epoch, etag)
+            try:
+                gaps = cache.get(key)
+            except RedisError as e:
+                print(e)
+                print('gaps: Redis port may be closed, skipping cache.')
+                gaps = key = None
+            if gaps is not None:
+                return [tuple(gap) for gap in gaps]
+
+    gaps = Machine.missing_intervals(
+        strict_rfc3339.timestamp_to_rfc3339_utcoffset(start_epoch),
+        strict_rfc3339.timestamp_to_rfc3339_utcoffset(end_epoch))
+    if key is not None:
+        try:
+            cache.set(key, gaps,
+                      timeout=current_app.config['GAP_CACHE_TIMEOUT'])
+        except RedisError as e:
+            print(e)
+            print('gaps: Redis port may be closed, could not cache gaps.')
+    return gaps
+
+
+def find_gaps(start_epoch, end_epoch, min_gap=1):
+    """
+    Finds the runs of missing seconds of a window
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+        min_gap: shortest run of missing seconds returned, in seconds
+
+    Returns:
+        list of (first missing epoch, last missing epoch) tuples, in
+        chronological order
+    """
+    start_epoch = int(start_epoch)
+    end_epoch = int(end_epoch)
+    merged = []
+    day_start = start_epoch
+    while day_start <= end_epoch:
+        day_end = min(day_start - day_start % DAY_S + DAY_S - 1, end_epoch)
+        for first, last in _day_gaps(day_start, day_end):
+            # Gaps running over midnight are found once in each day
+            if merged and merged[-1][1] + 1 == first:
+                merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        day_start = day_end + 1
+    return [(first, last) for first, last in merged
+            if last - first + 1 >= min_gap]
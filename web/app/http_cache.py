@@ -0,0 +1,121 @@
+"""
+HTTP caching helpers for windows of machine data.
+
+Every bucket of WINDOW_VERSION_BUCKET_S seconds has a version stored in Redis,
+which is the time of the last write that landed in that bucket. The ETag of a
+window is derived from its boundaries and the versions of the buckets it
+overlaps, so a late sample changes the ETag of every window that contains it.
+"""
+import time
+import hashlib
+from datetime import datetime
+from flask import current_app
+from redis import RedisError
+from . import redis_store
+
+VERSION_KEY = 'window_version:{}'
+
+
+def _version_keys(start_epoch, end_epoch):
+    """
+    Keys of the version buckets overlapped by a window
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        list of Redis keys, in chronological order
+    """
+    bucket_size = current_app.config['WINDOW_VERSION_BUCKET_S']
+    first = int(start_epoch) // bucket_size
+    last = int(end_epoch) // bucket_size
+    return [VERSION_KEY.format(bucket * bucket_size)
+            for bucket in range(first, last + 1)]
+
+
+def bump_window_version(epoch):
+    """
+    Marks the bucket containing epoch as modified. Must be called whenever a
+    sample is written so that cached windows holding it are revalidated.
+
+    Args:
+        epoch: timestamp of the sample that was written
+    """
+    key = _version_keys(epoch, epoch)[0]
+    try:
+        redis_store.set(key, repr(time.time()))
+    except RedisError as e:
+        print(e)
+        print('http_cache: Redis port may be closed, could not bump '
+              'window version.')
+
+
+def window_validators(start_epoch, end_epoch):
+    """
+    Computes the ETag and Last-Modified date of a window of data
+
+    Buckets that have never been written to since Redis started are given
+    a fresh version, so an ETag issued before a Redis restart never matches.
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        (etag, last_modified) tuple, or (None, None) if Redis is unavailable
+    """
+    keys = _version_keys(start_epoch, end_epoch)
+    try:
+        versions = redis_store.mget(keys)
+        for index, version in enumerate(versions):
+            if version is None:
+                redis_store.set(keys[index], repr(time.time()), nx=True)
+                versions[index] = redis_store.get(keys[index])
+    except RedisError as e:
+        print(e)
+        print('http_cache: Redis port may be closed, skipping validators.')
+        return None, None
+
+    digest = hashlib.sha1('{}:{}'.format(start_epoch, end_epoch).encode())
+    for version in versions:
+        digest.update(b':' + version)
+    last_modified = datetime.utcfromtimestamp(
+        max(float(version) for version in versions))
+    return digest.hexdigest(), last_modified
+
+
+def is_closed_window(end_epoch):
+    """
+    A window is closed once its end is older than WINDOW_CLOSE_DELAY_S, after
+    which only late-arriving data can change it.
+
+    Args:
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        True if the window no longer receives live data
+    """
+    return end_epoch < time.time() - current_app.config['WINDOW_CLOSE_DELAY_S']
+
+
+def set_window_cache_headers(response, etag, last_modified):
+    """
+    Adds ETag, Last-Modified and Cache-Control headers to a window response.
+    Windows are always revalidated, closed ones included since late samples
+    may still land in them, which costs a 304 while the ETag is unchanged.
+    Responses stay private since they require authentication.
+
+    Args:
+        response: the response being sent
+        etag: the window's ETag
+        last_modified: datetime of the window's last modification
+
+    Returns:
+        response, with the caching headers set
+    """
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,36 @@
+"""
+Side effects of a sample being ingested, shared by the API and the manual
+JSON form. They run once the sample is committed to the database.
+"""
+import time
+from flask import current_app
+from redis import RedisError
+from . import invalidation_bus, sample_cache, timeseries
+from .http_cache import bump_window_version
+from .replicas import note_write
+from .rollups import record_sample
+
+
+def sample_ingested(epoch, sample):
+    """
+    Propagates a newly committed sample to the caches
+
+    Args:
+        epoch: timestamp of the sample, in seconds since epoch
+        sample: sample as returned by Machine.to_json()
+    """
+    bump_window_version(epoch)
+    note_write()
+    record_sample(epoch, sample)
+    try:
+        timeseries.set_latest(epoch, sample)
+        timeseries.append_log(sample)
+        # Published last, so subscribers woken up find the sample logged
+        timeseries.publish(sample)
+    except RedisError as e:
+        print(e)
+        print('ingest: Redis port may be closed, could not update the '
+              'latest sample.')
+    # Workers may remember that this second had no data
+    if epoch < time.time() - current_app.config['LATE_SAMPLE_DELAY_S']:
+        invalidation_bus.publish(sample_cache.name, key=int(epoch))
@@ -0,0 +1,233 @@
+"""
+In-process caches that sit in front of Redis, private to each worker process.
+
+Entries expire after a TTL and the least recently used entries are evicted
+once the cache is full. Workers keep each other coherent by broadcasting
+invalidations over Redis pub/sub through an InvalidationBus.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from redis import RedisError
+
+
+class LocalCache():
+    """
+    Bounded, thread safe LRU cache with a TTL on every entry
+
+    Attributes:
+        name: name the cache is registered under on the invalidation bus
+        maxsize: maximum number of entries kept
+        ttl: seconds an entry is served for after being set
+        hits: number of lookups answered by the cache
+        misses: number of lookups that were not
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, now):
+        """Returns (found, value), must be called with the lock held"""
+        try:
+            expires, value, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        if expires < now:
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def get(self, key):
+        """
+        Args:
+            key: key of the entry
+
+        Returns:
+            (found, value) tuple, value is None when found is False
+        """
+        with self._lock:
+            return self._lookup(key, time.time())
+
+    def get_many(self, keys):
+        """
+        Args:
+            keys: iterable of keys
+
+        Returns:
+            dict of the keys that were found and their values
+        """
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                hit, value = self._lookup(key, now)
+                if hit:
+                    found[key] = value
+        return found
+
+    def set(self, key, value, tag=None):
+        """
+        Args:
+            key: key of the entry
+            value: value to cache, may be None
+            tag: optional tag, to invalidate groups of entries at once
+        """
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value, tag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Args:
+            key: key of the entry to drop, missing keys are ignored
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_tag(self, tag):
+        """
+        Args:
+            tag: every entry set with this tag is dropped
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if entry[2] == tag]:
+                del self._entries[key]
+
+    def clear(self):
+        """Drops every entry, counters are kept"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns:
+            dict with the size, hit and miss counters of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'name': self.name,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else None}
+
+
+class InvalidationBus():
+    """
+    Broadcasts invalidations of LocalCache entries to every worker process
+    through a Redis pub/sub channel. The subscriber thread is started lazily
+    from the process that uses the caches, so it survives gunicorn forking.
+
+    Attributes:
+        redis: Redis client
+        channel: pub/sub channel the invalidations are sent on
+        caches: dict of the registered caches, by name
+    """
+
+    def __init__(self, redis, channel='local_cache_invalidation'):
+        self.redis = redis
+        self.channel = channel
+        self.caches = {}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, local_cache):
+        """
+        Args:
+            local_cache: LocalCache to keep coherent across workers
+
+        Returns:
+            local_cache
+        """
+        self.caches[local_cache.name] = local_cache
+        return local_cache
+
+    def clear_local(self):
+        """Clears the registered caches of this process only"""
+        for local_cache in self.caches.values():
+            local_cache.clear()
+
+    def _handle(self, message):
+        """Applies an invalidation received from the channel"""
+        try:
+            invalidation = json.loads(message['data'].decode('utf-8'))
+            local_cache = self.caches[invalidation['cache']]
+        except (ValueError, KeyError) as e:
+            print('InvalidationBus: ignoring message', e)
+            return
+        self._apply(local_cache, invalidation)
+
+    @staticmethod
+    def _apply(local_cache, invalidation):
+        """Drops the key, the tag or everything from local_cache"""
+        if 'key' in invalidation:
+            local_cache.delete(invalidation['key'])
+        elif 'tag' in invalidation:
+            local_cache.delete_tag(invalidation['tag'])
+        else:
+            local_cache.clear()
+
+    def ensure_started(self):
+        """
+        Starts the subscriber thread of this process if it is not running.
+        The caches are cleared whenever the thread (re)starts, since
+        invalidations may have been missed while it was down.
+        """
+        if (self._thread is not None and self._thread.is_alive() and
+                self._pid == os.getpid()):
+            return
+        with self._lock:
+            if (self._thread is not None and self._thread.is_alive() and
+                    self._pid == os.getpid()):
+                return
+            self.clear_local()
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._handle})
+                self._thread = pubsub.run_in_thread(sleep_time=1)
+                self._pid = os.getpid()
+            except RedisError as e:
+                print(e)
+                print('InvalidationBus: Redis port may be closed, local '
+                      'caches will rely on their TTL.')
+
+    def publish(self, cache_name, key=None, tag=None):
+        """
+        Invalidates an entry, a tag or a whole cache in every worker,
+        including this one
+
+        Args:
+            cache_name: name of the LocalCache
+            key: key to invalidate
+            tag: tag to invalidate, if no key is given
+        """
+        invalidation = {'cache': cache_name}
+        if key is not None:
+            invalidation['key'] = key
+        elif tag is not None:
+            invalidation['tag'] = tag
+        self._apply(self.caches[cache_name], invalidation)
+        try:
+            self.redis.publish(self.channel, json.dumps(invalidation))
+        except RedisError as e:
+            print(e)
+            print('InvalidationBus: Redis port may be closed, could not '
+                  'broadcast invalidation.')
@@ -4,14 +4,19 @@
 # pylint: disable=superfluous-parens
 # pylint: disable=no-member
 import json
+import time
 import sqlalchemy
+import strict_rfc3339
 from sqlalchemy import desc
-from flask import request, render_template, current_app
+from flask import request, render_template, current_app, Response, \
+    stream_with_context
 from flask_login import login_required
 from redis import RedisError
 from .forms import JSONForm, SearchEnableForm
 from . import main
-from .. import db, cache, watchdog
+from .. import db, watchdog, timeseries, wait_slots
+from ..ingest import sample_ingested
+from ..replicas import read_only
 from ..accepted_json_message import ACCEPTED_JSON
 from ..models import Machine
 
@@ -29,6 +34,7 @@ def index():
 
 @main.route("/viewdata", methods=['GET', 'POST'])
 @login_required
+@read_only
 def show_machine_data():
     """
     Outputs all machine post table data to an HTML table
@@ -40,9 +46,9 @@ def show_machine_data():
     alive = watchdog.is_alive()
     auto_refresh = False
     try:
-        state = db.session.query(Machine).order_by(
-            desc(Machine.datetime)).first().state
-    except AttributeError as e:
+        # The latest sample is kept in Redis, no need to query the database
+        state = (timeseries.latest() or {}).get('state')
+    except RedisError as e:
         print(e)
         state = None
 
@@ -68,6 +74,71 @@ def show_machine_data():
                            auto_refresh=auto_refresh)
 
 
+@main.route("/viewdata/stream")
+@login_required
+def stream_machine_data():
+    """
+    Server-Sent Events stream of the samples as they are ingested, used by
+    viewdata.html to update its table without reloading the page. A status
+    event with the watchdog and machine state is sent every SSE_KEEPALIVE_S.
+
+    Returns:
+        Response, streaming text/event-stream until the client disconnects,
+        503 once MAX_WAITING_REQUESTS streams and long-polls are open
+    """
+    keepalive = current_app.config['SSE_KEEPALIVE_S']
+    if not wait_slots.acquire():
+        return Response('Too many open streams, retry later.', status=503,
+                        mimetype='text/plain', headers={
+                            'Retry-After': str(
+                                current_app.config['WAITING_RETRY_AFTER_S'])})
+
+    def status_event():
+        try:
+            state = (timeseries.latest() or {}).get('state')
+        except RedisError:
+            state = None
+        return 'event: status\ndata: {}\n\n'.format(json.dumps(
+            {'alive': watchdog.is_alive(), 'state': state}))
+
+    def events():
+        try:
+            pubsub = timeseries.subscribe()
+        except RedisError as e:
+            print(e)
+            # Let the browser retry, the page still works without the stream
+            yield 'retry: 30000\n\n'
+            return
+        try:
+            yield 'retry: 5000\n\n'
+            yield status_event()
+            next_status = time.time() + keepalive
+            while True:
+                message = pubsub.get_message(timeout=keepalive)
+                if message is not None and message['type'] == 'message':
+                    yield 'data: {}\n\n'.format(
+                        message['data'].decode('utf-8'))
+                if time.time() >= next_status:
+                    yield status_event()
+                    next_status = time.time() + keepalive
+        except RedisError as e:
+            print(e)
+        finally:
+            pubsub.close()
+
+    # The stream keeps the request context, not the connection checked out
+    # when the user was loaded
+    db.session.remove()
+    response = Response(stream_with_context(events()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 # Tells nginx not to buffer the stream
+                                 'X-Accel-Buffering': 'no'})
+    # Also called when the client leaves before the stream starts
+    response.call_on_close(wait_slots.release)
+    return response
+
+
 @main.route("/manualjsonpostdata", methods=['GET', 'POST'])
 @login_required
 def manual_json_post():
@@ -138,17 +209,18 @@ def manual_json_post():
                                    error=dict_error)
 
         """
-        Set datetime key in cache if it doesn't already exist.
+        Add the sample to the cache if that second isn't already cached.
         Try to commit it to the database if it wasn't in cache already.
         """
+        epoch = strict_rfc3339.rfc3339_to_timestamp(json_post['datetime'])
         try:
-            if cache.get(json_post['datetime']) is None:
-                cache.set(json_post['datetime'], to_json_data,
-                          timeout=current_app.config['REDIS_CACHE_TIMEOUT'])
+            if timeseries.add(epoch, to_json_data):
                 try:
                     db.session.add(data)
                     db.session.commit()
                 except sqlalchemy.exc.IntegrityError:
+                    db.session.rollback()
+                    timeseries.remove(to_json_data)
                     is_dict = False
                     dict_error = (
                         "There was a unique constraint error,"
@@ -157,6 +229,7 @@ def manual_json_post():
                                            form=form,
                                            is_dict=is_dict,
                                            error=dict_error)
+                sample_ingested(epoch, to_json_data)
             else:
                 is_dict = False
                 dict_error = ("The datetime already appears in the cache."
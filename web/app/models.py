@@ -3,13 +3,19 @@ Template for the database. After a change, a database upgrade must be done
 """
 
 # pylint: disable=invalid-name
+import time
+import uuid
+import datetime
 import collections
 import strict_rfc3339
 from flask import current_app
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session, make_transient_to_detached
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
-from . import db, login_manager
+from . import db, login_manager, invalidation_bus, credential_cache, \
+    user_cache, device_key_cache
 
 
 # pylint: disable=no-member
@@ -24,6 +30,8 @@ class User(UserMixin, db.Model):
         username: Takes the user's username
         email: Takes the user's email
         password_hash: storing the hashed & salted password
+        tokens_revoked_before: API tokens issued before this epoch are
+        revoked
     """
 
     __tablename__ = 'user'
@@ -32,6 +40,7 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(128), unique=True, index=True)
     password_hash = db.Column(db.String(128))
     confirmed = db.Column(db.Boolean, default=False)
+    tokens_revoked_before = db.Column(db.Float)
 
     @property
     def password(self):
@@ -74,38 +83,63 @@ class User(UserMixin, db.Model):
         """
         return check_password_hash(self.password_hash, password)
 
-    def generate_auth_token(self, expiration):
+    def generate_auth_token(self, expiration, scopes=None):
         """
-        Generates the auth token if username and password are given
+        Generates the auth token if username and password are given. The
+        token carries the claims the API authorizes with, so that it can be
+        verified without a database query.
 
         Args:
             self: is a class argument
             expiration: how long the token will work for
+            scopes: API scopes the token grants, all of API_TOKEN_SCOPES
+            by default
 
         Returns:
             s.dumps which generates the auth_token
         """
+        if scopes is None:
+            scopes = current_app.config['API_TOKEN_SCOPES']
+        now = time.time()
         s = Serializer(current_app.config['SECRET_KEY'],
                        expires_in=expiration)
-        return s.dumps({'id': self.id}).decode('ascii')
+        return s.dumps({'id': self.id,
+                        'confirmed': bool(self.confirmed),
+                        'scopes': list(scopes),
+                        'jti': uuid.uuid4().hex,
+                        'issued': now,
+                        'expires': now + expiration}).decode('ascii')
 
     @staticmethod
     def verify_auth_token(token):
         """
-        Verifies the auth token
+        Verifies the auth token from its signature, and its user and
+        revocations from the per-worker user cache
 
         Args:
             token: user's authentication token
 
         Returns:
-            User.query.get(data['id']), gets user id after token is verified
+            ApiPrincipal of the token's claims, None if the token is
+            invalid, expired or revoked, or its user deleted
         """
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
             data = s.loads(token)
         except BaseException:
             return None
-        return User.query.get(data['id'])
+        if 'jti' not in data:
+            # Issued before tokens carried claims
+            return None
+        user = load_user(data['id'])
+        if user is None:
+            return None
+        if user.tokens_revoked_before is not None and \
+                data['issued'] < user.tokens_revoked_before:
+            return None
+        if data['jti'] in revoked_tokens(user.id):
+            return None
+        return ApiPrincipal(user.id, user.confirmed, data['scopes'], data)
 
     def generate_confirmation_token(self, expiration=3600):
         """
@@ -182,15 +216,48 @@ class User(UserMixin, db.Model):
 @login_manager.user_loader
 def load_user(user_id):
     """
-    Loads user for queries
+    Loads user for queries. Rows are kept in a per-worker cache, dropped
+    when the user changes, and attached to the session without a query.
 
     Args:
         user_id: user's token verified id
 
     Results:
-        User.query.get(int(user_id)) which loads the user
+        the User, None if there is no such user
+    """
+    user_id = int(user_id)
+    invalidation_bus.ensure_started()
+    found, columns = user_cache.get(user_id)
+    if not found:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        user_cache.set(user_id, {column.key: getattr(user, column.key)
+                                 for column in User.__table__.columns},
+                       tag=user_id)
+        return user
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def revoked_tokens(user_id):
+    """
+    Args:
+        user_id: id of a user
+
+    Returns:
+        set of the jti of the user's revoked tokens, cached with the user's
+        row
     """
-    return User.query.get(int(user_id))
+    key = 'revoked_tokens:{}'.format(user_id)
+    found, jtis = user_cache.get(key)
+    if not found:
+        jtis = {jti for jti, in db.session.query(RevokedToken.jti).filter(
+            RevokedToken.user_id == user_id,
+            RevokedToken.expires >= time.time())}
+        user_cache.set(key, jtis, tag=user_id)
+    return jtis
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -213,6 +280,163 @@ class AnonymousUser(AnonymousUserMixin):
 login_manager.anonymous_user = AnonymousUser
 
 
+class ApiPrincipal():
+    """
+    User authenticated from cached credentials or from a token, without a
+    database query. Has what the API reads of g.current_user.
+
+    Attributes:
+        id: User id
+        confirmed: whether the user confirmed their account
+        scopes: API scopes granted, all of API_TOKEN_SCOPES if None
+        claims: claims of the token authenticated with, None with a password
+    """
+    is_anonymous = False
+
+    def __init__(self, id, confirmed, scopes=None, claims=None):
+        # pylint: disable=redefined-builtin
+        self.id = id
+        self.confirmed = confirmed
+        self.scopes = scopes
+        self.claims = claims
+
+    def generate_auth_token(self, expiration, scopes=None):
+        """Same as User.generate_auth_token"""
+        return User.generate_auth_token(self, expiration, scopes)
+
+
+class DeviceKey(db.Model):
+    """
+    API key of a device posting samples on behalf of a user. Its secret is
+    derived from the id, see device_keys.signing_secret, and is not stored.
+
+    Attributes:
+        __tablename__: table title
+        id: key id, sent by the device with each request
+        user_id: User the device posts as
+        name: what the device is, for its owner
+        created: when the key was created
+    """
+    __tablename__ = 'device_key'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('user.id', ondelete='CASCADE'),
+                        nullable=False, index=True)
+    name = db.Column(db.String(128))
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def generate(user, name):
+        """
+        Creates a key for a user, to be committed
+
+        Args:
+            user: User the device posts as
+            name: what the device is
+
+        Returns:
+            the new DeviceKey
+        """
+        key = DeviceKey(id=uuid.uuid4().hex, user_id=user.id, name=name)
+        db.session.add(key)
+        return key
+
+
+class RevokedToken(db.Model):
+    """
+    API token revoked before it expires, see app.tokens
+
+    Attributes:
+        __tablename__: table title
+        jti: jti claim of the token
+        user_id: User the token was issued to
+        expires: epoch the token expires at, when the row can be deleted
+    """
+    __tablename__ = 'revoked_token'
+    jti = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('user.id', ondelete='CASCADE'),
+                        nullable=False, index=True)
+    expires = db.Column(db.Float, nullable=False)
+
+
+# Columns of User that make cached credentials stale when they change
+CREDENTIAL_COLUMNS = ('email', 'password_hash', 'confirmed')
+
+
+def _remember(session, name, user_id):
+    """Adds a user id to a set kept in the session until the commit"""
+    session.info.setdefault(name, set()).add(user_id)
+
+
+@event.listens_for(User, 'before_update')
+def _revoke_stale_tokens(mapper, connection, target):
+    """Revokes the API tokens issued with credentials that change"""
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes()
+           for name in CREDENTIAL_COLUMNS):
+        target.tokens_revoked_before = time.time()
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    """Remembers the users changed in this transaction"""
+    session = object_session(target)
+    _remember(session, 'changed_users', target.id)
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes()
+           for name in CREDENTIAL_COLUMNS):
+        _remember(session, 'stale_credentials', target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    """Remembers the users deleted in this transaction"""
+    session = object_session(target)
+    _remember(session, 'changed_users', target.id)
+    _remember(session, 'stale_credentials', target.id)
+
+
+@event.listens_for(RevokedToken, 'after_insert')
+@event.listens_for(RevokedToken, 'after_delete')
+def _token_revoked(mapper, connection, target):
+    """Remembers the users whose revoked tokens changed"""
+    _remember(object_session(target), 'changed_users', target.user_id)
+
+
+@event.listens_for(DeviceKey, 'after_insert')
+@event.listens_for(DeviceKey, 'after_update')
+@event.listens_for(DeviceKey, 'after_delete')
+def _device_key_changed(mapper, connection, target):
+    """Remembers the device keys changed in this transaction"""
+    _remember(object_session(target), 'changed_device_keys', target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_users(session):
+    """
+    Drops the cached rows and credentials of the users changed by a
+    transaction, in every worker, once the change is visible to their next
+    query
+    """
+    for user_id in session.info.pop('changed_users', ()):
+        invalidation_bus.publish(user_cache.name, tag=user_id)
+    stale = session.info.pop('stale_credentials', set())
+    for user_id in stale:
+        invalidation_bus.publish(credential_cache.name, tag=user_id)
+        invalidation_bus.publish(device_key_cache.name, tag=user_id)
+    for key_id in session.info.pop('changed_device_keys', ()):
+        invalidation_bus.publish(device_key_cache.name, key=key_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_users(session):
+    """Nothing changed in a rolled back transaction"""
+    session.info.pop('changed_users', None)
+    session.info.pop('stale_credentials', None)
+    session.info.pop('changed_device_keys', None)
+
+
 class Machine(db.Model):
     """Template for the Machine Info table"""
     __tablename__ = 'machine'
@@ -303,6 +527,100 @@ class Machine(db.Model):
                 invalid_sensors.append(key)
         return missing_data, invalid_sensors
 
+    @staticmethod
+    def query_window(start_time, end_time):
+        """
+        Selects the rows of a window of time. Datetimes are stored as RFC3339
+        strings, which sort chronologically when in the same format.
+
+        Args:
+            start_time: Beginning of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+            end_time: End of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+
+        Returns:
+            query of the rows in the window, in chronological order
+        """
+        return Machine.query.filter(
+            Machine.datetime >= start_time,
+            Machine.datetime <= end_time).order_by(Machine.datetime)
+
+    @staticmethod
+    def missing_intervals(start_time, end_time):
+        """
+        Finds the seconds of a window without a sample, in the database.
+        Each sample is compared with the previous one using LAG, with
+        sentinels just outside the window so that gaps at its edges are
+        found too.
+
+        Args:
+            start_time: Beginning of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+            end_time: End of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+
+        Returns:
+            list of (first missing epoch, last missing epoch) tuples, in
+            chronological order
+        """
+        start_epoch = strict_rfc3339.rfc3339_to_timestamp(start_time)
+        end_epoch = strict_rfc3339.rfc3339_to_timestamp(end_time)
+        statement = db.text(
+            'SELECT EXTRACT(EPOCH FROM CAST(previous AS timestamptz)), '
+            'EXTRACT(EPOCH FROM CAST(current AS timestamptz)) FROM ('
+            'SELECT datetime AS current, '
+            'LAG(datetime) OVER (ORDER BY datetime) AS previous FROM ('
+            'SELECT datetime FROM machine '
+            'WHERE datetime BETWEEN :start_time AND :end_time '
+            'UNION ALL SELECT CAST(:before AS varchar) '
+            'UNION ALL SELECT CAST(:after AS varchar)) AS samples) AS steps '
+            'WHERE CAST(current AS timestamptz) - '
+            'CAST(previous AS timestamptz) > INTERVAL \'1 second\' '
+            'ORDER BY current')
+        rows = db.session.execute(statement, {
+            'start_time': start_time,
+            'end_time': end_time,
+            'before': strict_rfc3339.timestamp_to_rfc3339_utcoffset(
+                int(start_epoch) - 1),
+            'after': strict_rfc3339.timestamp_to_rfc3339_utcoffset(
+                int(end_epoch) + 1)})
+        return [(int(previous) + 1, int(current) - 1)
+                for previous, current in rows]
+
+    @staticmethod
+    def select_windows(windows, fields):
+        """
+        Reads many windows of time with a single query, by joining the
+        table against a VALUES list of the windows.
+
+        Args:
+            windows: list of (start_time, end_time) tuples, as
+            'YYYY-MM-DDTHH:MM:SSZ' strings
+            fields: list of column names to read besides datetime, each
+            must be a column of the table
+
+        Returns:
+            list with the samples of each window, in the order of windows
+        """
+        columns = ['datetime'] + [Machine.__table__.c[field].name
+                                  for field in fields if field != 'datetime']
+        params = {}
+        values = []
+        for index, (start_time, end_time) in enumerate(windows):
+            params['id_{}'.format(index)] = index
+            params['start_{}'.format(index)] = start_time
+            params['end_{}'.format(index)] = end_time
+            values.append('(:id_{0}, :start_{0}, :end_{0})'.format(index))
+        statement = db.text(
+            'SELECT windows.window_id, {columns} FROM machine '
+            'JOIN (VALUES {values}) AS windows (window_id, start_time, '
+            'end_time) ON machine.datetime BETWEEN windows.start_time '
+            'AND windows.end_time '
+            'ORDER BY windows.window_id, machine.datetime'.format(
+                columns=', '.join('machine.' + column for column in columns),
+                values=', '.join(values)))
+        results = [[] for _ in windows]
+        for row in db.session.execute(statement, params):
+            results[row[0]].append(dict(zip(columns, row[1:])))
+        return results
+
     def to_json(self):
         """
         Converts to JSON for API
@@ -341,3 +659,33 @@ class Machine(db.Model):
 
         return Machine(datetime=datetime,  # ADD MORE SENSORS HERE
                        sensor_1=sensor_1)
+
+
+class MachineRollup(db.Model):
+    """
+    Summary of the values of one sensor over one minute, built at ingest
+    time so that statistics of any window can be merged from them
+    """
+    __tablename__ = 'machine_rollup'
+    # Epoch of the start of the minute
+    minute = db.Column(db.Integer, primary_key=True)
+    sensor = db.Column(db.String(128), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    mean = db.Column(db.Float, nullable=False)
+    # Sum of squared deviations from the mean
+    m2 = db.Column(db.Float, nullable=False)
+    minimum = db.Column(db.Float, nullable=False)
+    maximum = db.Column(db.Float, nullable=False)
+
+
+class MachineRollupBin(db.Model):
+    """
+    Count of the values of one sensor over one minute falling in one bin of
+    its quantile sketch, see sketches.QuantileSketch
+    """
+    __tablename__ = 'machine_rollup_bin'
+    # Epoch of the start of the minute
+    minute = db.Column(db.Integer, primary_key=True)
+    sensor = db.Column(db.String(128), primary_key=True)
+    bin = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,133 @@
+"""
+Token bucket rate limits of the API, shared by every worker through Redis.
+
+Each (route class, principal) pair has a bucket of `capacity` tokens that
+refills at `per_second` tokens a second, and every request takes a token.
+Refilling and taking are a single Lua script run with Redis' clock, so
+concurrent workers never grant the same token twice.
+
+Before authentication, only the bucket of the request's IP address is
+charged, so that requests with wrong credentials are limited without using
+up the bucket of the principal they claim to be. Once the credentials are
+verified, the request also takes a token from the bucket of its route class
+and principal: its device key id, or its user id.
+"""
+import math
+from flask import current_app
+from redis import RedisError
+
+BUCKET_KEY = 'rate_limit:{}:{}'
+
+# Refills a bucket for the time elapsed since it was last used, then takes
+# a token if it has one. KEYS[1]: bucket hash, ARGV: capacity and tokens per
+# second. Returns whether the token was taken, the tokens left and the
+# seconds until the next token, as strings since Lua numbers are truncated
+# to integers.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local available = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+available = math.min(capacity, available + math.max(0, now - updated) * rate)
+local allowed = 0
+local wait = 0
+if available < 1 then
+    wait = (1 - available) / rate
+else
+    allowed = 1
+    available = available - 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', available, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(available), tostring(wait)}
+"""
+
+
+class RateLimiter():
+    """
+    Token buckets kept in Redis
+
+    Attributes:
+        redis: Redis client the buckets are kept in
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._take = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, route_class, principal, capacity, per_second):
+        """
+        Takes a token from a bucket if it has one
+
+        Args:
+            route_class: class of the routes the bucket limits
+            principal: who the bucket limits
+            capacity: maximum number of tokens of the bucket
+            per_second: tokens added to the bucket every second
+
+        Returns:
+            (allowed, tokens left, seconds until the next token)
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        allowed, tokens, wait = self._take(
+            keys=[BUCKET_KEY.format(route_class, principal)],
+            args=[capacity, per_second])
+        return bool(allowed), float(tokens), float(wait)
+
+    def limit_address(self, request):
+        """
+        Takes a token for a request from the bucket of its IP address,
+        before its credentials are checked
+
+        Args:
+            request: the Flask request
+
+        Returns:
+            (allowed, capacity, tokens left, seconds until the next token),
+            None if Redis cannot be reached and the request is let through
+        """
+        return self._limit('ip', 'ip:{}'.format(request.remote_addr),
+                           current_app.config['RATE_LIMITS']['ip'])
+
+    def limit(self, request, principal):
+        """
+        Takes a token for an authenticated request from the bucket of its
+        route class and principal
+
+        Args:
+            request: the Flask request
+            principal: 'device:<key id>' or 'user:<id>' of the verified
+            credentials
+
+        Returns:
+            (allowed, capacity, tokens left, seconds until the next token),
+            None if Redis cannot be reached and the request is let through
+        """
+        config = current_app.config
+        route_class = config['RATE_LIMIT_ROUTES'].get(request.endpoint,
+                                                      'default')
+        limits = config['RATE_LIMIT_PRINCIPALS'].get(principal, {}).get(
+            route_class, config['RATE_LIMITS'][route_class])
+        return self._limit(route_class, principal, limits)
+
+    def _limit(self, route_class, principal, limits):
+        """
+        Takes a token from the bucket of a route class and principal, see
+        limit
+        """
+        try:
+            allowed, tokens, wait = self.take(
+                route_class, principal, limits['capacity'],
+                limits['per_second'])
+        except RedisError as e:
+            print(e)
+            print('rate_limit: Redis port may be closed, request not '
+                  'limited.')
+            return None
+        return allowed, limits['capacity'], int(math.floor(tokens)), wait
@@ -0,0 +1,133 @@
+"""
+Routing of read-only work to the read replicas listed in READ_REPLICA_BINDS.
+
+A replica is only used while its replication lag is below REPLICA_MAX_LAG_S,
+otherwise reads fall back to the primary. Users who wrote in the last
+REPLICA_MAX_LAG_S seconds read from the primary so they see their own
+writes, as do requests sent with the 'X-Consistency: primary' header.
+"""
+import time
+import math
+import random
+from functools import wraps
+from flask import current_app, g, request, has_request_context
+from flask_login import current_user
+from redis import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+from . import db, redis_store, replica_lag_cache
+
+LAST_WRITE_KEY = 'last_write:{}'
+# Seconds since the last transaction replayed, NULL when not a standby
+LAG_QUERY = db.text('SELECT COALESCE(EXTRACT(EPOCH FROM '
+                    'now() - pg_last_xact_replay_timestamp()), 0)')
+
+
+def _current_user_id():
+    """
+    Returns:
+        id of the API or web user of the request, None if anonymous or
+        outside of a request
+    """
+    user = g.get('current_user')
+    if user is None and has_request_context():
+        user = current_user
+    if user is None or user.is_anonymous:
+        return None
+    return user.id
+
+
+def replica_lag(bind):
+    """
+    Replication lag of a replica, measured at most every REPLICA_LAG_CHECK_S
+
+    Args:
+        bind: bind key of the replica in SQLALCHEMY_BINDS
+
+    Returns:
+        lag in seconds, or None if the replica cannot be reached
+    """
+    found, lag = replica_lag_cache.get(bind)
+    if found:
+        return lag
+    try:
+        engine = db.get_engine(current_app, bind=bind)
+        lag = float(engine.execute(LAG_QUERY).scalar())
+    except SQLAlchemyError as e:
+        print(e)
+        print('replicas: {} cannot be reached, reading from the '
+              'primary.'.format(bind))
+        lag = None
+    replica_lag_cache.set(bind, lag)
+    return lag
+
+
+def note_write():
+    """
+    Sends the current user's reads to the primary until the replicas have
+    caught up with their write
+    """
+    user_id = _current_user_id()
+    if user_id is None or not current_app.config['READ_REPLICA_BINDS']:
+        return
+    try:
+        redis_store.set(
+            LAST_WRITE_KEY.format(user_id), repr(time.time()),
+            ex=math.ceil(current_app.config['REPLICA_MAX_LAG_S']))
+    except RedisError as e:
+        print(e)
+        print('replicas: Redis port may be closed, could not note write.')
+
+
+def _wrote_recently():
+    """
+    Returns:
+        True if the current user wrote recently, or if that is unknown
+    """
+    user_id = _current_user_id()
+    if user_id is None:
+        return False
+    try:
+        return bool(redis_store.exists(LAST_WRITE_KEY.format(user_id)))
+    except RedisError as e:
+        print(e)
+        print('replicas: Redis port may be closed, reading from the primary.')
+        return True
+
+
+def choose_read_bind():
+    """
+    Returns:
+        bind key of a replica fresh enough to read from, or None to read
+        from the primary
+    """
+    binds = list(current_app.config['READ_REPLICA_BINDS'])
+    if not binds:
+        return None
+    if has_request_context() and \
+            request.headers.get('X-Consistency', '').lower() == 'primary':
+        return None
+    if _wrote_recently():
+        return None
+    random.shuffle(binds)
+    max_lag = current_app.config['REPLICA_MAX_LAG_S']
+    for bind in binds:
+        lag = replica_lag(bind)
+        if lag is not None and lag <= max_lag:
+            return bind
+    return None
+
+
+def read_only(f):
+    """
+    Decorator for views and tasks that only read from the database, their
+    queries go to a read replica when one is fresh enough
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        previous = g.get('read_bind')
+        g.read_bind = choose_read_bind()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.read_bind = previous
+    return decorated
@@ -0,0 +1,145 @@
+"""
+Out-of-band storage of large task results.
+
+The result backend and the statistics cache share Redis' memory with the
+data cache, so a response larger than RESULT_INLINE_MAX_BYTES is written as
+a gzipped JSON file in RESULTS_DIR, a volume shared by the web and worker
+containers. Only a small pointer to the file is kept in Redis, and the file
+is streamed to the client without being loaded into memory.
+
+Files are kept for RESULT_FILE_TTL, then deleted by purge_results on the
+maintenance queue, which runs at most once every RESULTS_PURGE_INTERVAL_S.
+"""
+import os
+import gzip
+import json
+import time
+from flask import current_app, request, Response
+from kombu.exceptions import OperationalError
+from redis import RedisError
+from . import celery, redis_store
+
+RESULT_FILE = '{}.json.gz'
+PURGE_LOCK_KEY = 'results_purge_lock'
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def offload(response, name):
+    """
+    Writes the result of a successful response to a file if it is large
+
+    Args:
+        response: a task's response, {'result': ..., 'status': ...}
+        name: name unique to the result, such as the task's id
+
+    Returns:
+        response if it is small or not successful, else a pointer
+        {'result_file': ..., 'status': ...} to its stored result
+    """
+    if response['status'] != 200:
+        return response
+    body = json.dumps(response['result']).encode('utf-8')
+    if len(body) <= current_app.config['RESULT_INLINE_MAX_BYTES']:
+        return response
+    directory = current_app.config['RESULTS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    filename = RESULT_FILE.format(name)
+    path = os.path.join(directory, filename)
+    # Readers never see a partly written file
+    with gzip.open(path + '.tmp', 'wb') as result_file:
+        result_file.write(body)
+    os.replace(path + '.tmp', path)
+    schedule_purge()
+    return {'result_file': filename, 'status': response['status']}
+
+
+def is_offloaded(response):
+    """
+    Args:
+        response: a task's response
+
+    Returns:
+        True if the response is a pointer returned by offload()
+    """
+    return isinstance(response, dict) and 'result_file' in response
+
+
+def stream(response):
+    """
+    Streams the stored result of a response. Clients accepting gzip get the
+    file as it is, others get it decompressed on the fly.
+
+    Args:
+        response: pointer returned by offload()
+
+    Returns:
+        the streamed response, or None if the file no longer exists
+    """
+    path = os.path.join(current_app.config['RESULTS_DIR'],
+                        os.path.basename(response['result_file']))
+    try:
+        if 'gzip' in request.accept_encodings:
+            result_file = open(path, 'rb')
+            size = os.fstat(result_file.fileno()).st_size
+            headers = {'Content-Encoding': 'gzip', 'Content-Length': size}
+        else:
+            result_file = gzip.open(path, 'rb')
+            headers = {}
+    except FileNotFoundError:
+        return None
+
+    def generate():
+        # An open file can still be read if it is purged meanwhile
+        with result_file:
+            while True:
+                chunk = result_file.read(STREAM_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+
+    headers['Vary'] = 'Accept-Encoding'
+    return Response(generate(), status=response['status'],
+                    mimetype='application/json', headers=headers)
+
+
+def schedule_purge():
+    """Queues purge_results unless it ran recently"""
+    try:
+        if redis_store.set(PURGE_LOCK_KEY, 1, nx=True,
+                           ex=current_app.config['RESULTS_PURGE_INTERVAL_S']):
+            purge_results.delay()
+    except RedisError as e:
+        print(e)
+        print('result_store: Redis port may be closed, results are not '
+              'purged.')
+    except OperationalError as e:
+        print(e)
+        print('result_store: Celery broker may be down, results are not '
+              'purged.')
+
+
+@celery.task(ignore_result=True)
+def purge_results():
+    """
+    Deletes the result files older than RESULT_FILE_TTL, including files
+    left half written by a worker that died
+
+    Returns:
+        number of files deleted
+    """
+    directory = current_app.config['RESULTS_DIR']
+    oldest = time.time() - current_app.config['RESULT_FILE_TTL']
+    deleted = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return deleted
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            # Purged by another worker
+            continue
+    return deleted
@@ -0,0 +1,464 @@
+"""
+Per-minute rollups of the sensor values, maintained at ingest time.
+
+Every ingested sample updates a Redis hash of Welford accumulators (count,
+mean, M2, min and max of each sensor) for its minute, and marks the minute
+dirty. Minutes older than ROLLUP_FLUSH_DELAY_S are flushed to the
+machine_rollup table by a Celery task, which merges them into any row
+already there, so late samples are rolled up too.
+
+Each minute also keeps a quantile sketch of every sensor, the count of its
+values per bin, in the same hash and then in the machine_rollup_bin table.
+
+Statistics of a window are then merged from the rollups of its whole
+minutes, the minutes not flushed yet, and the raw rows of its partial
+minutes at each edge. Percentiles are estimated from the merged sketches
+within STATISTICS_SKETCH_ACCURACY, whatever the length of the window.
+Changing STATISTICS_SKETCH_ACCURACY or STATISTICS_SKETCH_MIN_VALUE
+renumbers the bins, the rollups then have to be rebuilt.
+
+Redis evicts keys when full and does not persist them, so minutes can be
+lost. rebuild() recomputes the rollups of a window from the raw rows.
+"""
+import math
+import time
+import uuid
+from flask import current_app
+from kombu.exceptions import OperationalError
+from redis import RedisError
+from . import db, celery, redis_store
+from .models import Machine, MachineRollup, MachineRollupBin
+from .sketches import QuantileSketch
+from .statistics import Accumulator, sensor_columns, window_statistics, \
+    NUMBER_PATTERN
+
+MINUTE_KEY = 'rollup:{}'
+FLUSHING_KEY = 'rollup_flushing:{}'
+DIRTY_KEY = 'rollup_dirty'
+FLUSHING_SET_KEY = 'rollup_flushing'
+FLUSH_LOCK_KEY = 'rollup_flush_lock'
+FIELDS = ('n', 'mean', 'm2', 'min', 'max')
+# Hash field counting the values of a sensor in a bin of its sketch
+BIN_FIELD = '{}:bin:{}'
+
+# Welford update of the accumulators of each sensor, and count of the
+# value's sketch bin. KEYS[1]: minute hash, KEYS[2]: dirty minutes sorted
+# set, ARGV: minute, then sensor/value/bin triples.
+# Returns 1 if the minute was not dirty yet
+RECORD_SCRIPT = """
+local created = redis.call('ZADD', KEYS[2], 'NX', ARGV[1], ARGV[1])
+for i = 2, #ARGV, 3 do
+    local sensor = ARGV[i]
+    local value = tonumber(ARGV[i + 1])
+    redis.call('HINCRBY', KEYS[1], sensor .. ':bin:' .. ARGV[i + 2], 1)
+    local n = redis.call('HINCRBY', KEYS[1], sensor .. ':n', 1)
+    local mean = tonumber(redis.call('HGET', KEYS[1], sensor .. ':mean') or 0)
+    local m2 = tonumber(redis.call('HGET', KEYS[1], sensor .. ':m2') or 0)
+    local minimum = tonumber(redis.call('HGET', KEYS[1], sensor .. ':min')
+                             or value)
+    local maximum = tonumber(redis.call('HGET', KEYS[1], sensor .. ':max')
+                             or value)
+    local delta = value - mean
+    mean = mean + delta / n
+    m2 = m2 + delta * (value - mean)
+    redis.call('HMSET', KEYS[1],
+               sensor .. ':mean', string.format('%.17g', mean),
+               sensor .. ':m2', string.format('%.17g', m2),
+               sensor .. ':min', string.format('%.17g',
+                                               math.min(minimum, value)),
+               sensor .. ':max', string.format('%.17g',
+                                               math.max(maximum, value)))
+end
+return created
+"""
+
+# Moves the dirty minutes older than a cutoff to the flushing keys, so that
+# samples arriving during the flush start a new hash. Minutes whose previous
+# flush did not finish are left dirty. KEYS[1]: dirty minutes, KEYS[2]:
+# flushing minutes, ARGV: cutoff, minute key prefix, flushing key prefix
+TAKE_DIRTY_SCRIPT = """
+local taken = {}
+for _, minute in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf',
+                                   ARGV[1])) do
+    if redis.call('EXISTS', ARGV[3] .. minute) == 0 then
+        if redis.call('EXISTS', ARGV[2] .. minute) == 1 then
+            redis.call('RENAME', ARGV[2] .. minute, ARGV[3] .. minute)
+            redis.call('SADD', KEYS[2], minute)
+            table.insert(taken, minute)
+        end
+        redis.call('ZREM', KEYS[1], minute)
+    end
+end
+return taken
+"""
+
+# Deletes the flush lock if it is still held by this flush, it may have
+# expired and been taken by another one. KEYS[1]: lock, ARGV[1]: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_record = redis_store.register_script(RECORD_SCRIPT)
+_take_dirty = redis_store.register_script(TAKE_DIRTY_SCRIPT)
+_release_lock = redis_store.register_script(RELEASE_LOCK_SCRIPT)
+
+
+def minute_of(epoch):
+    """
+    Returns:
+        epoch of the start of the minute of epoch
+    """
+    return int(epoch) // 60 * 60
+
+
+def new_sketch():
+    """
+    Returns:
+        an empty QuantileSketch with the configured accuracy
+    """
+    return QuantileSketch(current_app.config['STATISTICS_SKETCH_ACCURACY'],
+                          current_app.config['STATISTICS_SKETCH_MIN_VALUE'])
+
+
+def record_sample(epoch, sample):
+    """
+    Adds the numeric sensor values of an ingested sample to the rollup of
+    its minute, and starts a flush when a new minute becomes dirty
+
+    Args:
+        epoch: timestamp of the sample, in seconds since epoch
+        sample: sample as returned by Machine.to_json()
+    """
+    sensors = []
+    values = []
+    for sensor in sensor_columns():
+        try:
+            value = float(sample.get(sensor))
+        except (TypeError, ValueError):
+            continue
+        if math.isfinite(value):
+            sensors.append(sensor)
+            values.append(value)
+    if not values:
+        return
+    triples = []
+    for sensor, value, key in zip(sensors, values,
+                                  new_sketch().keys(values).tolist()):
+        triples.extend((sensor, repr(value), key))
+    minute = minute_of(epoch)
+    try:
+        created = _record(keys=[MINUTE_KEY.format(minute), DIRTY_KEY],
+                          args=[minute] + triples)
+    except RedisError as e:
+        print(e)
+        print('rollups: Redis port may be closed, sample is not rolled up.')
+        return
+    if created:
+        try:
+            flush_rollups.delay()
+        except OperationalError as e:
+            print(e)
+            print('rollups: Celery broker may be down, flush postponed.')
+
+
+def _accumulator(sensors, summaries):
+    """
+    Args:
+        sensors: names of the sensors
+        summaries: dict of sensor name to (count, mean, m2, min, max)
+
+    Returns:
+        Accumulator holding the summaries, without percentiles
+    """
+    accumulator = Accumulator(sensors, 0)
+    for index, sensor in enumerate(sensors):
+        if sensor in summaries:
+            count, mean, m2, minimum, maximum = summaries[sensor]
+            accumulator.count[index] = count
+            accumulator.mean[index] = mean
+            accumulator.m2[index] = m2
+            accumulator.minimum[index] = minimum
+            accumulator.maximum[index] = maximum
+    return accumulator
+
+
+def _parse_hash(fields):
+    """
+    Args:
+        fields: HGETALL of a minute hash
+
+    Returns:
+        (dict of sensor name to (count, mean, m2, min, max),
+         dict of sensor name to list of (bin, count) of its sketch)
+    """
+    values = {}
+    bins = {}
+    for field, value in fields.items():
+        parts = field.decode('utf-8').split(':')
+        if len(parts) == 3:
+            bins.setdefault(parts[0], []).append((int(parts[2]), int(value)))
+        else:
+            values.setdefault(parts[0], {})[parts[1]] = float(value)
+    summaries = {sensor: tuple(summary[name] for name in FIELDS)
+                 for sensor, summary in values.items()
+                 if all(name in summary for name in FIELDS)}
+    return summaries, bins
+
+
+def _flush_minute(minute, sensors):
+    """
+    Merges the flushing hash of a minute into its rows and drops the hash
+    """
+    key = FLUSHING_KEY.format(minute)
+    pending, pending_bins = _parse_hash(redis_store.hgetall(key))
+    for sensor in pending:
+        if sensor not in sensors:
+            continue
+        row = MachineRollup.query.get((minute, sensor))
+        accumulator = _accumulator([sensor], {sensor: pending[sensor]})
+        if row is None:
+            row = MachineRollup(minute=minute, sensor=sensor)
+            db.session.add(row)
+        else:
+            accumulator.merge(_accumulator([sensor], {sensor: (
+                row.count, row.mean, row.m2, row.minimum, row.maximum)}))
+        row.count = int(accumulator.count[0])
+        row.mean = float(accumulator.mean[0])
+        row.m2 = float(accumulator.m2[0])
+        row.minimum = float(accumulator.minimum[0])
+        row.maximum = float(accumulator.maximum[0])
+    bins = [{'minute': minute, 'sensor': sensor, 'bin': key, 'count': count}
+            for sensor in pending_bins if sensor in sensors
+            for key, count in pending_bins[sensor]]
+    if bins:
+        db.session.execute(db.text(
+            'INSERT INTO machine_rollup_bin (minute, sensor, bin, count) '
+            'VALUES (:minute, :sensor, :bin, :count) '
+            'ON CONFLICT (minute, sensor, bin) DO UPDATE '
+            'SET count = machine_rollup_bin.count + EXCLUDED.count'), bins)
+    db.session.commit()
+    # A failure between the commit and here would merge the minute twice
+    redis_store.delete(key)
+    redis_store.srem(FLUSHING_SET_KEY, minute)
+
+
+@celery.task(ignore_result=True)
+def flush_rollups():
+    """
+    Writes the rollups of the dirty minutes older than ROLLUP_FLUSH_DELAY_S
+    to the database. Only one flush runs at a time.
+    """
+    lock_timeout = current_app.config['ROLLUP_FLUSH_LOCK_S']
+    token = uuid.uuid4().hex
+    try:
+        if not redis_store.set(FLUSH_LOCK_KEY, token, nx=True,
+                               ex=lock_timeout):
+            return
+    except RedisError as e:
+        print(e)
+        print('rollups: Redis port may be closed, could not flush rollups.')
+        return
+    try:
+        sensors = sensor_columns()
+        # Minutes left over by a flush that failed are retried first
+        for minute in redis_store.smembers(FLUSHING_SET_KEY):
+            _flush_minute(int(minute), sensors)
+        cutoff = time.time() - current_app.config['ROLLUP_FLUSH_DELAY_S']
+        for minute in _take_dirty(
+                keys=[DIRTY_KEY, FLUSHING_SET_KEY],
+                args=[minute_of(cutoff) - 60, MINUTE_KEY.format(''),
+                      FLUSHING_KEY.format('')]):
+            _flush_minute(int(minute), sensors)
+    except RedisError as e:
+        print(e)
+        print('rollups: Redis port may be closed, could not flush rollups.')
+    finally:
+        # Also released if the database failed, the next flush retries
+        try:
+            _release_lock(keys=[FLUSH_LOCK_KEY], args=[token])
+        except RedisError as e:
+            print(e)
+            print('rollups: Redis port may be closed, flush lock expires '
+                  'in {}s.'.format(lock_timeout))
+
+
+def _table_statistics(first_minute, last_minute, sensors):
+    """
+    Merges the rollup rows of a range of minutes within the database
+
+    Returns:
+        Accumulator of the rows
+    """
+    statement = db.text(
+        'WITH totals AS (SELECT sensor, SUM(count) AS count, '
+        'SUM(count * mean) / SUM(count) AS mean, MIN(minimum) AS minimum, '
+        'MAX(maximum) AS maximum FROM machine_rollup '
+        'WHERE minute BETWEEN :first_minute AND :last_minute '
+        'GROUP BY sensor) '
+        'SELECT totals.sensor, totals.count, totals.mean, '
+        'SUM(rollups.m2 + '
+        'rollups.count * (rollups.mean - totals.mean) ^ 2), '
+        'totals.minimum, totals.maximum '
+        'FROM machine_rollup AS rollups JOIN totals '
+        'ON rollups.sensor = totals.sensor '
+        'WHERE rollups.minute BETWEEN :first_minute AND :last_minute '
+        'GROUP BY totals.sensor, totals.count, totals.mean, '
+        'totals.minimum, totals.maximum')
+    rows = db.session.execute(statement, {'first_minute': first_minute,
+                                          'last_minute': last_minute})
+    return _accumulator(sensors, {row[0]: tuple(row[1:]) for row in rows})
+
+
+def _table_sketches(first_minute, last_minute, sketches):
+    """
+    Adds the sketch bins of a range of minutes, summed within the database,
+    to the sketch of each sensor
+
+    Args:
+        sketches: dict of sensor name to QuantileSketch
+    """
+    rows = db.session.execute(db.text(
+        'SELECT sensor, bin, SUM(count) FROM machine_rollup_bin '
+        'WHERE minute BETWEEN :first_minute AND :last_minute '
+        'GROUP BY sensor, bin'), {'first_minute': first_minute,
+                                  'last_minute': last_minute})
+    for sensor, key, count in rows:
+        if sensor in sketches:
+            sketches[sensor].add_bins([(key, count)])
+
+
+def _pending_statistics(first_minute, last_minute, sensors, sketches):
+    """
+    Merges the minute hashes that have not been flushed yet. Minutes being
+    flushed at that very moment are briefly missed.
+
+    Args:
+        sketches: dict of sensor name to QuantileSketch, the bins of the
+        hashes are added to them
+
+    Returns:
+        Accumulator of the hashes
+    """
+    accumulator = Accumulator(sensors, 0)
+    minutes = redis_store.zrangebyscore(DIRTY_KEY, first_minute, last_minute)
+    pipe = redis_store.pipeline(transaction=False)
+    for minute in minutes:
+        pipe.hgetall(MINUTE_KEY.format(int(minute)))
+    for fields in pipe.execute():
+        summaries, bins = _parse_hash(fields)
+        accumulator.merge(_accumulator(sensors, summaries))
+        for sensor in bins:
+            if sensor in sketches:
+                sketches[sensor].add_bins(bins[sensor])
+    return accumulator
+
+
+def rollup_statistics(start_epoch, end_epoch):
+    """
+    Statistics of a window, merged from the rollups of its whole minutes and
+    the raw rows of the partial minutes at its edges
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        (Accumulator of the window without percentiles, dict of sensor name
+         to the QuantileSketch of the window)
+
+    Raises:
+        RedisError if Redis cannot be reached
+    """
+    sensors = sensor_columns()
+    sketches = {sensor: new_sketch() for sensor in sensors}
+    start_epoch = int(start_epoch)
+    end_epoch = int(end_epoch)
+    first_minute = minute_of(start_epoch + 59)
+    end_minute = minute_of(end_epoch + 1)
+    accumulator = Accumulator(sensors, 0)
+    edges = []
+    if first_minute >= end_minute:
+        edges.append((start_epoch, end_epoch))
+    else:
+        if start_epoch < first_minute:
+            edges.append((start_epoch, first_minute - 1))
+        if end_minute <= end_epoch:
+            edges.append((end_minute, end_epoch))
+        accumulator.merge(_table_statistics(
+            first_minute, end_minute - 60, sensors))
+        _table_sketches(first_minute, end_minute - 60, sketches)
+        accumulator.merge(_pending_statistics(
+            first_minute, end_minute - 60, sensors, sketches))
+    for edge_start, edge_end in edges:
+        # One row per second at most, so the sample keeps every value
+        edge = window_statistics(_rfc3339(edge_start), _rfc3339(edge_end),
+                                 sensors,
+                                 reservoir_size=edge_end - edge_start + 1)
+        for sensor, reservoir in zip(sensors, edge.reservoirs):
+            sketches[sensor].add(reservoir)
+        accumulator.merge(edge)
+    return accumulator, sketches
+
+
+def _rfc3339(epoch):
+    """Returns: epoch as 'YYYY-MM-DDTHH:MM:SSZ'"""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+def rebuild(start_epoch, end_epoch):
+    """
+    Recomputes the rollups of the minutes of a window from the raw rows,
+    e.g. after Redis lost unflushed minutes
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+
+    Returns:
+        number of rollup rows written
+    """
+    first_minute = minute_of(start_epoch)
+    last_minute = minute_of(end_epoch)
+    # Pending hashes would be counted twice once the rows are rebuilt
+    minutes = redis_store.zrangebyscore(DIRTY_KEY, first_minute, last_minute)
+    for minute in minutes:
+        redis_store.delete(MINUTE_KEY.format(int(minute)))
+        redis_store.zrem(DIRTY_KEY, minute)
+    for model in (MachineRollup, MachineRollupBin):
+        model.query.filter(
+            model.minute.between(first_minute, last_minute)).delete(
+                synchronize_session=False)
+    sketch = new_sketch()
+    written = 0
+    for sensor in sensor_columns():
+        samples = (
+            'SELECT CAST(FLOOR(EXTRACT(EPOCH FROM CAST(datetime AS '
+            'timestamptz)) / 60) * 60 AS integer) AS minute, '
+            'CASE WHEN {0} ~ :number THEN CAST({0} AS double precision) END '
+            'AS value FROM machine WHERE datetime BETWEEN :start_time AND '
+            ':end_time'.format(Machine.__table__.c[sensor].name))
+        params = {'sensor': sensor, 'number': NUMBER_PATTERN,
+                  'start_time': _rfc3339(first_minute),
+                  'end_time': _rfc3339(last_minute + 59),
+                  'min_value': sketch.min_value, 'gamma': sketch.gamma}
+        written += db.session.execute(db.text(
+            'INSERT INTO machine_rollup '
+            '(minute, sensor, count, mean, m2, minimum, maximum) '
+            'SELECT minute, :sensor, COUNT(value), AVG(value), '
+            'VAR_POP(value) * COUNT(value), MIN(value), MAX(value) FROM ({}) '
+            'AS samples GROUP BY minute HAVING COUNT(value) > 0'
+            .format(samples)), params).rowcount
+        # Same numbering of the bins as QuantileSketch.keys()
+        db.session.execute(db.text(
+            'INSERT INTO machine_rollup_bin (minute, sensor, bin, count) '
+            'SELECT minute, :sensor, bin, COUNT(*) FROM ('
+            'SELECT minute, CASE WHEN ABS(value) < :min_value THEN 0 '
+            'ELSE CAST(SIGN(value) * (CEIL(LN(ABS(value) / :min_value) / '
+            'LN(:gamma)) + 1) AS integer) END AS bin FROM ({}) AS samples '
+            'WHERE value IS NOT NULL) AS bins GROUP BY minute, bin'
+            .format(samples)), params)
+    db.session.commit()
+    return written
@@ -0,0 +1,32 @@
+"""
+SQLAlchemy session that sends reads to a read replica.
+
+Which replica, if any, is decided per request by app.replicas, which stores
+the chosen bind key in flask.g. Flushes always go to the primary.
+"""
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session whose reads go to the bind named by g.read_bind, when set.
+    Models with their own bind key and flushes keep the default binds.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        read_bind = g.get('read_bind') if has_app_context() else None
+        if read_bind is None or self._flushing:
+            return super().get_bind(mapper, clause)
+        if mapper is not None and \
+                mapper.mapped_table.info.get('bind_key') is not None:
+            return super().get_bind(mapper, clause)
+        return self.db.get_engine(self.app, bind=read_bind)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension using RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,131 @@
+"""
+Mergeable quantile sketches of sensor values, after DDSketch.
+
+Values are counted in logarithmic bins, so that any quantile is estimated
+within a relative error of relative_accuracy of the true value. Sketches are
+merged by adding the counts of their bins, which makes merging exact and
+independent of the order. The number of bins depends only on the range of
+the values, not on how many there are, so sketches of a month take as much
+memory as sketches of a minute.
+
+Bins are numbered so that their order is the order of their values: 0 holds
+the values closer to zero than min_value, bin k > 0 the values in
+(min_value * gamma^(k - 2), min_value * gamma^(k - 1)] and bin -k their
+opposites, where gamma = (1 + relative_accuracy) / (1 - relative_accuracy).
+"""
+import math
+import numpy as np
+
+
+class QuantileSketch():
+    """
+    Counts of values per logarithmic bin
+
+    Attributes:
+        relative_accuracy: bound of the relative error of the quantiles
+        min_value: values closer to zero are counted as zero
+        bins: dict of bin number to count
+    """
+
+    def __init__(self, relative_accuracy, min_value, bins=None):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = dict(bins or {})
+
+    def keys(self, values):
+        """
+        Args:
+            values: float array, without NaN
+
+        Returns:
+            integer array of the bin of each value
+        """
+        values = np.asarray(values, dtype=np.float64)
+        magnitudes = np.abs(values)
+        with np.errstate(divide='ignore'):
+            keys = np.ceil(np.log(magnitudes / self.min_value)
+                           / self._log_gamma) + 1
+        keys = np.where(magnitudes < self.min_value, 0, keys)
+        return (np.sign(values) * keys).astype(np.int64)
+
+    def key(self, value):
+        """
+        Returns:
+            the bin of a single value
+        """
+        return int(self.keys([value])[0])
+
+    def add(self, values):
+        """
+        Args:
+            values: float array, NaN are skipped
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        keys, counts = np.unique(self.keys(values), return_counts=True)
+        self.add_bins(zip(keys.tolist(), counts.tolist()))
+
+    def add_bins(self, bins):
+        """
+        Args:
+            bins: iterable of (bin, count) pairs
+        """
+        for key, count in bins:
+            self.bins[int(key)] = self.bins.get(int(key), 0) + int(count)
+
+    def merge(self, other):
+        """
+        Args:
+            other: QuantileSketch of the same accuracy and min_value
+        """
+        self.add_bins(other.bins.items())
+
+    def count(self):
+        """
+        Returns:
+            number of values in the sketch
+        """
+        return sum(self.bins.values())
+
+    def value(self, key):
+        """
+        Returns:
+            estimate of the values of a bin, within relative_accuracy of
+            each of them
+        """
+        if key == 0:
+            return 0.0
+        upper = self.min_value * self.gamma ** (abs(key) - 1)
+        return math.copysign(2 * upper / (self.gamma + 1), key)
+
+    def quantile(self, fraction):
+        """
+        Args:
+            fraction: quantile to estimate, from 0 to 1
+
+        Returns:
+            the estimate, None if the sketch is empty
+        """
+        count = self.count()
+        if not count:
+            return None
+        rank = fraction * (count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.bins))
+
+    def percentiles(self, percentiles):
+        """
+        Args:
+            percentiles: list of the percentiles to estimate, from 0 to 100
+
+        Returns:
+            dict of str(percentile) to its estimate, None if empty
+        """
+        return {str(percentile): self.quantile(percentile / 100.0)
+                for percentile in percentiles}
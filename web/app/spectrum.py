@@ -0,0 +1,149 @@
+"""
+Power spectral density of the sensors over a window, after Welch.
+
+Sensors are sampled at most once a second, the datetime having a one second
+resolution, so frequencies go up to 0.5 Hz. Each sensor's values are cut in
+runs of consecutive seconds, and every run in segments of segment_s seconds
+overlapping by half. The periodograms of the Hann windowed segments are
+summed, Welch's estimate is their average. Segments never span a gap.
+
+Rows are streamed in chunks as NumPy arrays. The end of a run that does not
+fill a segment is carried over to the next chunk, so memory is bounded by
+the chunk and segment sizes whatever the window size.
+"""
+import numpy as np
+from scipy import signal
+from flask import current_app
+import strict_rfc3339
+from .statistics import read_chunks
+
+SAMPLE_RATE_HZ = 1.0
+
+
+class Spectrum():
+    """
+    Sum of the periodograms of the segments of each sensor
+
+    Attributes:
+        sensors: names of the sensors, in the order of the arrays
+        segment_s: length of a segment, in seconds
+        frequencies: frequencies of the periodograms, in Hz
+        power: sum of the periodograms of each sensor, in units^2/Hz
+        segments: number of segments summed for each sensor
+    """
+
+    def __init__(self, sensors, segment_s):
+        self.sensors = list(sensors)
+        self.segment_s = int(segment_s)
+        self.frequencies = np.fft.rfftfreq(self.segment_s,
+                                           1 / SAMPLE_RATE_HZ)
+        self.power = np.zeros((len(self.sensors), len(self.frequencies)))
+        self.segments = np.zeros(len(self.sensors), dtype=np.int64)
+        # Per sensor, (epoch of the last value, values not in a segment yet)
+        self._tails = [(None, np.empty(0)) for _ in self.sensors]
+
+    def _add_run(self, index, values):
+        """
+        Adds the segments of a run of consecutive values of a sensor
+
+        Returns:
+            the values after the last segment
+        """
+        step = self.segment_s // 2
+        if len(values) < self.segment_s:
+            return values
+        _, _, periodograms = signal.spectrogram(
+            values, fs=SAMPLE_RATE_HZ, window='hann', nperseg=self.segment_s,
+            noverlap=self.segment_s - step, detrend='constant',
+            scaling='density', mode='psd')
+        count = periodograms.shape[1]
+        self.power[index] += periodograms.sum(axis=1)
+        self.segments[index] += count
+        return values[count * step:]
+
+    def add_chunk(self, epochs, values):
+        """
+        Adds a chunk of rows, in the order of the window
+
+        Args:
+            epochs: increasing times of the rows, in seconds since epoch
+            values: 2D float array of one row per time and one column per
+            sensor, NaN where a sensor has no value
+        """
+        for index in range(len(self.sensors)):
+            valid = ~np.isnan(values[:, index])
+            run_epochs = epochs[valid]
+            run_values = values[valid, index]
+            if not len(run_epochs):
+                continue
+            breaks = np.flatnonzero(np.diff(run_epochs) != 1) + 1
+            starts = np.concatenate(([0], breaks))
+            ends = np.concatenate((breaks, [len(run_epochs)]))
+            last_epoch, tail = self._tails[index]
+            for start, end in zip(starts, ends):
+                run = run_values[start:end]
+                if last_epoch is not None and \
+                        run_epochs[start] == last_epoch + 1:
+                    run = np.concatenate((tail, run))
+                tail = self._add_run(index, run)
+                last_epoch = run_epochs[end - 1]
+            self._tails[index] = (last_epoch, tail)
+
+    def result(self, peaks):
+        """
+        Args:
+            peaks: number of dominant frequencies returned per sensor
+
+        Returns:
+            dict of the frequencies and of the PSD, number of segments and
+            dominant frequencies of each sensor, PSD None without segments
+        """
+        results = {}
+        for index, sensor in enumerate(self.sensors):
+            count = int(self.segments[index])
+            if not count:
+                results[sensor] = {'segments': 0, 'psd': None, 'peaks': []}
+                continue
+            psd = self.power[index] / count
+            # The constant component is removed, its bin is not a peak
+            found, _ = signal.find_peaks(psd[1:])
+            found = found[np.argsort(psd[1:][found])[::-1][:peaks]] + 1
+            results[sensor] = {
+                'segments': count,
+                'psd': psd.tolist(),
+                'peaks': [{'frequency': float(self.frequencies[position]),
+                           'power': float(psd[position])}
+                          for position in found]}
+        return {'frequencies': self.frequencies.tolist(),
+                'sensors': results}
+
+
+def window_spectrum(start_epoch, end_epoch, sensors, segment_s,
+                    progress=None):
+    """
+    Computes the spectrum of every sensor over a window in one pass over
+    its rows
+
+    Args:
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+        sensors: names of the sensors
+        segment_s: length of the segments, in seconds
+        progress: function called with the fraction of the window done
+
+    Returns:
+        Spectrum of the window
+    """
+    spectrum = Spectrum(sensors, segment_s)
+    start_epoch = int(start_epoch)
+    end_epoch = int(end_epoch)
+    for chunk in read_chunks(
+            strict_rfc3339.timestamp_to_rfc3339_utcoffset(start_epoch),
+            strict_rfc3339.timestamp_to_rfc3339_utcoffset(end_epoch),
+            sensors, current_app.config['MAX_API_DATA_PER_REQUEST'],
+            epochs=True):
+        spectrum.add_chunk(chunk[:, 0], chunk[:, 1:])
+        if progress is not None:
+            progress((chunk[-1, 0] - start_epoch + 1.0) /
+                     (end_epoch - start_epoch + 1))
+    return spectrum
@@ -0,0 +1,264 @@
+"""
+Statistics of windows of machine data, computed with NumPy.
+
+Windows are streamed from the database in chunks through a server-side
+cursor, so memory is bounded by the chunk size whatever the window size.
+Each chunk is summarised with vectorized operations into an Accumulator, and
+accumulators are merged exactly (Chan et al.'s parallel variance), so chunks
+can be summarised in any order or on different workers.
+
+Percentiles are computed from a uniform sample of at most
+STATISTICS_RESERVOIR_SIZE values per sensor, which is every value for
+windows shorter than that.
+"""
+import numpy as np
+from flask import current_app
+from . import db
+from .models import Machine
+
+# Sensor values are stored as strings, anything that is not a number is NULL
+NUMBER_PATTERN = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+
+def sensor_columns():
+    """
+    Returns:
+        list of the names of the sensor columns of the machine table
+    """
+    return [column.name for column in Machine.__table__.columns
+            if column.name != 'datetime']
+
+
+class Accumulator():
+    """
+    Mergeable count, mean, sum of squared deviations, min and max of a set
+    of sensors, plus a uniform sample of their values for percentiles.
+
+    Attributes:
+        sensors: names of the sensors, in the order of the arrays
+        reservoir_size: maximum number of values sampled per sensor
+        count: number of values of each sensor
+        mean: mean of each sensor
+        m2: sum of squared deviations from the mean of each sensor
+        minimum: minimum of each sensor, NaN without values
+        maximum: maximum of each sensor, NaN without values
+        reservoirs: list of the sampled values of each sensor
+    """
+
+    def __init__(self, sensors, reservoir_size, random_state=None):
+        self.sensors = list(sensors)
+        self.reservoir_size = reservoir_size
+        size = len(self.sensors)
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.minimum = np.full(size, np.nan)
+        self.maximum = np.full(size, np.nan)
+        self.reservoirs = [np.empty(0) for _ in self.sensors]
+        self._random = random_state or np.random.RandomState()
+
+    def add_chunk(self, values):
+        """
+        Adds a chunk of rows
+
+        Args:
+            values: 2D float array of one row per sample and one column per
+            sensor, NaN where a sensor has no value
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(
+            -1, len(self.sensors))
+        chunk = Accumulator(self.sensors, self.reservoir_size, self._random)
+        valid = ~np.isnan(values)
+        chunk.count = valid.sum(axis=0)
+        has_values = chunk.count > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk.mean = np.where(
+                has_values,
+                np.where(valid, values, 0).sum(axis=0) / chunk.count, 0)
+        deviations = np.where(valid, values - chunk.mean, 0)
+        chunk.m2 = (deviations * deviations).sum(axis=0)
+        chunk.minimum = np.where(
+            has_values, np.where(valid, values, np.inf).min(axis=0), np.nan)
+        chunk.maximum = np.where(
+            has_values, np.where(valid, values, -np.inf).max(axis=0), np.nan)
+        chunk.reservoirs = [
+            chunk._sample(values[valid[:, index], index], self.reservoir_size)
+            for index in range(len(self.sensors))]
+        self.merge(chunk)
+
+    def _sample(self, values, size):
+        """Uniform sample without replacement of at most size values"""
+        if len(values) <= size:
+            return values
+        return self._random.choice(values, size, replace=False)
+
+    def merge(self, other):
+        """
+        Merges the statistics of other into this accumulator, the result is
+        the same as if other's values had been added to this one
+
+        Args:
+            other: Accumulator of the same sensors
+        """
+        count = self.count + other.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = other.mean - self.mean
+            weight = np.where(count > 0, other.count / count, 0)
+            mean = self.mean + delta * weight
+            m2 = self.m2 + other.m2 + \
+                delta * delta * self.count * weight
+        reservoirs = [self._merge_reservoirs(mine, self.count[index],
+                                             theirs, other.count[index])
+                      for index, (mine, theirs) in enumerate(
+                          zip(self.reservoirs, other.reservoirs))]
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = np.fmin(self.minimum, other.minimum)
+        self.maximum = np.fmax(self.maximum, other.maximum)
+        self.reservoirs = reservoirs
+
+    def _merge_reservoirs(self, mine, my_count, theirs, their_count):
+        """
+        Merges two uniform samples into a uniform sample of the union. The
+        number of values taken from each side follows the hypergeometric
+        distribution of their population sizes.
+        """
+        if len(mine) + len(theirs) <= self.reservoir_size:
+            return np.concatenate((mine, theirs))
+        taken = self._random.hypergeometric(
+            my_count, their_count, self.reservoir_size)
+        taken = min(max(taken, self.reservoir_size - len(theirs)), len(mine))
+        return np.concatenate((
+            self._sample(mine, taken),
+            self._sample(theirs, self.reservoir_size - taken)))
+
+    def to_dict(self):
+        """
+        Returns:
+            dict of lists, to send an accumulator between processes
+        """
+        return {'sensors': self.sensors,
+                'reservoir_size': self.reservoir_size,
+                'count': self.count.tolist(),
+                'mean': self.mean.tolist(),
+                'm2': self.m2.tolist(),
+                'minimum': self.minimum.tolist(),
+                'maximum': self.maximum.tolist(),
+                'reservoirs': [reservoir.tolist()
+                               for reservoir in self.reservoirs]}
+
+    @staticmethod
+    def from_dict(state):
+        """
+        Args:
+            state: dict returned by to_dict()
+
+        Returns:
+            the Accumulator
+        """
+        accumulator = Accumulator(state['sensors'], state['reservoir_size'])
+        accumulator.count = np.array(state['count'], dtype=np.int64)
+        for name in ('mean', 'm2', 'minimum', 'maximum'):
+            setattr(accumulator, name,
+                    np.array(state[name], dtype=np.float64))
+        accumulator.reservoirs = [np.array(reservoir, dtype=np.float64)
+                                  for reservoir in state['reservoirs']]
+        return accumulator
+
+    def result(self, percentiles):
+        """
+        Args:
+            percentiles: list of the percentiles to compute, from 0 to 100
+
+        Returns:
+            dict of the statistics of each sensor, None where undefined
+        """
+        def number(value):
+            return None if np.isnan(value) else float(value)
+
+        results = {}
+        for index, sensor in enumerate(self.sensors):
+            count = int(self.count[index])
+            reservoir = self.reservoirs[index]
+            if len(reservoir):
+                values = np.percentile(reservoir, percentiles).tolist()
+            else:
+                values = [None] * len(percentiles)
+            results[sensor] = {
+                'count': count,
+                'mean': float(self.mean[index]) if count else None,
+                'std': (float(np.sqrt(self.m2[index] / (count - 1)))
+                        if count > 1 else None),
+                'min': number(self.minimum[index]),
+                'max': number(self.maximum[index]),
+                'percentiles': {str(percentile): value for percentile, value
+                                in zip(percentiles, values)}}
+        return results
+
+
+def read_chunks(start_time, end_time, sensors, chunk_size, epochs=False):
+    """
+    Streams the sensor values of a window from the database
+
+    Args:
+        start_time: Beginning of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+        end_time: End of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+        sensors: names of the sensor columns to read
+        chunk_size: number of rows per chunk
+        epochs: read the rows in order, with the time of each row in
+        seconds since epoch as an extra first column
+
+    Yields:
+        2D float arrays of at most chunk_size rows, NaN where a value is
+        missing or not a number
+    """
+    columns = ', '.join(
+        'CASE WHEN {0} ~ :number THEN CAST({0} AS double precision) END'
+        .format(Machine.__table__.c[sensor].name) for sensor in sensors)
+    order = ''
+    if epochs:
+        columns = ('EXTRACT(EPOCH FROM CAST(datetime AS timestamptz)), ' +
+                   columns)
+        order = ' ORDER BY datetime'
+    statement = db.text(
+        'SELECT {} FROM machine WHERE datetime BETWEEN :start_time '
+        'AND :end_time{}'.format(columns, order))
+    # stream_results makes psycopg2 use a server-side cursor
+    result = db.session.connection().execution_options(
+        stream_results=True).execute(
+            statement, start_time=start_time, end_time=end_time,
+            number=NUMBER_PATTERN)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield np.array(rows, dtype=np.float64)
+    finally:
+        result.close()
+
+
+def window_statistics(start_time, end_time, sensors=None,
+                      reservoir_size=None):
+    """
+    Computes the statistics of every sensor over a window
+
+    Args:
+        start_time: Beginning of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+        end_time: End of the window, as 'YYYY-MM-DDTHH:MM:SSZ'
+        sensors: names of the sensors, defaults to every sensor column
+        reservoir_size: values sampled for percentiles, defaults to
+        STATISTICS_RESERVOIR_SIZE
+
+    Returns:
+        Accumulator of the window
+    """
+    sensors = sensors or sensor_columns()
+    if reservoir_size is None:
+        reservoir_size = current_app.config['STATISTICS_RESERVOIR_SIZE']
+    accumulator = Accumulator(sensors, reservoir_size)
+    for chunk in read_chunks(start_time, end_time, sensors,
+                             current_app.config['MAX_API_DATA_PER_REQUEST']):
+        accumulator.add_chunk(chunk)
+    return accumulator
@@ -0,0 +1,118 @@
+"""
+Result cache and in-flight deduplication of statistics tasks.
+
+Requests are keyed by the machine, the window, the parameters of the
+computation and the data version of the window, so a late sample gives the
+window a new key. Results of closed windows are kept for
+STATISTICS_RESULT_CLOSED_TTL, open windows only for
+STATISTICS_RESULT_OPEN_TTL. Identical requests made while a task is running
+share that task.
+"""
+import json
+import hashlib
+from flask import current_app
+from redis import RedisError
+from . import cache, redis_store
+from .http_cache import window_validators, is_closed_window
+
+RESULT_KEY = 'statistics_result:{}'
+INFLIGHT_KEY = 'statistics_inflight:{}'
+
+
+def request_key(machine, start_epoch, end_epoch, params):
+    """
+    Args:
+        machine: name of the machine's table
+        start_epoch: Beginning of the window, in seconds since epoch
+        end_epoch: End of the window, in seconds since epoch
+        params: JSON serializable parameters of the computation
+
+    Returns:
+        key of the request, or None if the window's version is unknown
+    """
+    etag, _ = window_validators(start_epoch, end_epoch)
+    if etag is None:
+        return None
+    return hashlib.sha1(json.dumps(
+        [machine, start_epoch, end_epoch, params, etag],
+        sort_keys=True).encode()).hexdigest()
+
+
+def cached_result(key):
+    """
+    Args:
+        key: key of the request
+
+    Returns:
+        the task's response, or None if it is not cached
+    """
+    try:
+        return cache.get(RESULT_KEY.format(key))
+    except RedisError as e:
+        print(e)
+        print('statistics_cache: Redis port may be closed, skipping cache.')
+        return None
+
+
+def store_result(key, end_epoch, response):
+    """
+    Caches the response of a task and ends its in-flight claim
+
+    Args:
+        key: key of the request
+        end_epoch: End of the window, in seconds since epoch
+        response: the task's response
+    """
+    if is_closed_window(end_epoch):
+        timeout = current_app.config['STATISTICS_RESULT_CLOSED_TTL']
+    else:
+        timeout = current_app.config['STATISTICS_RESULT_OPEN_TTL']
+    try:
+        cache.set(RESULT_KEY.format(key), response, timeout=timeout)
+    except RedisError as e:
+        print(e)
+        print('statistics_cache: Redis port may be closed, could not cache '
+              'result.')
+    release(key)
+
+
+def claim(key, task_id, replace=False):
+    """
+    Registers task_id as the task computing a request
+
+    Args:
+        key: key of the request
+        task_id: id of the task about to be started
+        replace: take over the request even if another task holds it
+
+    Returns:
+        id of the task already computing the request, None if task_id
+        should be started
+    """
+    inflight_key = INFLIGHT_KEY.format(key)
+    timeout = current_app.config['STATISTICS_INFLIGHT_TTL']
+    try:
+        if redis_store.set(inflight_key, task_id, ex=timeout,
+                           nx=not replace):
+            return None
+        existing = redis_store.get(inflight_key)
+    except RedisError as e:
+        print(e)
+        print('statistics_cache: Redis port may be closed, not '
+              'deduplicating.')
+        return None
+    # The claim may have been released in the meantime
+    return existing.decode('utf-8') if existing is not None else None
+
+
+def release(key):
+    """
+    Args:
+        key: key of the request, new requests start a new task
+    """
+    try:
+        redis_store.delete(INFLIGHT_KEY.format(key))
+    except RedisError as e:
+        print(e)
+        print('statistics_cache: Redis port may be closed, could not '
+              'release task.')
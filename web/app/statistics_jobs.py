@@ -0,0 +1,169 @@
+"""
+Bookkeeping of the statistics tasks requested by each user.
+
+Since identical requests share a task, a task is only revoked once every
+user who requested it has cancelled it. The tasks a user is waiting on are
+also counted, so that one user cannot fill the statistics queue.
+
+Windows of up to STATISTICS_INTERACTIVE_MAX_S run on the interactive queue,
+longer ones on the batch queue, which has its own workers so that batch work
+does not delay interactive requests. Inside a queue shorter windows get a
+higher priority.
+"""
+import math
+from flask import current_app
+from redis import RedisError
+from . import redis_store
+
+REQUESTERS_KEY = 'statistics_requesters:{}'
+USER_TASKS_KEY = 'statistics_user_tasks:{}'
+# Separator kombu's Redis transport puts between a queue and its priority
+PRIORITY_SEP = '\x06\x16'
+
+
+def time_limits(window_s):
+    """
+    Time limits of a task computing statistics over a window
+
+    Args:
+        window_s: length of the window, in seconds
+
+    Returns:
+        (soft, hard) time limits, in seconds
+    """
+    soft = current_app.config['STATISTICS_TIME_LIMIT_BASE_S'] + math.ceil(
+        window_s * current_app.config['STATISTICS_TIME_LIMIT_PER_HOUR_S']
+        / 3600)
+    return soft, soft + current_app.config['STATISTICS_TIME_LIMIT_GRACE_S']
+
+
+def placement(window_s):
+    """
+    Queue and priority of the tasks computing statistics over a window
+
+    Args:
+        window_s: length of the window, in seconds
+
+    Returns:
+        (queue, priority), priority 0 is consumed first
+    """
+    if window_s <= current_app.config['STATISTICS_INTERACTIVE_MAX_S']:
+        queue = 'interactive'
+    else:
+        queue = 'batch'
+    # One step per doubling of the window above an hour
+    priority = min(9, max(0, math.ceil(math.log2(max(window_s, 1) / 3600))))
+    return queue, priority
+
+
+def add_requester(task_id, user_id):
+    """
+    Records that a user waits on a task
+
+    Args:
+        task_id: id of the task
+        user_id: id of the user
+    """
+    timeout = current_app.config['STATISTICS_INFLIGHT_TTL']
+    try:
+        pipe = redis_store.pipeline()
+        pipe.sadd(REQUESTERS_KEY.format(task_id), user_id)
+        pipe.expire(REQUESTERS_KEY.format(task_id), timeout)
+        pipe.sadd(USER_TASKS_KEY.format(user_id), task_id)
+        pipe.expire(USER_TASKS_KEY.format(user_id), timeout)
+        pipe.execute()
+    except RedisError as e:
+        print(e)
+        print('statistics_jobs: Redis port may be closed, could not record '
+              'requester.')
+
+
+def remove_requester(task_id, user_id):
+    """
+    Records that a user no longer waits on a task
+
+    Args:
+        task_id: id of the task
+        user_id: id of the user
+
+    Returns:
+        number of users still waiting on the task, or None if user_id was
+        not waiting on it
+
+    Raises:
+        RedisError if Redis cannot be reached
+    """
+    pipe = redis_store.pipeline()
+    pipe.srem(REQUESTERS_KEY.format(task_id), user_id)
+    pipe.scard(REQUESTERS_KEY.format(task_id))
+    pipe.srem(USER_TASKS_KEY.format(user_id), task_id)
+    removed, remaining, _ = pipe.execute()
+    if not removed:
+        return None
+    return remaining
+
+
+def finish(task_id):
+    """
+    Forgets the requesters of a task once it is done
+
+    Args:
+        task_id: id of the task
+    """
+    key = REQUESTERS_KEY.format(task_id)
+    try:
+        for user_id in redis_store.smembers(key):
+            redis_store.srem(USER_TASKS_KEY.format(int(user_id)), task_id)
+        redis_store.delete(key)
+    except RedisError as e:
+        print(e)
+        print('statistics_jobs: Redis port may be closed, could not forget '
+              'requesters.')
+
+
+def tasks_in_flight(user_id, is_done):
+    """
+    Counts the tasks a user waits on, forgetting those that are done
+
+    Args:
+        user_id: id of the user
+        is_done: function telling if a task id is done
+
+    Returns:
+        number of tasks the user waits on
+    """
+    key = USER_TASKS_KEY.format(user_id)
+    try:
+        task_ids = [task_id.decode('utf-8')
+                    for task_id in redis_store.smembers(key)]
+        done = [task_id for task_id in task_ids if is_done(task_id)]
+        if done:
+            redis_store.srem(key, *done)
+    except RedisError as e:
+        print(e)
+        print('statistics_jobs: Redis port may be closed, not counting '
+              'tasks.')
+        return 0
+    return len(task_ids) - len(done)
+
+
+def queue_length(queue):
+    """
+    Args:
+        queue: name of a Celery queue on the Redis broker
+
+    Returns:
+        number of messages waiting in the queue at any priority, 0 if
+        unknown
+    """
+    try:
+        pipe = redis_store.pipeline()
+        pipe.llen(queue)
+        for priority in range(1, 10):
+            pipe.llen('{}{}{}'.format(queue, PRIORITY_SEP, priority))
+        return sum(pipe.execute())
+    except RedisError as e:
+        print(e)
+        print('statistics_jobs: Redis port may be closed, queue length '
+              'unknown.')
+        return 0
@@ -0,0 +1,261 @@
+"""
+Completion notifications of background tasks, so that clients need not
+poll their status.
+
+When a task of NOTIFIED_TASKS finishes, the task_postrun signal publishes its
+final state on the task's Redis channel, which Server-Sent Events streams
+wait on, and queues a POST to every webhook given with the request. Webhook
+bodies are signed with an HMAC-SHA256 of the app's SECRET_KEY in the
+X-Signature header, so that receivers can check where they come from.
+Webhooks are POSTed by the workers, inside the deployment's network, so
+only hosts resolving to public addresses are called. Since a host may
+resolve elsewhere by the time it is called, the address each connection is
+actually made to is checked too, before the TLS handshake and anything is
+sent, and redirects are not followed.
+"""
+import hmac
+import json
+import socket
+import hashlib
+import ipaddress
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import VerifiedHTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from celery.signals import task_postrun
+from flask import current_app
+from kombu.exceptions import OperationalError
+from redis import RedisError
+from . import celery, redis_store
+
+TASK_CHANNEL = 'task_done:{}'
+WEBHOOKS_KEY = 'task_webhooks:{}'
+# Tasks whose id is returned to clients, chunks of a chord are not
+NOTIFIED_TASKS = ('app.api_0_1.machine_posts.async_statistics',
+                  'app.api_0_1.machine_posts.merge_statistics',
+                  'app.api_0_1.machine_posts.async_correlation',
+                  'app.api_0_1.machine_posts.async_spectrum')
+
+
+def public_address(address):
+    """
+    Args:
+        address: IP address, as a string
+
+    Returns:
+        False if the address is private, loopback, link-local or otherwise
+        not routable, else True
+    """
+    # Drops the scope of IPv6 link-local addresses, e.g. fe80::1%eth0
+    ip = ipaddress.ip_address(address.split('%')[0])
+    return not (ip.is_private or ip.is_loopback or ip.is_link_local or
+                ip.is_reserved or ip.is_multicast or ip.is_unspecified)
+
+
+def public_host(host):
+    """
+    Args:
+        host: host name or IP address
+
+    Returns:
+        True if every address the host resolves to is public, False if one
+        is not, or if the host does not resolve
+    """
+    try:
+        addresses = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(public_address(address[4][0])
+                                   for address in addresses)
+
+
+def valid_webhook(url):
+    """
+    Args:
+        url: webhook URL given by a client
+
+    Returns:
+        True if url is an absolute https URL of a public host
+    """
+    try:
+        parsed = urlparse(url)
+        host = parsed.hostname
+    except ValueError:
+        return False
+    return parsed.scheme == 'https' and bool(host) and public_host(host)
+
+
+class PublicHTTPSConnection(VerifiedHTTPSConnection):
+    """
+    HTTPS connection refusing to go on once connected to an address that is
+    not public, whatever the host name resolved to when it was checked
+    """
+
+    def _new_conn(self):
+        sock = super()._new_conn()
+        peer = sock.getpeername()[0]
+        if not public_address(peer):
+            sock.close()
+            raise NewConnectionError(self, 'Refused to call {}, it resolved '
+                                           'to {}.'.format(self.host, peer))
+        return sock
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    """Pool of PublicHTTPSConnection"""
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicHTTPSAdapter(HTTPAdapter):
+    """Transport adapter only connecting to public addresses over https"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'https': PublicHTTPSConnectionPool}
+
+
+def webhook_session():
+    """
+    Returns:
+        requests Session for calling webhooks, which only connects to
+        public addresses over https, and ignores the proxies of the
+        environment so that the connected address is the webhook's
+    """
+    session = requests.Session()
+    session.trust_env = False
+    # Plain http URLs then raise InvalidSchema
+    del session.adapters['http://']
+    session.mount('https://', PublicHTTPSAdapter())
+    return session
+
+
+def add_webhook(task_id, url, location):
+    """
+    Registers a webhook called when a task finishes
+
+    Args:
+        task_id: id of the task
+        url: URL POSTed to
+        location: URL of the task's status, sent to the webhook
+    """
+    key = WEBHOOKS_KEY.format(task_id)
+    try:
+        pipe = redis_store.pipeline()
+        pipe.sadd(key, json.dumps({'url': url, 'location': location}))
+        pipe.expire(key, current_app.config['STATISTICS_INFLIGHT_TTL'])
+        pipe.execute()
+    except RedisError as e:
+        print(e)
+        print('task_events: Redis port may be closed, webhook not '
+              'registered.')
+
+
+def event(task_id, state, status=None):
+    """
+    Returns:
+        payload of the notification of a finished task
+    """
+    return {'task_id': task_id, 'state': state, 'status': status}
+
+
+def notify(task_id, state, status=None):
+    """
+    Publishes that a task is done and calls its webhooks
+
+    Args:
+        task_id: id of the task
+        state: final Celery state of the task
+        status: HTTP status of the task's response, if any
+    """
+    payload = event(task_id, state, status)
+    key = WEBHOOKS_KEY.format(task_id)
+    try:
+        redis_store.publish(TASK_CHANNEL.format(task_id), json.dumps(payload))
+        pipe = redis_store.pipeline()
+        pipe.smembers(key)
+        pipe.delete(key)
+        webhooks, _ = pipe.execute()
+    except RedisError as e:
+        print(e)
+        print('task_events: Redis port may be closed, task completion not '
+              'notified.')
+        return
+    for webhook in webhooks:
+        webhook = json.loads(webhook.decode('utf-8'))
+        try:
+            deliver_webhook.delay(webhook['url'], dict(
+                payload, location=webhook['location']))
+        except OperationalError as e:
+            print(e)
+            print('task_events: Celery broker may be down, webhook not '
+                  'called.')
+
+
+def subscribe(task_id):
+    """
+    Returns:
+        Redis pub/sub subscribed to the notifications of a task
+
+    Raises:
+        RedisError if Redis cannot be reached
+    """
+    pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(TASK_CHANNEL.format(task_id))
+    return pubsub
+
+
+def signature(body):
+    """
+    Args:
+        body: bytes of a webhook's body
+
+    Returns:
+        hex HMAC-SHA256 of the body, keyed by SECRET_KEY
+    """
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'), body,
+                    hashlib.sha256).hexdigest()
+
+
+@task_postrun.connect
+def task_finished(sender=None, task_id=None, state=None, retval=None,
+                  **kwargs):
+    """Notifies the end of the tasks of NOTIFIED_TASKS"""
+    if sender is None or sender.name not in NOTIFIED_TASKS:
+        return
+    status = retval.get('status') if isinstance(retval, dict) else None
+    notify(task_id, state, status)
+
+
+@celery.task(bind=True, ignore_result=True)
+def deliver_webhook(self, url, payload):
+    """
+    POSTs the notification of a finished task to a webhook, retried with a
+    growing delay if the webhook fails
+
+    Args:
+        url: URL of the webhook
+        payload: notification, with the location of the task's status
+    """
+    if not valid_webhook(url):
+        # The host may resolve elsewhere since it was registered
+        print('task_events: webhook {} no longer resolves to a public '
+              'address, not called.'.format(url))
+        return
+    body = json.dumps(payload).encode('utf-8')
+    try:
+        with webhook_session() as session:
+            response = session.post(
+                url, data=body,
+                timeout=current_app.config['WEBHOOK_TIMEOUT_S'],
+                allow_redirects=False,
+                headers={'Content-Type': 'application/json',
+                         'X-Signature': 'sha256=' + signature(body)})
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(e)
+        if self.request.retries < current_app.config['WEBHOOK_MAX_RETRIES']:
+            raise self.retry(countdown=2 ** self.request.retries * 10)
+        print('task_events: giving up on webhook {}.'.format(url))
@@ -0,0 +1,398 @@
+"""
+Redis time-series cache of machine samples.
+
+Samples are kept in one sorted set per machine, scored by their epoch, so a
+window of data is a single ZRANGEBYSCORE and trimming old samples is a single
+ZREMRANGEBYSCORE instead of one key per second.
+
+Seconds without data are normal, so a missing second does not tell whether
+the window was read from the database. Once a block of TIMESERIES_BLOCK_S
+seconds is, a loaded marker scored by the start of the block is added to the
+same sorted set, so that it is evicted, cleared or trimmed along with the
+samples, and the block is served from the cache from then on. Markers are
+not JSON objects, which is how they are told apart from the samples.
+"""
+import json
+import time
+import uuid
+from flask import current_app
+from .exceptions import CursorExpired
+
+LOADED_MARKER = 'loaded:{}'
+
+# Refuses a second sample for an already cached second, loaded markers aside,
+# then trims samples older than the retention cutoff. KEYS[1]: sorted set,
+# ARGV: score, member, cutoff
+ADD_SAMPLE_SCRIPT = """
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1],
+                                   ARGV[1])) do
+    if string.sub(member, 1, 1) == '{' then
+        return 0
+    end
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[3])
+return 1
+"""
+
+# Replaces the latest sample if the new one is more recent, and pushes it on
+# the capped list of recent samples. KEYS[1]: hash, KEYS[2]: list,
+# ARGV: score, member, list length, then the hash's field/value pairs
+SET_LATEST_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], '_epoch'))
+if current and current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HMSET', KEYS[1], '_epoch', ARGV[1], unpack(ARGV, 4))
+redis.call('LPUSH', KEYS[2], ARGV[2])
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[3]) - 1)
+return 1
+"""
+
+# Appends a sample to the ingest log under the next sequence number. The
+# sequence lives in the same hash as the log's generation, so if Redis loses
+# it a new generation starts and older cursors are refused. KEYS[1]: meta
+# hash, KEYS[2]: log sorted set, ARGV: sample, new generation, log length
+APPEND_LOG_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], 'generation', ARGV[2]) == 1 then
+    redis.call('DEL', KEYS[2])
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+redis.call('ZADD', KEYS[2], seq,
+           '{"cursor":' .. seq .. ',"sample":' .. ARGV[1] .. '}')
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[3]) - 1)
+return seq
+"""
+
+
+class TimeSeriesCache():
+    """
+    Sorted set of JSON encoded samples, scored by the sample's epoch. The key
+    starts with the flask_caching prefix so cache.clear() also clears it.
+
+    The most recent sample is also kept in a hash, along with a capped list
+    of the most recent samples, so that reading them is O(1).
+
+    Attributes:
+        redis: Redis client used for the sorted set
+        key: Redis key of the sorted set
+        latest_key: Redis key of the hash holding the latest sample
+        recent_key: Redis key of the list of recent samples, newest first
+        channel: pub/sub channel every ingested sample is published on
+        log_key: Redis key of the ingest log, a sorted set of samples scored
+        by the sequence number they were ingested with
+        log_meta_key: Redis key of the hash holding the ingest log's
+        generation and last sequence number
+    """
+
+    def __init__(self, redis, key='fcache_timeseries:machine',
+                 latest_key='fcache_latest:machine',
+                 recent_key='fcache_recent:machine',
+                 channel='timeseries:machine',
+                 log_key='ingest_log:machine',
+                 log_meta_key='ingest_log_meta:machine'):
+        self.redis = redis
+        self.key = key
+        self.latest_key = latest_key
+        self.recent_key = recent_key
+        self.channel = channel
+        self.log_key = log_key
+        self.log_meta_key = log_meta_key
+        self._add_sample = redis.register_script(ADD_SAMPLE_SCRIPT)
+        self._set_latest = redis.register_script(SET_LATEST_SCRIPT)
+        self._append_log = redis.register_script(APPEND_LOG_SCRIPT)
+
+    @staticmethod
+    def retention_cutoff():
+        """
+        Returns:
+            epoch before which samples are no longer kept in the cache
+        """
+        return time.time() - current_app.config['REDIS_CACHE_TIMEOUT']
+
+    @staticmethod
+    def encode(sample):
+        """
+        Args:
+            sample: sample as returned by Machine.to_json()
+
+        Returns:
+            the sorted set member for that sample
+        """
+        return json.dumps(sample, sort_keys=True)
+
+    def add(self, epoch, sample):
+        """
+        Caches a new sample
+
+        Args:
+            epoch: timestamp of the sample, in seconds since epoch
+            sample: sample as returned by Machine.to_json()
+
+        Returns:
+            False if a sample for that second is already cached, else True
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        return bool(self._add_sample(
+            keys=[self.key],
+            args=[epoch, self.encode(sample), self.retention_cutoff()]))
+
+    def add_many(self, samples):
+        """
+        Back-fills the cache with samples read from the database. Samples
+        older than the retention cutoff are skipped.
+
+        Args:
+            samples: list of (epoch, sample) tuples
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        cutoff = self.retention_cutoff()
+        members = []
+        for epoch, sample in samples:
+            if epoch >= cutoff:
+                members.extend((epoch, self.encode(sample)))
+        if members:
+            self.redis.zadd(self.key, *members)
+
+    def range(self, start_epoch, end_epoch):
+        """
+        Reads a window of samples
+
+        Args:
+            start_epoch: Beginning of the window, in seconds since epoch
+            end_epoch: End of the window, in seconds since epoch
+
+        Returns:
+            list of (epoch, sample) tuples, in chronological order
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        members = self.redis.zrangebyscore(
+            self.key, start_epoch, end_epoch, withscores=True)
+        return self.decode_members(members)
+
+    @staticmethod
+    def decode_members(members):
+        """
+        Args:
+            members: (member, score) tuples of the sorted set
+
+        Returns:
+            list of (epoch, sample) tuples, without the loaded markers
+        """
+        return [(score, json.loads(member.decode('utf-8')))
+                for member, score in members if member.startswith(b'{')]
+
+    def range_loaded(self, start_epoch, end_epoch, block_s):
+        """
+        Reads a window of samples and which of its blocks were not loaded
+        from the database, in a single transaction
+
+        Args:
+            start_epoch: Beginning of the window, in seconds since epoch
+            end_epoch: End of the window, in seconds since epoch
+            block_s: size of the blocks, TIMESERIES_BLOCK_S
+
+        Returns:
+            (list of (epoch, sample) tuples in chronological order, list of
+            the indexes of the blocks not loaded)
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        blocks = range(int(start_epoch) // block_s,
+                       int(end_epoch) // block_s + 1)
+        pipe = self.redis.pipeline()
+        pipe.zrangebyscore(self.key, start_epoch, end_epoch, withscores=True)
+        for block in blocks:
+            pipe.zscore(self.key, LOADED_MARKER.format(block))
+        results = pipe.execute()
+        return (self.decode_members(results[0]),
+                [block for block, score in zip(blocks, results[1:])
+                 if score is None])
+
+    def mark_loaded(self, blocks, block_s):
+        """
+        Marks blocks whose samples were all added to the cache. Blocks
+        starting before the retention cutoff are not, since their oldest
+        samples are trimmed.
+
+        Args:
+            blocks: indexes of the blocks
+            block_s: size of the blocks, TIMESERIES_BLOCK_S
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        cutoff = self.retention_cutoff()
+        members = []
+        for block in blocks:
+            if block * block_s >= cutoff:
+                members.extend((block * block_s, LOADED_MARKER.format(block)))
+        if members:
+            self.redis.zadd(self.key, *members)
+
+    def remove(self, sample):
+        """
+        Drops a cached sample, e.g. if the database refused it. Only the
+        sample's member is removed, not the loaded marker of its block.
+
+        Args:
+            sample: sample as returned by Machine.to_json(), as it was added
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        self.redis.zrem(self.key, self.encode(sample))
+
+    def set_latest(self, epoch, sample):
+        """
+        Makes sample the latest one, unless a more recent sample is known
+
+        Args:
+            epoch: timestamp of the sample, in seconds since epoch
+            sample: sample as returned by Machine.to_json()
+
+        Returns:
+            True if sample is now the latest sample
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        fields = []
+        for field, value in sample.items():
+            fields.extend((field, json.dumps(value)))
+        return bool(self._set_latest(
+            keys=[self.latest_key, self.recent_key],
+            args=[epoch, self.encode(sample),
+                  current_app.config['LATEST_SAMPLES_KEPT']] + fields))
+
+    def latest(self):
+        """
+        Returns:
+            the latest sample, or None if no sample was ingested yet
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        fields = self.redis.hgetall(self.latest_key)
+        fields.pop(b'_epoch', None)
+        if not fields:
+            return None
+        return {field.decode('utf-8'): json.loads(value.decode('utf-8'))
+                for field, value in fields.items()}
+
+    def recent(self, count):
+        """
+        Args:
+            count: number of samples, at most LATEST_SAMPLES_KEPT are kept
+
+        Returns:
+            list of the most recent samples, newest first
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        return [json.loads(member.decode('utf-8')) for member
+                in self.redis.lrange(self.recent_key, 0, count - 1)]
+
+    def publish(self, sample):
+        """
+        Fans a newly ingested sample out to the live subscribers
+
+        Args:
+            sample: sample as returned by Machine.to_json()
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        self.redis.publish(self.channel, self.encode(sample))
+
+    def subscribe(self):
+        """
+        Returns:
+            PubSub subscribed to the ingested samples, to be closed by the
+            caller
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        return pubsub
+
+    def append_log(self, sample):
+        """
+        Appends an ingested sample to the ingest log. Samples are logged in
+        the order they are ingested, whatever their datetime.
+
+        Args:
+            sample: sample as returned by Machine.to_json()
+
+        Returns:
+            the sequence number the sample was logged with
+
+        Raises:
+            RedisError if Redis cannot be reached
+        """
+        return self._append_log(
+            keys=[self.log_meta_key, self.log_key],
+            args=[self.encode(sample), uuid.uuid4().hex,
+                  current_app.config['INGEST_LOG_MAX']])
+
+    def changes_since(self, cursor, limit):
+        """
+        Reads the samples ingested after a cursor. Cursors are of the form
+        '<generation>.<sequence number>', '0' starts at the oldest sample
+        still in the log.
+
+        Args:
+            cursor: cursor returned by a previous call, or '0'
+            limit: maximum number of samples returned
+
+        Returns:
+            (samples, next cursor) tuple
+
+        Raises:
+            CursorExpired if the cursor is malformed, from another
+            generation of the log, or older than the oldest logged sample
+            RedisError if Redis cannot be reached
+        """
+        meta = self.redis.hgetall(self.log_meta_key)
+        generation = meta.get(b'generation', b'').decode('utf-8')
+        last_seq = int(meta.get(b'seq', 0))
+        if cursor == '0':
+            seq = 0
+        else:
+            try:
+                cursor_generation, seq = cursor.split('.')
+                seq = int(seq)
+            except ValueError:
+                raise CursorExpired('Malformed cursor.')
+            if cursor_generation != generation or seq > last_seq:
+                raise CursorExpired('The ingest log was reset.')
+
+        members = self.redis.zrangebyscore(
+            self.log_key, '({}'.format(seq), '+inf', start=0, num=limit)
+        if cursor != '0' and seq < last_seq:
+            oldest = self.redis.zrange(self.log_key, 0, 0, withscores=True)
+            if not oldest or oldest[0][1] > seq + 1:
+                raise CursorExpired('Samples after this cursor were '
+                                    'dropped from the ingest log.')
+
+        if cursor == '0' and not members:
+            seq = last_seq
+        samples = []
+        for member in members:
+            entry = json.loads(member.decode('utf-8'))
+            samples.append(entry['sample'])
+            seq = entry['cursor']
+        if not generation:
+            return samples, '0'
+        return samples, '{}.{}'.format(generation, seq)
@@ -0,0 +1,52 @@
+"""
+Revocation of API tokens.
+
+API tokens are signed and carry the claims the API authorizes with (user id,
+scopes), so verifying one needs no query beyond the cached user row, see
+User.verify_auth_token. What the signature cannot tell is whether a token
+was revoked before it expires, which is kept in Postgres so that it survives
+Redis evictions and restarts:
+
+- a single token is revoked by storing its jti claim in revoked_token until
+  it expires;
+- every token of a user issued before a time is revoked by storing that
+  time in user.tokens_revoked_before, which also happens whenever the
+  user's credentials change.
+
+Both are read through the per-worker user cache, invalidated when they
+change.
+"""
+import time
+from . import db
+from .models import User, RevokedToken
+
+
+def revoke_token(claims):
+    """
+    Revokes a token until it expires, and forgets the expired revocations
+    of its user
+
+    Args:
+        claims: verified claims of the token
+    """
+    now = time.time()
+    RevokedToken.query.filter(RevokedToken.user_id == claims['id'],
+                              RevokedToken.expires < now).delete()
+    if claims['expires'] > now:
+        db.session.add(RevokedToken(jti=claims['jti'], user_id=claims['id'],
+                                    expires=claims['expires']))
+    db.session.commit()
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revokes every token issued so far to a user
+
+    Args:
+        user_id: id of the user
+    """
+    user = User.query.get(user_id)
+    if user is not None:
+        # Through the ORM, so that the cached rows are invalidated
+        user.tokens_revoked_before = time.time()
+        db.session.commit()
@@ -0,0 +1,49 @@
+"""
+Bound on the requests of a worker process that wait on events: Server-Sent
+Events streams and long-polls.
+
+A waiting request holds a thread of a threaded worker, 32 of which are shared
+with every other request, so MAX_WAITING_REQUESTS of them at most may wait
+at once and the others are refused with a 503 and a Retry-After. In the async
+serving mode, a waiting request is a greenlet and the bound is much higher.
+"""
+import threading
+from flask import current_app
+
+
+class WaitSlots():
+    """
+    Count of the waiting requests of the process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._used = 0
+
+    def acquire(self):
+        """
+        Takes a slot if fewer than MAX_WAITING_REQUESTS are taken
+
+        Returns:
+            True if a slot was taken and must be released, False otherwise
+        """
+        with self._lock:
+            if self._used >= current_app.config['MAX_WAITING_REQUESTS']:
+                return False
+            self._used += 1
+            return True
+
+    def release(self):
+        """
+        Gives back a slot taken by acquire
+        """
+        with self._lock:
+            self._used = max(0, self._used - 1)
+
+    def used(self):
+        """
+        Returns:
+            number of slots taken
+        """
+        with self._lock:
+            return self._used
@@ -0,0 +1 @@
+"""Benchmarks that are run against the live services, see manage.py"""
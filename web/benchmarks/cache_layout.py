@@ -0,0 +1,123 @@
+"""
+Compares range reads of the one-key-per-second cache layout with the sorted
+set layout used by app.timeseries. Runs against a real Redis server, using
+keys under the 'benchmark:' prefix which are removed afterwards.
+"""
+import json
+import time
+import pickle
+import statistics
+from app.timeseries import TimeSeriesCache
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+KEY_PREFIX = 'benchmark:'
+
+
+def make_sample(epoch):
+    """
+    Args:
+        epoch: timestamp of the sample
+
+    Returns:
+        a sample shaped like Machine.to_json()
+    """
+    return {'datetime': time.strftime(TIME_FORMAT, time.gmtime(epoch)),
+            'sensor_1': str(epoch % 100)}
+
+
+def populate(redis, series, first_epoch, samples):
+    """
+    Writes the same samples in both layouts
+
+    Args:
+        redis: Redis client
+        series: TimeSeriesCache to fill
+        first_epoch: timestamp of the first sample
+        samples: number of one second samples to write
+    """
+    pipe = redis.pipeline(transaction=False)
+    members = []
+    for epoch in range(first_epoch, first_epoch + samples):
+        sample = make_sample(epoch)
+        # flask_caching pickles values under '<prefix><datetime>'
+        pipe.set(KEY_PREFIX + sample['datetime'], pickle.dumps(sample))
+        members.extend((epoch, series.encode(sample)))
+        if len(members) >= 2000:
+            pipe.zadd(series.key, *members)
+            members = []
+            pipe.execute()
+    if members:
+        pipe.zadd(series.key, *members)
+    pipe.execute()
+
+
+def read_per_key(redis, start_epoch, end_epoch):
+    """
+    Reads a window the way get_post used to, one GET per second
+
+    Returns:
+        list of samples
+    """
+    data = []
+    for epoch in range(start_epoch, end_epoch + 1):
+        value = redis.get(KEY_PREFIX + time.strftime(
+            TIME_FORMAT, time.gmtime(epoch)))
+        if value is not None:
+            data.append(pickle.loads(value))
+    return data
+
+
+def read_sorted_set(series, start_epoch, end_epoch):
+    """
+    Reads a window with a single ZRANGEBYSCORE
+
+    Returns:
+        list of samples
+    """
+    return [sample for _, sample in series.range(start_epoch, end_epoch)]
+
+
+def timed(function, repeats, *args):
+    """
+    Returns:
+        (median seconds per call, result of the last call)
+    """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+
+def run(redis, samples, window, repeats):
+    """
+    Populates both layouts, then times reads of windows of the given size
+
+    Args:
+        redis: Redis client
+        samples: number of one second samples to store
+        window: size of the windows read, in seconds
+        repeats: number of reads timed for each layout
+    """
+    series = TimeSeriesCache(redis, key=KEY_PREFIX + 'timeseries')
+    first_epoch = 1500000000
+    try:
+        populate(redis, series, first_epoch, samples)
+        start_epoch = first_epoch + (samples - window) // 2
+        end_epoch = start_epoch + window - 1
+        per_key, keyed = timed(read_per_key, repeats, redis,
+                               start_epoch, end_epoch)
+        sorted_set, ranged = timed(read_sorted_set, repeats, series,
+                                   start_epoch, end_epoch)
+        assert json.dumps(keyed, sort_keys=True) == \
+            json.dumps(ranged, sort_keys=True)
+        print('{} samples stored, {} second window, median of {} reads'
+              .format(samples, window, repeats))
+        print('per-key GETs:     {:9.2f} ms'.format(per_key * 1000))
+        print('ZRANGEBYSCORE:    {:9.2f} ms'.format(sorted_set * 1000))
+        print('speedup:          {:9.1f}x'.format(per_key / sorted_set))
+    finally:
+        keys = list(redis.scan_iter(match=KEY_PREFIX + '*', count=5000))
+        for index in range(0, len(keys), 5000):
+            redis.delete(*keys[index:index + 5000])
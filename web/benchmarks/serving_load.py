@@ -0,0 +1,192 @@
+"""
+Compares how deployments of the API in the threaded and async serving modes
+(see docker_setup.sh) hold up under many concurrent devices.
+
+For each target, `clients` devices post one sample after another, signed
+with a device key, for `duration` seconds, while `readers` clients read
+windows old enough to miss the Redis cache and hit Postgres. Throughput,
+latency percentiles and status codes of the posts are printed side by side.
+A threaded worker is saturated once every thread waits on a slow read, the
+async worker keeps posting.
+
+Samples are posted at datetimes of the year 2000, so run it against
+a test deployment. The limits of the device key and of the readers must be
+raised in RATE_LIMIT_PRINCIPALS, else most requests get a 429.
+"""
+import time
+import random
+import itertools
+import threading
+from base64 import b64encode
+from urllib.parse import urlparse
+import requests
+from app.device_keys import sign
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FIRST_EPOCH = 946684800
+YEAR_S = 365 * 24 * 3600
+
+
+class Recorder():
+    """
+    Latencies and status codes of the requests of one kind, shared by the
+    client threads
+
+    Attributes:
+        latencies: seconds taken by each request
+        statuses: dict of status code, or error name, to count
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency, status):
+        """
+        Args:
+            latency: seconds taken by the request
+            status: its status code, or the name of the error
+        """
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def percentile(self, percent):
+        """
+        Returns:
+            latency of the given percentile, in milliseconds
+        """
+        if not self.latencies:
+            return float('nan')
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100.0))
+        return ordered[index] * 1000
+
+
+def post_samples(api_url, key_id, secret, deadline, epochs, recorder):
+    """
+    Posts signed samples until the deadline, as a device would
+
+    Args:
+        api_url: URL of the API, ending in /api/v0.1
+        key_id: id of the device key
+        secret: secret of the device key
+        deadline: time.time() when to stop
+        epochs: itertools.count of the sample timestamps, shared by the
+        threads; its next() is atomic under the GIL
+        recorder: Recorder of the posts
+    """
+    url = api_url + '/posts/'
+    path = urlparse(url).path
+    session = requests.Session()
+    while time.time() < deadline:
+        epoch = next(epochs)
+        body = '{{"datetime": "{}", "sensor_1": "{}"}}'.format(
+            time.strftime(TIME_FORMAT, time.gmtime(epoch)),
+            random.uniform(0, 100)).encode('utf-8')
+        timestamp = int(time.time())
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'X-Device-Key': key_id,
+            'X-Timestamp': str(timestamp),
+            'X-Signature': sign(secret, timestamp, 'POST', path, '', body)}
+        start = time.perf_counter()
+        try:
+            status = session.post(url, data=body, headers=headers,
+                                  timeout=60).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        recorder.record(time.perf_counter() - start, status)
+
+
+def read_windows(api_url, credentials, deadline, window, recorder):
+    """
+    Reads random uncached windows until the deadline
+
+    Args:
+        api_url: URL of the API, ending in /api/v0.1
+        credentials: 'email:password' of a user
+        deadline: time.time() when to stop
+        window: size of the windows, in seconds
+        recorder: Recorder of the reads
+    """
+    session = requests.Session()
+    session.headers['Authorization'] = 'Basic ' + b64encode(
+        credentials.encode('utf-8')).decode('utf-8')
+    while time.time() < deadline:
+        start_epoch = FIRST_EPOCH + random.randrange(YEAR_S - window)
+        url = '{}/posts/{}/{}'.format(
+            api_url,
+            time.strftime(TIME_FORMAT, time.gmtime(start_epoch)),
+            time.strftime(TIME_FORMAT, time.gmtime(start_epoch + window - 1)))
+        start = time.perf_counter()
+        try:
+            status = session.get(url, timeout=60).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        recorder.record(time.perf_counter() - start, status)
+
+
+def load(api_url, key_id, secret, clients, duration, readers, credentials,
+         window):
+    """
+    Runs the load against one deployment
+
+    Returns:
+        (Recorder of the posts, Recorder of the reads)
+    """
+    # Consecutive seconds from a random start, so that runs do not collide
+    epochs = itertools.count(FIRST_EPOCH + random.randrange(YEAR_S // 2))
+    posts = Recorder()
+    reads = Recorder()
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=post_samples,
+                                args=(api_url, key_id, secret, deadline,
+                                      epochs, posts))
+               for _ in range(clients)]
+    if credentials:
+        threads.extend(threading.Thread(target=read_windows,
+                                        args=(api_url, credentials, deadline,
+                                              window, reads))
+                       for _ in range(readers))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return posts, reads
+
+
+def run(targets, key_id, secret, clients, duration, readers=0,
+        credentials=None, window=1800):
+    """
+    Loads every target in turn and prints the results side by side
+
+    Args:
+        targets: list of (label, URL of the API ending in /api/v0.1)
+        key_id: id of a device key of the targets
+        secret: secret of the device key
+        clients: number of devices posting concurrently
+        duration: seconds each target is loaded for
+        readers: number of clients reading uncached windows meanwhile
+        credentials: 'email:password' of the readers, no readers if None
+        window: size of the windows read, in seconds
+    """
+    results = []
+    for label, api_url in targets:
+        print('Loading {} ({}) for {} s...'.format(label, api_url, duration))
+        results.append((label, load(api_url.rstrip('/'), key_id, secret,
+                                    clients, duration, readers, credentials,
+                                    window)))
+    print('{} devices posting, {} readers, {} s per target'.format(
+        clients, readers if credentials else 0, duration))
+    print('{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}  {}'.format(
+        'target', 'posts/s', 'p50 ms', 'p95 ms', 'p99 ms', 'reads/s',
+        'post statuses'))
+    row = '{:<12}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}  {}'
+    for label, (posts, reads) in results:
+        print(row.format(label, len(posts.latencies) / duration,
+                         posts.percentile(50), posts.percentile(95),
+                         posts.percentile(99),
+                         len(reads.latencies) / duration, posts.statuses))
@@ -6,7 +6,7 @@ import sys
 import logging
 import json
 from datetime import timedelta as td
-from celery.task.control import rate_limit
+from kombu import Queue
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -15,13 +15,129 @@ class Config(object):
     Sets Config defaults
 
     Attributes:
-        SECRET_KEY: Gets the secret key for Config.
+        SECRET_KEY: Gets the secret key for Config. Device key secrets are
+        derived from it, so changing it changes them, see app.device_keys.
         TRAP_BAD_REQUEST_ERRORS: Establishes that
         bad request errors will be trapped, i.e. TRUE.
         SQLALCHEMY_COMMIT_ON_TEARDOWN: Establishes that
         upon teardown SQLAlchemy will commit.
+        SQLALCHEMY_POOL_SIZE: Postgres connections kept open by each
+        process, shared by its threads or greenlets.
+        SQLALCHEMY_MAX_OVERFLOW: Connections opened above the pool size
+        under load.
+        SQLALCHEMY_POOL_TIMEOUT: Longest a request waits for a connection.
         POSTS_PER_PAGE: Maximum posts per page.
         REDIS_CACHE_TIMEOUT: Time limit for the Redis cache.
+        REDIS_URL: Redis server used for counters, sorted sets and pub/sub.
+        WINDOW_VERSION_BUCKET_S: Size of the buckets that data versions
+        are tracked in, used to build ETags for windows of data.
+        WINDOW_CLOSE_DELAY_S: Age after which a window of data is
+        considered closed, i.e. no longer receiving live data.
+        TIMESERIES_BLOCK_S: Size of the blocks of the Redis cache of
+        samples that are loaded from the database at once.
+        LOCAL_CACHE_MAX_SAMPLES: Samples kept in each worker's memory.
+        LOCAL_CACHE_TTL_S: Seconds a sample is kept in a worker's memory.
+        LATE_SAMPLE_DELAY_S: Samples arriving later than this after their
+        datetime are late, and invalidate the workers' memory caches.
+        LATEST_SAMPLES_KEPT: Number of recent samples served from Redis by
+        the latest sample endpoint.
+        SSE_KEEPALIVE_S: Interval of the keep-alive and status events sent
+        on Server-Sent Events streams.
+        MAX_WAITING_REQUESTS: Server-Sent Events streams and long-polls
+        each worker process serves at once, more get a 503. Each holds a
+        thread in the threaded serving mode, a greenlet in the async one.
+        WAITING_RETRY_AFTER_S: Retry-After of the refused waiting requests.
+        INGEST_LOG_MAX: Number of ingested samples kept in the ingest log
+        that the changes since endpoint reads from.
+        LONG_POLL_MAX_TIMEOUT_S: Longest a long-poll request may wait.
+        MAX_QUERY_WINDOWS: Maximum number of windows of a batch query.
+        MAX_QUERY_TOTAL_S: Maximum seconds of data of a batch query.
+        SQLALCHEMY_BINDS: Read replicas of the database, as replica_<n>
+        binds, from the optional FLASK_READ_REPLICA_DATABASES secret.
+        READ_REPLICA_BINDS: Bind keys of the read replicas.
+        REPLICA_MAX_LAG_S: Replicas lagging more than this are not read
+        from, users who wrote this recently read from the primary.
+        REPLICA_LAG_CHECK_S: Interval of the replication lag checks.
+        MAX_GAP_QUERY_S: Longest window the gaps endpoint accepts.
+        GAP_CACHE_TIMEOUT: Time the gaps of a closed day are cached for.
+        STATISTICS_RESERVOIR_SIZE: Values sampled per sensor to compute
+        percentiles, windows with fewer values get exact percentiles.
+        STATISTICS_PERCENTILES: Percentiles returned by statistics.
+        STATISTICS_SKETCH_ACCURACY: Relative error of the percentiles of
+        the rollups, changing it requires rebuilding the rollups.
+        STATISTICS_SKETCH_MIN_VALUE: Smaller sensor values count as zero in
+        the percentiles of the rollups.
+        STATISTICS_SKETCH_PERCENTILES: Default percentiles of the rollups.
+        ROLLUP_FLUSH_DELAY_S: Age after which a minute's rollup is written
+        from Redis to the database.
+        ROLLUP_FLUSH_LOCK_S: Longest a rollup flush may hold its lock.
+        STATISTICS_RESULT_CLOSED_TTL: Time statistics of a closed window
+        are cached for.
+        STATISTICS_RESULT_OPEN_TTL: Time statistics of an open window are
+        cached for.
+        STATISTICS_INFLIGHT_TTL: Time identical statistics requests share
+        a running task for.
+        STATISTICS_CHUNK_S: Longer statistics windows are split into chunks
+        of this many seconds, computed in parallel.
+        STATISTICS_MAX_WINDOW_S: Longest window of raw statistics.
+        STATISTICS_TIME_LIMIT_BASE_S: Soft time limit of a statistics task,
+        plus STATISTICS_TIME_LIMIT_PER_HOUR_S per hour of its window.
+        STATISTICS_TIME_LIMIT_GRACE_S: Time between the soft and the hard
+        time limit of a statistics task.
+        STATISTICS_QUEUE_MAX: Queue length above which new statistics tasks
+        are refused.
+        STATISTICS_INTERACTIVE_MAX_S: Longest statistics window run on the
+        interactive queue, longer ones run on the batch queue.
+        CELERY_QUEUES: interactive for requests users wait on, batch for
+        long computations and maintenance for housekeeping, each consumed
+        by its own worker service.
+        CELERY_ROUTES: Queue of each task, tasks sent with an explicit queue
+        override it.
+        BROKER_TRANSPORT_OPTIONS: Gives each queue priorities 0 to 9, on the
+        Redis broker 0 is consumed first.
+        CORRELATION_MAX_LAG_S: Longest lag between correlated sensors.
+        CORRELATION_MAX_LAGS: Most lags of a correlation request.
+        CORRELATION_CACHE_TIMEOUT: Time the co-moments of a closed day are
+        cached for.
+        SPECTRUM_SEGMENT_S: Default length of the Welch segments.
+        SPECTRUM_MAX_SEGMENT_S: Longest Welch segment.
+        SPECTRUM_PEAKS: Dominant frequencies returned per sensor.
+        TASK_EVENTS_MAX_S: Longest a task's event stream stays open.
+        WEBHOOK_TIMEOUT_S: Timeout of a call to a webhook.
+        WEBHOOK_MAX_RETRIES: Retries of a failed webhook, with a growing
+        delay.
+        CREDENTIAL_CACHE_TTL_S: Time verified API credentials are cached
+        for by each worker.
+        CREDENTIAL_CACHE_MAX: Most credentials cached by each worker.
+        USER_CACHE_TTL_S: Time User rows are cached for by each worker.
+        USER_CACHE_MAX: Most User rows cached by each worker.
+        API_TOKEN_SCOPES: Scopes an API token can grant, read for GET and
+        HEAD requests, write for the others.
+        API_TOKEN_EXPIRATION: Default lifetime of an API token.
+        API_TOKEN_MAX_EXPIRATION: Longest lifetime of an API token.
+        DEVICE_SIGNATURE_MAX_SKEW_S: Largest difference between the
+        timestamp of a request signed with a device key and the server's
+        clock, also how long its signature is remembered to refuse replays.
+        DEVICE_KEY_CACHE_TTL_S: Time device keys are cached for by each
+        worker.
+        DEVICE_KEY_CACHE_MAX: Most device keys cached by each worker.
+        RATE_LIMITS: Token bucket of each class of API routes, its capacity
+        and the tokens added every second, see app.rate_limit. Every request
+        also takes a token from the ip bucket of its address.
+        RATE_LIMIT_ROUTES: Class of each endpoint, default if not listed.
+        RATE_LIMIT_PRINCIPALS: Limits replacing RATE_LIMITS for some
+        principals, as {'device:<key id>': {'ingest': {...}}} or
+        {'user:<id>': {'read': {...}}}.
+        RESULT_INLINE_MAX_BYTES: Larger task results are stored as files in
+        RESULTS_DIR instead of Redis.
+        RESULTS_DIR: Directory of the result files, shared by the web and
+        worker containers.
+        RESULT_FILE_TTL: Time result files are kept for, longer than the
+        statistics results are cached for.
+        RESULTS_PURGE_INTERVAL_S: Least time between two purges of the result
+        files.
+        STATISTICS_MAX_TASKS_PER_USER: Statistics tasks a user may wait on.
+        STATISTICS_RETRY_AFTER_S: Retry-After of refused statistics tasks.
         LOGGING_FORMAT: Establishes logging format.
         ERROR_LOGGING_LOCATION: Establishes where the errors are logged.
         ERROR_LOGGING_LEVEL: Establishes the error level as WARNING.
@@ -54,6 +170,24 @@ class Config(object):
         print('EXITING.')
         sys.exit(-1)
 
+    # Read replicas are optional, FLASK_READ_REPLICA_DATABASES is a comma
+    # separated list of database URLs
+    SQLALCHEMY_BINDS = {}
+    try:
+        with open('/run/secrets/chamber_of_secrets') as secret_chamber:
+            for line in secret_chamber:
+                if 'FLASK_READ_REPLICA_DATABASES' in line:
+                    # Take the VAL part of ARG=VAL, strip newlines
+                    for replica_uri in line.split("=", 1)[1].rstrip().split(','):
+                        SQLALCHEMY_BINDS['replica_{}'.format(
+                            len(SQLALCHEMY_BINDS))] = replica_uri
+    except OSError as e:
+        print('CANNOT FIND CHAMBER')
+        print(e)
+        print('EXITING.')
+        sys.exit(-1)
+    READ_REPLICA_BINDS = sorted(SQLALCHEMY_BINDS)
+
     PREFERRED_URL_SCHEME = 'https'
     SESSION_COOKIE_SECURE = True
 
@@ -62,10 +196,52 @@ class Config(object):
     CELERY_BROKER_URL = 'redis://redis:6379'
     CELERY_ACKS_LATE = True
     CELERYD_PREFETCH_MULTIPLIER = 1
-    rate_limit = '4/m'
+    CELERY_QUEUES = (Queue('interactive'), Queue('batch'),
+                     Queue('maintenance'))
+    CELERY_DEFAULT_QUEUE = 'batch'
+    CELERY_ROUTES = {
+        'app.api_0_1.machine_posts.async_statistics': {
+            'queue': 'interactive'},
+        'app.api_0_1.machine_posts.statistics_chunk': {
+            'queue': 'interactive'},
+        'app.api_0_1.machine_posts.merge_statistics': {
+            'queue': 'interactive'},
+        'app.api_0_1.machine_posts.async_correlation': {
+            'queue': 'interactive'},
+        'app.api_0_1.machine_posts.async_spectrum': {
+            'queue': 'interactive'},
+        'app.rollups.flush_rollups': {'queue': 'maintenance'},
+        'app.result_store.purge_results': {'queue': 'maintenance'},
+        'app.task_events.deliver_webhook': {'queue': 'maintenance'}}
+    BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10)),
+                                'queue_order_strategy': 'priority'}
+    RATE_LIMITS = {
+        'ingest': {'capacity': 120, 'per_second': 2},
+        'read': {'capacity': 60, 'per_second': 1},
+        'statistics': {'capacity': 20, 'per_second': 0.2},
+        'default': {'capacity': 30, 'per_second': 0.5},
+        'ip': {'capacity': 600, 'per_second': 20}}
+    RATE_LIMIT_ROUTES = {
+        'api_0_1.new_post': 'ingest',
+        'api_0_1.get_posts': 'read',
+        'api_0_1.get_post': 'read',
+        'api_0_1.get_gaps': 'read',
+        'api_0_1.query_posts': 'read',
+        'api_0_1.get_latest_post': 'read',
+        'api_0_1.get_posts_since': 'read',
+        'api_0_1.statistics_of_data': 'statistics',
+        'api_0_1.correlation_of_data': 'statistics',
+        'api_0_1.spectrum_of_data': 'statistics',
+        'api_0_1.statistics_status': 'statistics',
+        'api_0_1.statistics_events': 'statistics',
+        'api_0_1.cancel_statistics': 'statistics'}
+    RATE_LIMIT_PRINCIPALS = {}
 
     TRAP_BAD_REQUEST_ERRORS = True
     SQLALCHEMY_COMMIT_ON_TEARDOWN = False
+    SQLALCHEMY_POOL_SIZE = 20
+    SQLALCHEMY_MAX_OVERFLOW = 20
+    SQLALCHEMY_POOL_TIMEOUT = 10
 
     # Log database requests that take a long time
     SQLALCHEMY_RECORD_QUERIES = True
@@ -75,6 +251,69 @@ class Config(object):
     POSTS_PER_PAGE = 20
     MAX_API_DATA_PER_REQUEST = 1800  # cannot pull more than an hour for API
     REDIS_CACHE_TIMEOUT = 3600 * 24 * 3
+    REDIS_URL = 'redis://redis:6379'
+    WINDOW_VERSION_BUCKET_S = 3600
+    WINDOW_CLOSE_DELAY_S = 300
+    TIMESERIES_BLOCK_S = 600
+    LOCAL_CACHE_MAX_SAMPLES = 3600 * 4
+    LOCAL_CACHE_TTL_S = 120
+    LATE_SAMPLE_DELAY_S = 10
+    LATEST_SAMPLES_KEPT = 60
+    SSE_KEEPALIVE_S = 5
+    # Leaves most of the 32 threads of a threaded worker to other requests
+    MAX_WAITING_REQUESTS = (
+        1000 if os.environ.get('SERVING_MODE') == 'async' else 8)
+    WAITING_RETRY_AFTER_S = 5
+    INGEST_LOG_MAX = 3600 * 24
+    LONG_POLL_MAX_TIMEOUT_S = 25
+    MAX_QUERY_WINDOWS = 1000
+    MAX_QUERY_TOTAL_S = 3600 * 24
+    REPLICA_MAX_LAG_S = 5
+    REPLICA_LAG_CHECK_S = 1
+    MAX_GAP_QUERY_S = 3600 * 24 * 31
+    GAP_CACHE_TIMEOUT = 3600 * 24 * 7
+    STATISTICS_RESERVOIR_SIZE = 100000
+    STATISTICS_PERCENTILES = [5, 25, 50, 75, 95]
+    STATISTICS_SKETCH_ACCURACY = 0.01
+    STATISTICS_SKETCH_MIN_VALUE = 1e-6
+    STATISTICS_SKETCH_PERCENTILES = [50, 95, 99]
+    ROLLUP_FLUSH_DELAY_S = 120
+    ROLLUP_FLUSH_LOCK_S = 60
+    STATISTICS_RESULT_CLOSED_TTL = 3600 * 24 * 30
+    STATISTICS_RESULT_OPEN_TTL = 10
+    STATISTICS_INFLIGHT_TTL = 3600
+    STATISTICS_CHUNK_S = 3600
+    STATISTICS_MAX_WINDOW_S = 3600 * 24 * 31
+    STATISTICS_TIME_LIMIT_BASE_S = 30
+    STATISTICS_TIME_LIMIT_PER_HOUR_S = 10
+    STATISTICS_TIME_LIMIT_GRACE_S = 30
+    STATISTICS_QUEUE_MAX = 1000
+    STATISTICS_INTERACTIVE_MAX_S = 3600 * 24
+    STATISTICS_MAX_TASKS_PER_USER = 3
+    STATISTICS_RETRY_AFTER_S = 30
+    CORRELATION_MAX_LAG_S = 3600
+    CORRELATION_MAX_LAGS = 10
+    CORRELATION_CACHE_TIMEOUT = 3600 * 24 * 7
+    SPECTRUM_SEGMENT_S = 256
+    SPECTRUM_MAX_SEGMENT_S = 4096
+    SPECTRUM_PEAKS = 5
+    TASK_EVENTS_MAX_S = 3600
+    WEBHOOK_TIMEOUT_S = 5
+    WEBHOOK_MAX_RETRIES = 5
+    CREDENTIAL_CACHE_TTL_S = 60
+    CREDENTIAL_CACHE_MAX = 10000
+    USER_CACHE_TTL_S = 300
+    USER_CACHE_MAX = 1000
+    API_TOKEN_SCOPES = ['read', 'write']
+    API_TOKEN_EXPIRATION = 3600
+    API_TOKEN_MAX_EXPIRATION = 3600 * 24
+    DEVICE_SIGNATURE_MAX_SKEW_S = 300
+    DEVICE_KEY_CACHE_TTL_S = 300
+    DEVICE_KEY_CACHE_MAX = 10000
+    RESULT_INLINE_MAX_BYTES = 64 * 1024
+    RESULTS_DIR = os.path.join(BASE_DIR, 'results')
+    RESULT_FILE_TTL = 3600 * 24 * 31
+    RESULTS_PURGE_INTERVAL_S = 3600
     LOGGING_FORMAT = ('%(asctime)s - %(name)s - %(levelname)s - %(message)s '
                       '[in %(pathname)s: line %(lineno)d]')
     ERROR_LOGGING_LOCATION = 'error_log.log'
@@ -236,10 +475,19 @@ class TestingConfig(Config):
         TESTING: Sets TESTING status for error log while Testing (True/False).
         WTF_CSRF_ENABLED: Sets status for CSRF during testing (True or False).
         SQLALCHEMY_DATABASE_URI: Sets the path to the database.
+        SQLALCHEMY_BINDS: No read replicas while testing.
+        READ_REPLICA_BINDS: No read replicas while testing.
+        RESULTS_DIR: Result files of the tests.
+        RATE_LIMITS: Limits the tests do not reach.
     """
     TESTING = True
     WTF_CSRF_ENABLED = False
     CELERY_ALWAYS_EAGER = True
+    SQLALCHEMY_BINDS = {}
+    READ_REPLICA_BINDS = []
+    RESULTS_DIR = os.path.join(BASE_DIR, 'tmp', 'results')
+    RATE_LIMITS = {name: {'capacity': 10000, 'per_second': 1000}
+                   for name in Config.RATE_LIMITS}
     try:
         with open('/run/secrets/chamber_of_secrets') as secret_chamber:
             for line in secret_chamber:
@@ -89,7 +89,20 @@ else
 fi
 
 echo "Running Gunicorn WSGI"
-/usr/local/bin/gunicorn --error-logfile ./error.log --log-file ./info.log --enable-stdio-inheritance --timeout 30 -w 1 -b :8000 manage:app
+GUNICORN_OPTIONS="--error-logfile ./error.log --log-file ./info.log --enable-stdio-inheritance --timeout 30 -w 1 -b :8000"
+case "${SERVING_MODE:-threaded}" in
+	async)
+		# gevent worker: a greenlet per request, so requests waiting on
+		# Postgres or Redis do not hold up the other devices
+		echo "Async serving mode"
+		/usr/local/bin/gunicorn $GUNICORN_OPTIONS -c gunicorn_async.py manage:app
+	;;
+	*)
+		# Threaded worker: each open /viewdata/stream (Server-Sent Events) holds a
+		# thread, so a sync worker would be blocked by a single open dashboard
+		/usr/local/bin/gunicorn $GUNICORN_OPTIONS --worker-class gthread --threads 32 manage:app
+	;;
+esac
 
 
 if [[ $? != 0 ]]; then
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings of the async serving mode, added to the command line
+options of docker_setup.sh when SERVING_MODE is async.
+
+The same Flask app is served by gevent workers: each request is a greenlet,
+and sockets are made cooperative, so a request waiting on Postgres or Redis
+no longer blocks the others and one process holds thousands of device
+connections. psycopg2 waits through gevent once patched by psycogreen.
+Database connections are shared through the SQLAlchemy pool, whose size is
+set by SQLALCHEMY_POOL_SIZE and SQLALCHEMY_MAX_OVERFLOW.
+"""
+# pylint: disable=invalid-name
+import os
+
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('ASYNC_WORKER_CONNECTIONS', 2000))
+
+
+def post_worker_init(worker):
+    """
+    Makes psycopg2 yield to other greenlets while it waits on Postgres,
+    once gevent has patched the worker
+
+    Args:
+        worker: the gunicorn worker
+    """
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    worker.log.info('psycopg2 patched for gevent')
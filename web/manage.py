@@ -15,8 +15,8 @@ if os.environ.get('FLASK_COVERAGE'):  # For checking test coverage
 # These imports must be below the coverage start function, else
 # the coverage misses parts of scripts
 # pylint: disable=wrong-import-position
-from app import create_app, db, celery
-from app.models import User, Machine
+from app import create_app, db, celery, redis_store
+from app.models import User, Machine, DeviceKey
 
 try:
     with open('/run/secrets/chamber_of_secrets') as secret_chamber:
@@ -47,11 +47,14 @@ def make_shell_context():
     Returns:
         dict, takes the data and formats into a dictionary and indexes by keys
     """
-    return dict(app=app, db=db, User=User, Machine=Machine, celery=celery)
+    return dict(app=app, db=db, User=User, Machine=Machine,
+                DeviceKey=DeviceKey, celery=celery)
 
 
+device_manager = Manager(usage='Manage the API keys of devices')
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
+manager.add_command('device', device_manager)
 
 
 # pylint: disable=redefined-outer-name
@@ -82,5 +85,151 @@ def test(coverage=False):
         COV.erase()
 
 
+@manager.command
+def benchmark_cache(samples=86400, window=1800, repeats=20):
+    """
+    Compare window reads of the per-key and sorted set cache layouts
+
+    Args:
+        samples: number of one second samples stored in each layout
+        window: size of the windows read, in seconds
+        repeats: number of reads timed for each layout
+    """
+    from benchmarks import cache_layout
+    cache_layout.run(redis_store, int(samples), int(window), int(repeats))
+
+
+@manager.option('-t', '--targets', dest='targets', required=True,
+                help="Deployments to compare, as "
+                "'threaded=http://host/api/v0.1,async=http://other/api/v0.1'")
+@manager.option('-k', '--key', dest='key_id', required=True,
+                help='Id of the device key posting')
+@manager.option('--secret', dest='secret', required=True,
+                help='Secret of the device key')
+@manager.option('-c', '--clients', dest='clients', default=200,
+                help='Devices posting concurrently')
+@manager.option('-d', '--duration', dest='duration', default=30,
+                help='Seconds each deployment is loaded for')
+@manager.option('-r', '--readers', dest='readers', default=20,
+                help='Clients reading uncached windows meanwhile')
+@manager.option('-u', '--credentials', dest='credentials', default=None,
+                help="'email:password' of the readers, no readers if omitted")
+def benchmark_serving(targets, key_id, secret, clients, duration, readers,
+                      credentials):
+    """
+    Compare the serving modes under concurrent devices posting samples
+
+    Args:
+        targets: comma separated label=URL of the deployments' APIs
+        key_id: Id of the device key posting
+        secret: Secret of the device key
+        clients: Devices posting concurrently
+        duration: Seconds each deployment is loaded for
+        readers: Clients reading uncached windows meanwhile
+        credentials: 'email:password' of the readers
+    """
+    from benchmarks import serving_load
+    serving_load.run([target.split('=', 1) for target in targets.split(',')],
+                     key_id, secret, int(clients), int(duration),
+                     int(readers), credentials)
+
+
+@manager.option('-s', '--start_time', dest='start_time', required=True,
+                help="First minute to rebuild, as 'YYYY-MM-DDTHH:MM:SSZ'")
+@manager.option('-e', '--end_time', dest='end_time', required=True,
+                help="Last minute to rebuild, as 'YYYY-MM-DDTHH:MM:SSZ'")
+def rebuild_rollups(start_time, end_time):
+    """
+    Recompute the per-minute rollups of a window from the raw rows
+
+    Args:
+        start_time: Beginning of the window
+        end_time: End of the window
+    """
+    import strict_rfc3339
+    from app.rollups import rebuild
+    written = rebuild(strict_rfc3339.rfc3339_to_timestamp(start_time),
+                      strict_rfc3339.rfc3339_to_timestamp(end_time))
+    print('Rebuilt {} rollups.'.format(written))
+
+
+@device_manager.option('-e', '--email', dest='email', required=True,
+                       help='Email of the user the device posts as')
+@device_manager.option('-n', '--name', dest='name', required=True,
+                       help='What the device is')
+def create(email, name):
+    """
+    Create an API key for a device and print its id and secret
+
+    Args:
+        email: Email of the user the device posts as
+        name: What the device is
+    """
+    from sqlalchemy import func
+    from app.device_keys import signing_secret
+    user = User.query.filter(
+        func.lower(User.email) == email.lower()).first()
+    if user is None:
+        print('No user has the email {}.'.format(email))
+        sys.exit(-1)
+    key = DeviceKey.generate(user, name)
+    db.session.commit()
+    print('Key id: {}'.format(key.id))
+    print('Secret: {}'.format(signing_secret(key.id)))
+
+
+@device_manager.option('-k', '--key', dest='key_id', required=True,
+                       help='Id of the key')
+def secret(key_id):
+    """
+    Print the secret of a device key, which changes with SECRET_KEY
+
+    Args:
+        key_id: Id of the key
+    """
+    from app.device_keys import signing_secret
+    if DeviceKey.query.get(key_id) is None:
+        print('No device key has the id {}.'.format(key_id))
+        sys.exit(-1)
+    print('Secret: {}'.format(signing_secret(key_id)))
+
+
+@device_manager.option('-e', '--email', dest='email', default=None,
+                       help='Only list the keys of this user')
+def list_keys(email):
+    """
+    List the API keys of devices
+
+    Args:
+        email: Only list the keys of this user, all keys if None
+    """
+    from sqlalchemy import func
+    query = db.session.query(DeviceKey, User.email).join(
+        User, DeviceKey.user_id == User.id).order_by(DeviceKey.created)
+    if email is not None:
+        query = query.filter(func.lower(User.email) == email.lower())
+    for key, key_email in query:
+        print('{}  {}  {}  {}'.format(key.id, key_email, key.created,
+                                      key.name))
+
+
+@device_manager.option('-k', '--key', dest='key_id', required=True,
+                       help='Id of the key to revoke')
+def revoke(key_id):
+    """
+    Revoke the API key of a device
+
+    Args:
+        key_id: Id of the key
+    """
+    key = DeviceKey.query.get(key_id)
+    if key is None:
+        print('No device key has the id {}.'.format(key_id))
+        sys.exit(-1)
+    db.session.delete(key)
+    db.session.commit()
+    print('Revoked {}.'.format(key_id))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,43 @@
+"""Token revocations in Postgres
+
+Adds user.tokens_revoked_before, and the tables the database is missing,
+such as revoked_token and device_key.
+
+This is the first revision kept in the repository. A new database gets
+every table from the models, as the migration generated on first start
+used to. A database migrated with a migrations folder generated in its
+container has an alembic_version this folder does not know: drop the
+alembic_version table before upgrading, this revision only adds what is
+missing.
+
+Revision ID: 3f1c9e2a7b4d
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9e2a7b4d'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    # Only creates the tables that do not exist yet
+    current_app.extensions['migrate'].db.metadata.create_all(bind=bind)
+    columns = [column['name'] for column
+               in sa.inspect(bind).get_columns('user')]
+    if 'tokens_revoked_before' not in columns:
+        op.add_column('user', sa.Column('tokens_revoked_before', sa.Float(),
+                                        nullable=True))
+
+
+def downgrade():
+    op.drop_table('revoked_token')
+    op.drop_column('user', 'tokens_revoked_before')
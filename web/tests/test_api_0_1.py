@@ -1,11 +1,15 @@
 """Unit tests for the api"""
 import unittest
 import json
+import gzip
+import time
 from base64 import b64encode
 from flask import url_for, current_app
 from redis import RedisError
-from app import create_app, db, cache
-from app.models import User
+from app import create_app, db, cache, credential_cache, invalidation_bus
+from app.models import User, DeviceKey
+from app import device_keys, redis_store, timeseries
+from app.rate_limit import BUCKET_KEY
 
 class API2TestCase(unittest.TestCase):
 
@@ -30,6 +34,7 @@ class API2TestCase(unittest.TestCase):
         except RedisError:
             print('Redis port is closed, the redis server '
                   'does not appear to be running.')
+        invalidation_bus.clear_local()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -148,6 +153,41 @@ class API2TestCase(unittest.TestCase):
                                          password='hahaha'))
         self.assertTrue(response.status_code == 401)
 
+    def test_cached_credentials(self):
+        """Checks verified credentials are cached until the user changes"""
+        email = 'mary.poppins@'+current_app.config['MAIL_DOMAIN']
+        user = User(email=email, password='umbrella', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        hits = credential_cache.stats()['hits']
+        for _ in range(2):
+            response = self.client.get(
+                url_for('api_0_1.get_posts'),
+                headers=self.get_api_headers(email, 'umbrella'))
+            self.assertTrue(response.status_code == 200)
+        self.assertTrue(credential_cache.stats()['hits'] == hits + 1)
+
+        # a new password invalidates the cached one
+        user.password = 'kite'
+        db.session.commit()
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(email, 'umbrella'))
+        self.assertTrue(response.status_code == 401)
+
+        # so does unconfirming the account
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(email, 'kite'))
+        self.assertTrue(response.status_code == 200)
+        user.confirmed = False
+        db.session.commit()
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(email, 'kite'))
+        self.assertTrue(response.status_code == 403)
+
     def test_unconfirmed_account(self):
         """Checks users with unconfirmed accounts can't use the api"""
         user = User(email='indianajones@'+current_app.config['MAIL_DOMAIN'],
@@ -213,6 +253,166 @@ class API2TestCase(unittest.TestCase):
         self.assertTrue(response.status_code == 401)
 
 
+    def test_token_scopes_and_revocation(self):
+        """Checks token scopes and that revoked tokens are refused"""
+        email = 'ada.lovelace@'+current_app.config['MAIL_DOMAIN']
+        user = User(email=email, password='engine', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        # read only token
+        response = self.client.get(
+            url_for('api_0_1.get_token', scope='read'),
+            headers=self.get_api_headers(email, 'engine'))
+        self.assertTrue(response.status_code == 200)
+        token = json.loads(response.data.decode('utf-8'))['token']
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 200)
+        response = self.client.post(
+            url_for('api_0_1.new_post'),
+            headers=self.get_api_headers(token, '', True),
+            data=json.dumps(self.EXAMPLE_JSON_MESSAGE))
+        self.assertTrue(response.status_code == 403)
+
+        # unknown scope
+        response = self.client.get(
+            url_for('api_0_1.get_token', scope='admin'),
+            headers=self.get_api_headers(email, 'engine'))
+        self.assertTrue(response.status_code == 400)
+
+        # the token revokes itself
+        response = self.client.delete(
+            url_for('api_0_1.revoke_token'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 204)
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 401)
+
+        # revocations are not lost with the caches
+        cache.clear()
+        invalidation_bus.clear_local()
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 401)
+
+        # a new password revokes the tokens issued before
+        response = self.client.get(
+            url_for('api_0_1.get_token'),
+            headers=self.get_api_headers(email, 'engine'))
+        token = json.loads(response.data.decode('utf-8'))['token']
+        user.password = 'difference'
+        db.session.commit()
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 401)
+
+    def device_headers(self, key_id, method, path, body, timestamp=None):
+        """Headers of a request signed with a device key"""
+        if timestamp is None:
+            timestamp = int(time.time())
+        return {
+            'X-Device-Key': key_id,
+            'X-Timestamp': str(timestamp),
+            'X-Signature': device_keys.sign(
+                device_keys.signing_secret(key_id), timestamp, method, path,
+                '', body),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def test_device_key(self):
+        """Checks posts signed with a device key"""
+        user = User(email='r2d2@'+current_app.config['MAIL_DOMAIN'],
+                    password='beepboop', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        key = DeviceKey.generate(user, 'astromech')
+        db.session.commit()
+        key_id = key.id
+        path = url_for('api_0_1.new_post')
+        body = json.dumps(self.EXAMPLE_JSON_MESSAGE).encode('utf-8')
+
+        headers = self.device_headers(key_id, 'POST', path, body)
+        response = self.client.post(path, data=body, headers=headers)
+        self.assertTrue(response.status_code == 201)
+
+        # replayed request
+        response = self.client.post(path, data=body, headers=headers)
+        self.assertTrue(response.status_code == 401)
+
+        # altered body
+        response = self.client.post(
+            path, data=body.replace(b'{', b'{ ', 1),
+            headers=self.device_headers(key_id, 'POST', path, body))
+        self.assertTrue(response.status_code == 401)
+
+        # stale timestamp
+        response = self.client.post(
+            path, data=body, headers=self.device_headers(
+                key_id, 'POST', path, body, int(time.time()) - 3600))
+        self.assertTrue(response.status_code == 401)
+
+        # devices only post samples
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.device_headers(
+                key_id, 'GET', url_for('api_0_1.get_posts'), b''))
+        self.assertTrue(response.status_code == 403)
+
+        # revoked key, signed later than the first post so it is no replay
+        db.session.delete(DeviceKey.query.get(key_id))
+        db.session.commit()
+        response = self.client.post(
+            path, data=body, headers=self.device_headers(
+                key_id, 'POST', path, body, int(time.time()) + 1))
+        self.assertTrue(response.status_code == 401)
+
+    def test_rate_limit(self):
+        """Checks requests above the rate limit get a 429"""
+        email = 'speedy.gonzales@'+current_app.config['MAIL_DOMAIN']
+        user = User(email=email, password='arriba', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        principal = 'user:{}'.format(user.id)
+        redis_store.delete(BUCKET_KEY.format('read', principal))
+        current_app.config['RATE_LIMIT_PRINCIPALS'] = {
+            principal: {'read': {'capacity': 2, 'per_second': 0.01}}}
+
+        # wrong credentials only take from the bucket of the IP address,
+        # so they cannot use up the bucket of the user they claim to be
+        for _ in range(3):
+            response = self.client.get(
+                url_for('api_0_1.get_posts'),
+                headers=self.get_api_headers(email, 'wrong'))
+            self.assertTrue(response.status_code == 401)
+
+        for remaining in (1, 0):
+            response = self.client.get(
+                url_for('api_0_1.get_posts'),
+                headers=self.get_api_headers(email, 'arriba'))
+            self.assertTrue(response.status_code == 200)
+            self.assertTrue(response.headers['X-RateLimit-Limit'] == '2')
+            self.assertTrue(
+                response.headers['X-RateLimit-Remaining'] == str(remaining))
+
+        response = self.client.get(
+            url_for('api_0_1.get_posts'),
+            headers=self.get_api_headers(email, 'arriba'))
+        self.assertTrue(response.status_code == 429)
+        self.assertTrue(int(response.headers['Retry-After']) > 0)
+
+        # other route classes have their own bucket
+        response = self.client.get(
+            url_for('api_0_1.get_token'),
+            headers=self.get_api_headers(email, 'arriba'))
+        self.assertTrue(response.status_code == 200)
+
     # TEST HEADERS
 
     def test_missing_json_header(self):
@@ -292,6 +492,690 @@ class API2TestCase(unittest.TestCase):
         self.assertTrue(b'2017-09-13T13:01:58Z' in response.data)
         self.assertTrue(b'Could not find data.' in response.data)
 
+    def test_window_conditional_get(self):
+        """Test windows are revalidated with ETags and late data changes them"""
+        email = 'marty.mcfly@'+current_app.config['MAIL_DOMAIN']
+        password = 'GreatScott'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        example_json = self.EXAMPLE_JSON_MESSAGE
+        example_json["datetime"] = "2017-09-13T13:01:57Z"
+        response = self.client.post(
+            url_for('api_0_1.new_post'),
+            headers=self.get_api_headers(email, password, True),
+            data=json.dumps(example_json))
+        self.assertTrue(response.status_code == 201)
+
+        window = url_for('api_0_1.get_post',
+                         start_time='2017-09-13T13:01:57Z',
+                         end_time='2017-09-13T13:01:59Z')
+        response = self.client.get(
+            window, headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        # closed windows may still get late samples, so are revalidated
+        self.assertTrue('no-cache' in response.headers.get('Cache-Control'))
+
+        headers = self.get_api_headers(email, password)
+        headers['If-None-Match'] = etag
+        response = self.client.get(window, headers=headers)
+        self.assertTrue(response.status_code == 304)
+
+        # late data in the window must invalidate the old ETag
+        example_json["datetime"] = "2017-09-13T13:01:58Z"
+        response = self.client.post(
+            url_for('api_0_1.new_post'),
+            headers=self.get_api_headers(email, password, True),
+            data=json.dumps(example_json))
+        self.assertTrue(response.status_code == 201)
+        response = self.client.get(window, headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.headers.get('ETag') != etag)
+        self.assertTrue(b'2017-09-13T13:01:58Z' in response.data)
+
+    def test_window_read_after_cache_clear(self):
+        """Test windows missing from the cache are read from the database"""
+        email = 'emmett.brown@'+current_app.config['MAIL_DOMAIN']
+        password = 'OnePointTwentyOneGigawatts'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        example_json = self.EXAMPLE_JSON_MESSAGE
+        for second in ('57', '58'):
+            example_json["datetime"] = "2017-09-13T13:01:" + second + "Z"
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        try:
+            cache.clear()
+        except RedisError:
+            print('Redis port is closed, the redis server '
+                  'does not appear to be running.')
+
+        response = self.client.get(
+            url_for('api_0_1.get_post',
+                    start_time='2017-09-13T13:01:57Z',
+                    end_time='2017-09-13T13:01:59Z'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue([sample['datetime'] for sample in json_response] ==
+                        ['2017-09-13T13:01:57Z', '2017-09-13T13:01:58Z'])
+
+    def test_window_gaps_cached(self):
+        """Test windows with gaps are read from the database only once"""
+        email = 'marty.mcfly@'+current_app.config['MAIL_DOMAIN']
+        password = 'GreatScott'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        end_epoch = int(time.time()) - 60
+        example_json = self.EXAMPLE_JSON_MESSAGE
+        for epoch in (end_epoch - 2, end_epoch):
+            example_json["datetime"] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                     time.gmtime(epoch))
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+        cache.clear()
+        invalidation_bus.clear_local()
+
+        block_s = current_app.config['TIMESERIES_BLOCK_S']
+        self.assertTrue(timeseries.range_loaded(end_epoch - 2, end_epoch,
+                                                block_s)[1] != [])
+        response = self.client.get(
+            url_for('api_0_1.get_post',
+                    start_time=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                             time.gmtime(end_epoch - 2)),
+                    end_time=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                           time.gmtime(end_epoch))),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(len(json.loads(response.data.decode('utf-8'))) == 2)
+        # The second without data does not send the next reads to Postgres
+        samples, missing = timeseries.range_loaded(end_epoch - 2, end_epoch,
+                                                   block_s)
+        self.assertTrue(len(samples) == 2)
+        self.assertTrue(missing == [])
+
+    def test_latest_post(self):
+        """Test the latest samples are served and late samples are ignored"""
+        email = 'lorraine.baines@'+current_app.config['MAIL_DOMAIN']
+        password = 'CalvinKlein'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        response = self.client.get(
+            url_for('api_0_1.get_latest_post'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 404)
+
+        example_json = self.EXAMPLE_JSON_MESSAGE
+        for second in ('57', '58', '56'):
+            example_json["datetime"] = "2017-09-13T13:01:" + second + "Z"
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        response = self.client.get(
+            url_for('api_0_1.get_latest_post', count=2),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['latest']['datetime'] ==
+                        '2017-09-13T13:01:58Z')
+        self.assertTrue([sample['datetime'] for sample
+                         in json_response['recent']] ==
+                        ['2017-09-13T13:01:58Z', '2017-09-13T13:01:57Z'])
+
+        response = self.client.get(
+            url_for('api_0_1.get_latest_post', count=100000),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 429)
+
+    def test_posts_since_cursor(self):
+        """Test every ingested sample is returned once, late ones included"""
+        email = 'biff.tannen@'+current_app.config['MAIL_DOMAIN']
+        password = 'Butthead'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        def post(datetime):
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def since(cursor):
+            response = self.client.get(
+                url_for('api_0_1.get_posts_since', cursor=cursor, timeout=0),
+                headers=self.get_api_headers(email, password))
+            self.assertTrue(response.status_code == 200)
+            json_response = json.loads(response.data.decode('utf-8'))
+            return ([sample['datetime'] for sample in json_response['data']],
+                    json_response['cursor'])
+
+        post('2017-09-13T13:01:57Z')
+        post('2017-09-13T13:01:58Z')
+        datetimes, cursor = since(0)
+        self.assertTrue(datetimes[-2:] == ['2017-09-13T13:01:57Z',
+                                           '2017-09-13T13:01:58Z'])
+        self.assertTrue(since(cursor) == ([], cursor))
+
+        post('2017-09-13T13:01:50Z')
+        datetimes, next_cursor = since(cursor)
+        self.assertTrue(datetimes == ['2017-09-13T13:01:50Z'])
+        self.assertTrue(next_cursor != cursor)
+
+        response = self.client.get(
+            url_for('api_0_1.get_posts_since', cursor='not-a-cursor',
+                    timeout=0),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 410)
+
+    def test_gaps(self):
+        """Test missing seconds are reported, merged across days"""
+        email = 'emmett.brown@'+current_app.config['MAIL_DOMAIN']
+        password = 'GreatScott'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for datetime in ['2017-09-13T13:01:57Z', '2017-09-13T13:01:58Z',
+                         '2017-09-13T13:02:05Z']:
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def gaps(start_time, end_time, min_gap):
+            response = self.client.get(
+                url_for('api_0_1.get_gaps', start_time=start_time,
+                        end_time=end_time, min_gap=min_gap),
+                headers=self.get_api_headers(email, password))
+            self.assertTrue(response.status_code == 200)
+            return json.loads(response.data.decode('utf-8'))['gaps']
+
+        self.assertTrue(gaps('2017-09-13T13:01:50Z', '2017-09-13T13:02:10Z',
+                             '1s') ==
+                        [['2017-09-13T13:01:50Z', '2017-09-13T13:01:56Z'],
+                         ['2017-09-13T13:01:59Z', '2017-09-13T13:02:04Z'],
+                         ['2017-09-13T13:02:06Z', '2017-09-13T13:02:10Z']])
+        self.assertTrue(gaps('2017-09-13T13:01:50Z', '2017-09-13T13:02:10Z',
+                             '6') ==
+                        [['2017-09-13T13:01:50Z', '2017-09-13T13:01:56Z'],
+                         ['2017-09-13T13:01:59Z', '2017-09-13T13:02:04Z']])
+        # Whole closed days are cached, the second request reads the cache
+        for _ in range(2):
+            self.assertTrue(gaps('2017-09-12T00:00:00Z',
+                                 '2017-09-13T13:01:57Z', '1m') ==
+                            [['2017-09-12T00:00:00Z',
+                              '2017-09-13T13:01:56Z']])
+
+        response = self.client.get(
+            url_for('api_0_1.get_gaps', start_time='2017-09-13T13:01:50Z',
+                    end_time='2017-09-13T13:02:10Z', min_gap='soon'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 400)
+
+    def test_rollup_statistics(self):
+        """Test statistics merged from rollups match the raw rows"""
+        email = 'jennifer.parker@'+current_app.config['MAIL_DOMAIN']
+        password = 'Hillvalley'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for datetime, value in [('2017-09-13T13:00:58Z', '1'),
+                                ('2017-09-13T13:00:59Z', '2'),
+                                ('2017-09-13T13:01:00Z', '3'),
+                                ('2017-09-13T13:01:30Z', '4'),
+                                ('2017-09-13T13:02:05Z', '10')]:
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            example_json["sensor_1"] = value
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def statistics():
+            response = self.client.get(
+                url_for('api_0_1.statistics_of_data',
+                        start_time='2017-09-13T13:00:59Z',
+                        end_time='2017-09-13T13:02:05Z', source='rollups'),
+                headers=self.get_api_headers(email, password))
+            self.assertTrue(response.status_code == 200)
+            return json.loads(response.data.decode('utf-8'))['data']
+
+        sensor_1 = statistics()['sensor_1']
+        self.assertTrue(sensor_1['count'] == 4)
+        self.assertAlmostEqual(sensor_1['mean'], 4.75)
+        self.assertAlmostEqual(sensor_1['std'], 3.5939764421413041)
+        self.assertTrue(sensor_1['min'] == 2.0)
+        self.assertTrue(sensor_1['max'] == 10.0)
+        accuracy = current_app.config['STATISTICS_SKETCH_ACCURACY']
+        self.assertTrue(abs(sensor_1['percentiles']['50'] - 3.0) <=
+                        3.0 * accuracy)
+        self.assertTrue(abs(sensor_1['percentiles']['99'] - 10.0) <=
+                        10.0 * accuracy)
+
+        from app.rollups import rebuild
+        rebuild(1505307600, 1505307779)
+        rebuilt = statistics()['sensor_1']
+        self.assertTrue(rebuilt['count'] == 4)
+        self.assertAlmostEqual(rebuilt['mean'], sensor_1['mean'])
+        self.assertAlmostEqual(rebuilt['std'], sensor_1['std'])
+        self.assertTrue(rebuilt['percentiles'] == sensor_1['percentiles'])
+
+    def test_statistics_result_cache(self):
+        """Test repeated statistics requests are answered from the cache"""
+        email = 'george.mcfly@'+current_app.config['MAIL_DOMAIN']
+        password = 'Destiny'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        def post(datetime):
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def statistics():
+            return self.client.get(
+                url_for('api_0_1.statistics_of_data',
+                        start_time='2017-09-13T13:01:50Z',
+                        end_time='2017-09-13T13:01:59Z', source='raw'),
+                headers=self.get_api_headers(email, password))
+
+        post('2017-09-13T13:01:57Z')
+        self.assertTrue(statistics().status_code == 202)
+        response = statistics()
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['data']['sensor_1']['count'] == 1)
+
+        # A new sample in the window gives the request a new key
+        post('2017-09-13T13:01:58Z')
+        self.assertTrue(statistics().status_code == 202)
+
+    def test_large_statistics_result(self):
+        """Test large statistics results are streamed from their file"""
+        email = 'jennifer.parker@'+current_app.config['MAIL_DOMAIN']
+        password = 'Hoverboard'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        example_json = self.EXAMPLE_JSON_MESSAGE
+        example_json["datetime"] = '2017-09-13T13:01:57Z'
+        response = self.client.post(
+            url_for('api_0_1.new_post'),
+            headers=self.get_api_headers(email, password, True),
+            data=json.dumps(example_json))
+        self.assertTrue(response.status_code == 201)
+
+        current_app.config['RESULT_INLINE_MAX_BYTES'] = 0
+        url = url_for('api_0_1.statistics_of_data',
+                      start_time='2017-09-13T13:01:50Z',
+                      end_time='2017-09-13T13:01:59Z', source='raw')
+        self.assertTrue(self.client.get(
+            url, headers=self.get_api_headers(email, password)
+            ).status_code == 202)
+        # The cache only holds a pointer to the file
+        response = self.client.get(
+            url, headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['data']['sensor_1']['count'] == 1)
+
+        headers = self.get_api_headers(email, password)
+        headers['Accept-Encoding'] = 'gzip'
+        response = self.client.get(url, headers=headers)
+        self.assertTrue(response.headers['Content-Encoding'] == 'gzip')
+        json_response = json.loads(
+            gzip.decompress(response.data).decode('utf-8'))
+        self.assertTrue(json_response['data']['sensor_1']['count'] == 1)
+
+    def test_correlation(self):
+        """Test correlation matrices are computed in the background"""
+        email = 'emmett.brown@'+current_app.config['MAIL_DOMAIN']
+        password = 'Plutonium'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for datetime, value in [('2017-09-13T13:01:51Z', '1'),
+                                ('2017-09-13T13:01:52Z', '2'),
+                                ('2017-09-13T13:01:53Z', '4'),
+                                ('2017-09-13T13:01:54Z', '8')]:
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            example_json["sensor_1"] = value
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def correlation(**args):
+            return self.client.get(
+                url_for('api_0_1.correlation_of_data',
+                        start_time='2017-09-13T13:01:50Z',
+                        end_time='2017-09-13T13:01:59Z', **args),
+                headers=self.get_api_headers(email, password))
+
+        self.assertTrue(correlation(lags='-1').status_code == 400)
+        self.assertTrue(correlation(sensors='flux').status_code == 400)
+        # Tasks run eagerly, the result is then served from cache
+        self.assertTrue(correlation(lags='0,1').status_code == 202)
+        response = correlation(lags='0,1')
+        self.assertTrue(response.status_code == 200)
+        lags = json.loads(response.data.decode('utf-8'))['lags']
+        self.assertTrue(lags['0']['count'] == [[4]])
+        self.assertAlmostEqual(lags['0']['correlation'][0][0], 1.0)
+        # (2, 1), (4, 2), (8, 4) are perfectly correlated
+        self.assertTrue(lags['1']['count'] == [[3]])
+        self.assertAlmostEqual(lags['1']['correlation'][0][0], 1.0)
+        self.assertAlmostEqual(lags['1']['covariance'][0][0], 14.0 / 3)
+
+    def test_spectrum(self):
+        """Test spectra are computed in the background"""
+        email = 'marty.mcfly.jr@'+current_app.config['MAIL_DOMAIN']
+        password = 'Hoverboard'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for second in range(16):
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = '2017-09-13T13:01:{:02d}Z'.format(
+                second)
+            example_json["sensor_1"] = str(second % 4)
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def spectrum(segment):
+            return self.client.get(
+                url_for('api_0_1.spectrum_of_data',
+                        start_time='2017-09-13T13:01:00Z',
+                        end_time='2017-09-13T13:01:59Z', segment=segment),
+                headers=self.get_api_headers(email, password))
+
+        self.assertTrue(spectrum(12).status_code == 400)
+        # Tasks run eagerly, the result is then served from cache
+        self.assertTrue(spectrum(8).status_code == 202)
+        response = spectrum(8)
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        sensor_1 = json_response['sensors']['sensor_1']
+        self.assertTrue(sensor_1['segments'] == 3)
+        self.assertTrue(sensor_1['peaks'][0]['frequency'] == 0.25)
+
+    def test_chunked_statistics(self):
+        """Test long windows are split into chunks and merged exactly"""
+        email = 'lorraine.mcfly@'+current_app.config['MAIL_DOMAIN']
+        password = 'Enchantment'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for datetime, value in [('2017-09-13T13:01:51Z', '1'),
+                                ('2017-09-13T13:01:53Z', '2'),
+                                ('2017-09-13T13:01:57Z', '6')]:
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            example_json["sensor_1"] = value
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        current_app.config['STATISTICS_CHUNK_S'] = 3
+
+        def statistics():
+            return self.client.get(
+                url_for('api_0_1.statistics_of_data',
+                        start_time='2017-09-13T13:01:50Z',
+                        end_time='2017-09-13T13:01:59Z', source='raw'),
+                headers=self.get_api_headers(email, password))
+
+        # Tasks run eagerly, the merged result is then served from cache
+        self.assertTrue(statistics().status_code == 202)
+        response = statistics()
+        self.assertTrue(response.status_code == 200)
+        sensor_1 = json.loads(response.data.decode('utf-8'))['data']['sensor_1']
+        self.assertTrue(sensor_1['count'] == 3)
+        self.assertAlmostEqual(sensor_1['mean'], 3.0)
+        self.assertAlmostEqual(sensor_1['std'], 2.6457513110645907)
+        self.assertTrue(sensor_1['percentiles']['50'] == 2.0)
+
+    def test_statistics_admission_and_cancel(self):
+        """Test statistics tasks are refused when over quota and cancelled"""
+        from app import statistics_jobs
+        email = 'biff.tannen.sr@'+current_app.config['MAIL_DOMAIN']
+        password = 'Manure'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        current_app.config['STATISTICS_MAX_TASKS_PER_USER'] = 0
+        response = self.client.get(
+            url_for('api_0_1.statistics_of_data',
+                    start_time='2017-09-13T13:01:50Z',
+                    end_time='2017-09-13T13:01:59Z', source='raw'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 429)
+        self.assertTrue(response.headers['Retry-After'] ==
+                        str(current_app.config['STATISTICS_RETRY_AFTER_S']))
+
+        response = self.client.delete(
+            url_for('api_0_1.cancel_statistics', task_id='not-a-task'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 404)
+
+        statistics_jobs.add_requester('test-statistics-task', user.id)
+        response = self.client.delete(
+            url_for('api_0_1.cancel_statistics',
+                    task_id='test-statistics-task'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 204)
+        response = self.client.get(
+            url_for('api_0_1.statistics_status',
+                    task_id='test-statistics-task'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 410)
+        # Streams of tasks already done end with their state
+        response = self.client.get(
+            url_for('api_0_1.statistics_events',
+                    task_id='test-statistics-task'),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.data.decode('utf-8').startswith(
+            'event: done\n'))
+        self.assertTrue('"REVOKED"' in response.data.decode('utf-8'))
+
+    def test_task_events(self):
+        """Test finished tasks are published on their channel"""
+        from app import redis_store
+        email = 'dave.mcfly@'+current_app.config['MAIL_DOMAIN']
+        password = 'Pinheads'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        def statistics(**args):
+            return self.client.get(
+                url_for('api_0_1.statistics_of_data',
+                        start_time='2017-09-13T13:01:50Z',
+                        end_time='2017-09-13T13:01:59Z', source='raw',
+                        **args),
+                headers=self.get_api_headers(email, password))
+
+        self.assertTrue(statistics(
+            callback='http://localhost/hook').status_code == 400)
+        # Workers do not call hosts inside the network
+        self.assertTrue(statistics(
+            callback='https://localhost/hook').status_code == 400)
+        self.assertTrue(statistics(
+            callback='https://169.254.169.254/hook').status_code == 400)
+        pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe('task_done:*')
+        try:
+            # Tasks run eagerly, so they are done when the request returns
+            response = statistics()
+            self.assertTrue(response.status_code == 202)
+            task_id = response.headers['Location'].rsplit('/', 1)[1]
+            # The subscription's confirmation is read as None first
+            for _ in range(3):
+                message = pubsub.get_message(timeout=1)
+                if message is not None:
+                    break
+        finally:
+            pubsub.close()
+        self.assertTrue(message['channel'].decode('utf-8') ==
+                        'task_done:' + task_id)
+        payload = json.loads(message['data'].decode('utf-8'))
+        self.assertTrue(payload['state'] == 'SUCCESS')
+        self.assertTrue(payload['status'] == 200)
+
+    def test_chunk_failure_events(self):
+        """Test a failing chunk ends its chord's task and notifies it"""
+        from unittest import mock
+        from celery.exceptions import ChordError
+        from app import statistics_cache, statistics_jobs
+        from app.api_0_1.machine_posts import async_statistics, \
+            statistics_chunk, merge_callback
+        email = 'jennifer.parker@'+current_app.config['MAIL_DOMAIN']
+        password = 'HillValley'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+
+        task_id = 'test-chord-task'
+        cache_key = 'test-chord-key'
+        statistics_jobs.add_requester(task_id, user.id)
+        statistics_cache.claim(cache_key, task_id)
+        pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('task_done:' + task_id)
+        try:
+            with mock.patch('app.statistics.window_statistics',
+                            side_effect=RuntimeError('chunk failed')):
+                chunk = statistics_chunk.apply(
+                    ('2017-09-13T13:01:50Z', '2017-09-13T13:01:52Z',
+                     task_id))
+            self.assertTrue(chunk.failed())
+            # What the result backend does once every chunk returned
+            async_statistics.backend.chord_error_from_stack(
+                merge_callback(task_id, '2017-09-13T13:01:50Z',
+                               '2017-09-13T13:01:59Z', 1505307719,
+                               cache_key, 'interactive'),
+                ChordError('chunk failed'))
+            for _ in range(3):
+                message = pubsub.get_message(timeout=1)
+                if message is not None:
+                    break
+        finally:
+            pubsub.close()
+        payload = json.loads(message['data'].decode('utf-8'))
+        self.assertTrue(payload['state'] == 'FAILURE')
+
+        # The user's slot and the request are free again
+        self.assertTrue(statistics_jobs.tasks_in_flight(
+            user.id, lambda task_id: False) == 0)
+        self.assertIsNone(statistics_cache.claim(cache_key, 'another-task'))
+        response = self.client.get(
+            url_for('api_0_1.statistics_status', task_id=task_id),
+            headers=self.get_api_headers(email, password))
+        self.assertTrue(response.status_code == 500)
+
+    def test_query_posts(self):
+        """Test several windows are answered in one request, per window"""
+        email = 'lorraine.baines@'+current_app.config['MAIL_DOMAIN']
+        password = 'Calvin'
+        user = User(email=email, password=password, confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        for datetime in ['2017-09-13T13:01:57Z', '2017-09-13T13:01:58Z',
+                         '2017-09-13T14:00:00Z']:
+            example_json = self.EXAMPLE_JSON_MESSAGE
+            example_json["datetime"] = datetime
+            response = self.client.post(
+                url_for('api_0_1.new_post'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(example_json))
+            self.assertTrue(response.status_code == 201)
+
+        def query(body):
+            return self.client.post(
+                url_for('api_0_1.query_posts'),
+                headers=self.get_api_headers(email, password, True),
+                data=json.dumps(body))
+
+        response = query({'windows': [
+            {'start_time': '2017-09-13T13:59:00Z',
+             'end_time': '2017-09-13T14:01:00Z'},
+            {'start_time': '2017-09-13T13:01:57Z',
+             'end_time': '2017-09-13T13:01:58Z'},
+            {'start_time': '2017-09-13T12:00:00Z',
+             'end_time': '2017-09-13T12:00:01Z'}],
+            'fields': ['sensor_1']})
+        self.assertTrue(response.status_code == 200)
+        windows = json.loads(response.data.decode('utf-8'))['windows']
+        self.assertTrue([[sample['datetime'] for sample in window['data']]
+                         for window in windows] ==
+                        [['2017-09-13T14:00:00Z'],
+                         ['2017-09-13T13:01:57Z', '2017-09-13T13:01:58Z'],
+                         []])
+        self.assertTrue(set(windows[0]['data'][0]) ==
+                        {'datetime', 'sensor_1'})
+
+        response = query({'windows': [
+            {'start_time': '2017-09-13T13:01:57Z',
+             'end_time': '2017-09-13T13:01:58Z'}],
+            'fields': ['sensor_1; DROP TABLE machine']})
+        self.assertTrue(response.status_code == 400)
+
+        for field in (['sensor_1'], {'sensor_1': 1}, 1):
+            response = query({'windows': [
+                {'start_time': '2017-09-13T13:01:57Z',
+                 'end_time': '2017-09-13T13:01:58Z'}],
+                'fields': [field]})
+            self.assertTrue(response.status_code == 400)
+
+        response = query({'windows': [
+            {'start_time': '2017-09-13T13:01:58Z',
+             'end_time': '2017-09-13T13:01:57Z'}]})
+        self.assertTrue(response.status_code == 400)
+
+        response = query({'windows': [
+            {'start_time': '2017-09-13T00:00:00Z',
+             'end_time': '2017-09-13T23:00:00Z'}]})
+        self.assertTrue(response.status_code == 429)
+
     def test_too_many_requests_get_posts(self):
         """Test too many seconds  are requested for get posts"""
         # add user
@@ -683,6 +683,18 @@ class FlaskClientTestCase(unittest.TestCase):
                                     data={'search_enable': ''})
         self.assertTrue(b'Enable search' in response.data)
         """
+    def test_viewdata_stream(self):
+        """Check the live stream of samples requires login and opens"""
+        response = self.client.get(url_for('main.stream_machine_data'))
+        self.assertTrue(response.status_code == 302)
+        self.login()
+        response = self.client.get(url_for('main.stream_machine_data'),
+                                   buffered=False)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.mimetype == 'text/event-stream')
+        self.assertTrue(next(iter(response.response)).startswith(b'retry:'))
+        response.close()
+
     # TEST JSON POST TO WEBPAGE
 
     def test_wrong_json_time_format(self):
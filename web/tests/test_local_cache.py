@@ -0,0 +1,145 @@
+"""Unit tests for the in-process caches"""
+import os
+import time
+import unittest
+import redis
+from app import redis_store
+from app.local_cache import LocalCache, InvalidationBus
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    """Tests LRU eviction, TTL expiry and counters of LocalCache"""
+
+    def test_hits_and_misses(self):
+        """Lookups are counted, including cached None values"""
+        local_cache = LocalCache('test', maxsize=10, ttl=60)
+        local_cache.set(1, {'sensor_1': '1'})
+        local_cache.set(2, None)
+        self.assertTrue(local_cache.get(1) == (True, {'sensor_1': '1'}))
+        self.assertTrue(local_cache.get(2) == (True, None))
+        self.assertTrue(local_cache.get(3) == (False, None))
+        stats = local_cache.stats()
+        self.assertTrue(stats['hits'] == 2)
+        self.assertTrue(stats['misses'] == 1)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when full"""
+        local_cache = LocalCache('test', maxsize=2, ttl=60)
+        local_cache.set(1, 'a')
+        local_cache.set(2, 'b')
+        local_cache.get(1)
+        local_cache.set(3, 'c')
+        self.assertTrue(local_cache.get_many([1, 2, 3]) == {1: 'a', 3: 'c'})
+
+    def test_ttl_expiry(self):
+        """Entries are not served after their TTL"""
+        local_cache = LocalCache('test', maxsize=2, ttl=1)
+        local_cache.set(1, 'a')
+        time.sleep(1.1)
+        self.assertTrue(local_cache.get(1) == (False, None))
+        self.assertTrue(local_cache.stats()['size'] == 0)
+
+    def test_delete_tag(self):
+        """Tagged entries are invalidated together"""
+        local_cache = LocalCache('test', maxsize=10, ttl=60)
+        local_cache.set('a', 1, tag=7)
+        local_cache.set('b', 2, tag=7)
+        local_cache.set('c', 3, tag=8)
+        local_cache.delete_tag(7)
+        self.assertTrue(local_cache.get_many(['a', 'b', 'c']) == {'c': 3})
+
+
+class InvalidationBusTestCase(unittest.TestCase):
+    """Tests the invalidations broadcast between processes over pub/sub"""
+
+    def setUp(self):
+        """Two buses on one channel, standing for two worker processes"""
+        self.channel = 'test_invalidation_{}'.format(os.getpid())
+        self.publisher = InvalidationBus(redis_store, channel=self.channel)
+        self.subscriber = InvalidationBus(redis_store, channel=self.channel)
+        self.published = self.publisher.register(
+            LocalCache('test', maxsize=10, ttl=60))
+        self.received = self.subscriber.register(
+            LocalCache('test', maxsize=10, ttl=60))
+
+    def tearDown(self):
+        """Stops the subscriber threads"""
+        for bus in (self.publisher, self.subscriber):
+            if bus._thread is not None:
+                bus._thread.stop()
+
+    def wait_subscribed(self):
+        """Waits until the subscriber thread listens on the channel"""
+        for _ in range(50):
+            if dict(redis_store.pubsub_numsub(self.channel)).get(
+                    self.channel.encode('utf-8')):
+                return
+            time.sleep(0.1)
+        self.fail('Subscriber never joined the channel')
+
+    def wait_missing(self, local_cache, key):
+        """Waits until key is no longer cached"""
+        for _ in range(50):
+            if not local_cache.get(key)[0]:
+                return
+            time.sleep(0.1)
+        self.fail('Invalidation of {} never arrived'.format(key))
+
+    def test_tag_invalidation_is_delivered(self):
+        """Another process drops the entries of a published tag"""
+        self.subscriber.ensure_started()
+        self.wait_subscribed()
+        self.received.set('a', 1, tag=7)
+        self.received.set('b', 2, tag=8)
+        self.published.set('a', 1, tag=7)
+        self.publisher.publish('test', tag=7)
+        # Applied to the publishing process at once
+        self.assertTrue(self.published.get('a') == (False, None))
+        self.wait_missing(self.received, 'a')
+        self.assertTrue(self.received.get('b') == (True, 2))
+
+    def test_key_invalidation_is_delivered(self):
+        """Another process drops a published key"""
+        self.subscriber.ensure_started()
+        self.wait_subscribed()
+        self.received.set('a', 1)
+        self.received.set('b', 2)
+        self.publisher.publish('test', key='a')
+        self.wait_missing(self.received, 'a')
+        self.assertTrue(self.received.get('b') == (True, 2))
+
+    def test_lazy_start_per_process(self):
+        """The thread starts on first use, and again after a fork"""
+        self.assertTrue(self.subscriber._thread is None)
+        self.subscriber.ensure_started()
+        thread = self.subscriber._thread
+        self.assertTrue(thread.is_alive())
+        self.assertTrue(self.subscriber._pid == os.getpid())
+        self.subscriber.ensure_started()
+        self.assertTrue(self.subscriber._thread is thread)
+        # A forked child inherits the bus but not the thread, and may have
+        # missed invalidations, so its caches start empty
+        self.received.set('a', 1)
+        self.subscriber._pid = -1
+        self.subscriber.ensure_started()
+        thread.stop()
+        self.assertTrue(self.subscriber._thread is not thread)
+        self.assertTrue(self.subscriber._pid == os.getpid())
+        self.assertTrue(self.received.get('a') == (False, None))
+
+    def test_unreachable_redis(self):
+        """Without Redis, caches are cleared and invalidated locally"""
+        unreachable = redis.StrictRedis.from_url('redis://localhost:1')
+        bus = InvalidationBus(unreachable, channel=self.channel)
+        local_cache = bus.register(LocalCache('test', maxsize=10, ttl=60))
+        local_cache.set('a', 1, tag=7)
+        local_cache.set('b', 2)
+        bus.ensure_started()
+        self.assertTrue(bus._thread is None)
+        self.assertTrue(local_cache.stats()['size'] == 0)
+        local_cache.set('a', 1, tag=7)
+        local_cache.set('b', 2)
+        bus.publish('test', tag=7)
+        self.assertTrue(local_cache.get_many(['a', 'b']) == {'b': 2})
+        bus.clear_local()
+        self.assertTrue(local_cache.stats()['size'] == 0)
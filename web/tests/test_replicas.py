@@ -0,0 +1,75 @@
+"""Unit tests for the routing of reads to read replicas"""
+import unittest
+from flask import current_app, g
+from redis import RedisError
+from app import create_app, db, cache, replica_lag_cache
+from app.models import User
+from app.replicas import choose_read_bind, note_write, read_only
+
+
+class ReplicasTestCase(unittest.TestCase):
+    """
+    Tests replica selection, using the test database as its own replica
+    """
+
+    def setUp(self):
+        """Create test environment"""
+        self.Backend = create_app('testing')
+        self.Backend.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': self.Backend.config['SQLALCHEMY_DATABASE_URI']}
+        self.Backend.config['READ_REPLICA_BINDS'] = ['replica_0']
+        self.app_context = self.Backend.app_context()
+        self.app_context.push()
+        db.create_all()
+        replica_lag_cache.clear()
+
+    def tearDown(self):
+        """Close test environment"""
+        try:
+            cache.clear()
+        except RedisError:
+            print('Redis port is closed, the redis server '
+                  'does not appear to be running.')
+        replica_lag_cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_fresh_replica_is_read(self):
+        """Reads go to a replica that is not lagging"""
+        with self.Backend.test_request_context():
+            self.assertTrue(choose_read_bind() == 'replica_0')
+
+            @read_only
+            def view():
+                return db.session.get_bind()
+            self.assertTrue(view() is db.get_engine(current_app,
+                                                    bind='replica_0'))
+            self.assertTrue(db.session.get_bind() is db.get_engine())
+
+    def test_lagging_replica_is_skipped(self):
+        """Reads go to the primary when replicas lag or are down"""
+        replica_lag_cache.set('replica_0', 60.0)
+        with self.Backend.test_request_context():
+            self.assertTrue(choose_read_bind() is None)
+        replica_lag_cache.set('replica_0', None)
+        with self.Backend.test_request_context():
+            self.assertTrue(choose_read_bind() is None)
+
+    def test_consistency_header(self):
+        """Clients can ask to read from the primary"""
+        with self.Backend.test_request_context(
+                headers={'X-Consistency': 'primary'}):
+            self.assertTrue(choose_read_bind() is None)
+
+    def test_read_your_writes(self):
+        """Users read from the primary right after they wrote"""
+        user = User(email='marty.mcfly@'+current_app.config['MAIL_DOMAIN'],
+                    password='OutATime', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        with self.Backend.test_request_context():
+            g.current_user = user
+            self.assertTrue(choose_read_bind() == 'replica_0')
+            note_write()
+            self.assertTrue(choose_read_bind() is None)
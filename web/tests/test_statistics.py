@@ -0,0 +1,201 @@
+"""Unit tests for the statistics engine"""
+import json
+import unittest
+import numpy as np
+from scipy import signal
+from flask import current_app
+from redis import RedisError
+from app import create_app, db, cache
+from app.models import Machine
+from app.statistics import Accumulator, window_statistics
+from app.statistics_jobs import placement
+from app.sketches import QuantileSketch
+from app.correlation import CoMoments
+from app.spectrum import Spectrum
+
+
+class AccumulatorTestCase(unittest.TestCase):
+    """Tests merging chunk statistics gives the statistics of the whole"""
+
+    def test_merged_chunks_match_numpy(self):
+        """Chunks of any size merge into the statistics of all the values"""
+        random = np.random.RandomState(7)
+        values = random.normal(50, 10, size=(10000, 2))
+        values[random.rand(10000) < 0.1, 1] = np.nan
+        accumulator = Accumulator(['a', 'b'], 100000)
+        for start in range(0, 10000, 1800):
+            accumulator.add_chunk(values[start:start + 1800])
+        result = accumulator.result([50])
+        for index, sensor in enumerate(['a', 'b']):
+            column = values[:, index]
+            column = column[~np.isnan(column)]
+            self.assertTrue(result[sensor]['count'] == len(column))
+            self.assertAlmostEqual(result[sensor]['mean'], column.mean())
+            self.assertAlmostEqual(result[sensor]['std'], column.std(ddof=1))
+            self.assertTrue(result[sensor]['min'] == column.min())
+            self.assertTrue(result[sensor]['max'] == column.max())
+            self.assertAlmostEqual(result[sensor]['percentiles']['50'],
+                                   np.percentile(column, 50))
+
+    def test_reservoir_is_bounded(self):
+        """Percentiles of long windows are sampled from bounded memory"""
+        accumulator = Accumulator(['a'], 500)
+        for _ in range(10):
+            accumulator.add_chunk(np.arange(1000.0).reshape(-1, 1))
+        self.assertTrue(len(accumulator.reservoirs[0]) == 500)
+        self.assertTrue(accumulator.count[0] == 10000)
+        median = accumulator.result([50])['a']['percentiles']['50']
+        self.assertTrue(300 < median < 700)
+
+    def test_round_trip(self):
+        """Accumulators survive being sent between processes as JSON"""
+        accumulator = Accumulator(['a', 'b'], 100)
+        accumulator.add_chunk([[1.0, np.nan], [2.0, np.nan]])
+        state = json.loads(json.dumps(accumulator.to_dict()))
+        result = Accumulator.from_dict(state).result([50])
+        self.assertTrue(result == accumulator.result([50]))
+        self.assertTrue(result['b']['mean'] is None)
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """Tests quantiles of merged sketches are within their accuracy"""
+
+    def test_merged_sketches_are_accurate(self):
+        """Sketches of chunks merge into a sketch of all the values"""
+        random = np.random.RandomState(7)
+        values = np.concatenate((random.lognormal(0, 2, 50000),
+                                 -random.lognormal(0, 1, 10000),
+                                 np.zeros(100)))
+        sketch = QuantileSketch(0.01, 1e-6)
+        for start in range(0, len(values), 1800):
+            chunk = QuantileSketch(0.01, 1e-6)
+            chunk.add(values[start:start + 1800])
+            sketch.merge(chunk)
+        self.assertTrue(sketch.count() == len(values))
+        for percentile in (1, 25, 50, 95, 99):
+            exact = np.percentile(values, percentile,
+                                  interpolation='lower')
+            estimate = sketch.quantile(percentile / 100.0)
+            self.assertTrue(abs(estimate - exact) <= 0.01 * abs(exact))
+
+    def test_zero_and_empty(self):
+        """Values near zero count as zero, empty sketches have no quantiles"""
+        sketch = QuantileSketch(0.01, 1e-6)
+        self.assertTrue(sketch.quantile(0.5) is None)
+        sketch.add([1e-9, 0.0, np.nan])
+        self.assertTrue(sketch.count() == 2)
+        self.assertTrue(sketch.percentiles([50]) == {'50': 0.0})
+
+
+class CoMomentsTestCase(unittest.TestCase):
+    """Tests merged co-moments give NumPy's covariances and correlations"""
+
+    def test_merged_chunks_match_numpy(self):
+        """Lagged pairs are matched by time, across chunks and gaps"""
+        random = np.random.RandomState(7)
+        epochs = np.arange(5000.0)
+        epochs = epochs[random.rand(5000) > 0.05]
+        values = random.normal(100, 5, size=(len(epochs), 2))
+        values[:, 1] += 0.5 * values[:, 0]
+        values[random.rand(len(epochs)) < 0.1, 1] = np.nan
+        comoments = CoMoments(['a', 'b'], [0, 3])
+        for start in range(0, len(epochs), 700):
+            comoments.add_chunk(epochs[start:start + 700],
+                                values[start:start + 700], epochs, values)
+        result = comoments.result()
+        lookup = dict(zip(epochs.tolist(), values[:, 1].tolist()))
+        for lag in (0, 3):
+            lagged = np.array([lookup.get(epoch - lag, np.nan)
+                               for epoch in epochs])
+            pairs = ~np.isnan(values[:, 0]) & ~np.isnan(lagged)
+            expected = np.cov(values[pairs, 0], lagged[pairs])
+            self.assertTrue(result[str(lag)]['count'][0][1] == pairs.sum())
+            self.assertAlmostEqual(result[str(lag)]['covariance'][0][1],
+                                   expected[0][1])
+            self.assertAlmostEqual(
+                result[str(lag)]['correlation'][0][1],
+                np.corrcoef(values[pairs, 0], lagged[pairs])[0][1])
+
+    def test_round_trip(self):
+        """Co-moments survive their conversion to lists"""
+        comoments = CoMoments(['a'], [0])
+        comoments.add_chunk(np.arange(3.0), np.array([[1.0], [2.0], [4.0]]),
+                            np.arange(3.0), np.array([[1.0], [2.0], [4.0]]))
+        copy = CoMoments.from_dict(comoments.to_dict())
+        self.assertTrue(copy.result() == comoments.result())
+        self.assertTrue(copy.result()['0']['correlation'] == [[1.0]])
+
+
+class SpectrumTestCase(unittest.TestCase):
+    """Tests chunked spectra match SciPy's Welch estimate"""
+
+    def test_chunks_match_welch(self):
+        """Segments carried over chunks give Welch's PSD and its peak"""
+        random = np.random.RandomState(7)
+        epochs = np.arange(4000.0)
+        values = np.sin(2 * np.pi * 0.125 * epochs) + \
+            random.normal(0, 0.1, 4000)
+        spectrum = Spectrum(['a'], 64)
+        for start in range(0, 4000, 1800):
+            spectrum.add_chunk(epochs[start:start + 1800],
+                               values[start:start + 1800].reshape(-1, 1))
+        _, expected = signal.welch(values, fs=1.0, window='hann',
+                                   nperseg=64, noverlap=32)
+        result = spectrum.result(1)
+        self.assertTrue(np.allclose(result['sensors']['a']['psd'], expected))
+        self.assertTrue(
+            result['sensors']['a']['peaks'][0]['frequency'] == 0.125)
+
+    def test_segments_skip_gaps(self):
+        """Runs shorter than a segment between gaps are not counted"""
+        epochs = np.concatenate((np.arange(100.0), np.arange(200.0, 230.0)))
+        spectrum = Spectrum(['a'], 64)
+        spectrum.add_chunk(epochs, np.ones((130, 1)))
+        # (100 - 32) // 32 segments in the first run, none in the second
+        self.assertTrue(spectrum.result(1)['sensors']['a']['segments'] == 2)
+
+
+class WindowStatisticsTestCase(unittest.TestCase):
+    """Tests statistics read from the database"""
+
+    def setUp(self):
+        """Create test environment"""
+        self.Backend = create_app('testing')
+        self.app_context = self.Backend.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        """Close test environment"""
+        try:
+            cache.clear()
+        except RedisError:
+            print('Redis port is closed, the redis server '
+                  'does not appear to be running.')
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_window_statistics(self):
+        """Non numeric values are skipped, chunks are merged"""
+        current_app.config['MAX_API_DATA_PER_REQUEST'] = 2
+        for second, value in enumerate(['1', '2', '3', 'off', '6']):
+            db.session.add(Machine(
+                datetime='2017-09-13T13:01:5{}Z'.format(second),
+                sensor_1=value))
+        db.session.commit()
+        result = window_statistics('2017-09-13T13:01:50Z',
+                                   '2017-09-13T13:01:59Z').result([50])
+        self.assertTrue(result['sensor_1']['count'] == 4)
+        self.assertTrue(result['sensor_1']['mean'] == 3.0)
+        self.assertTrue(result['sensor_1']['max'] == 6.0)
+        self.assertTrue(result['sensor_1']['percentiles']['50'] == 2.5)
+
+    def test_placement(self):
+        """Long windows go to the batch queue, shorter windows go first"""
+        self.assertTrue(placement(60) == ('interactive', 0))
+        self.assertTrue(placement(3600) == ('interactive', 0))
+        self.assertTrue(placement(3600 * 2) == ('interactive', 1))
+        self.assertTrue(placement(3600 * 24)[0] == 'interactive')
+        self.assertTrue(placement(3600 * 24 + 1)[0] == 'batch')
+        self.assertTrue(placement(3600 * 24 * 31) == ('batch', 9))